@@ -0,0 +1,88 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Helpers shared by the benchmark scripts: timing of functions and writing the results as JSON.
+"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+BASELINE = "baseline"
+
+
+def measure(func, count):
+    """Call func count times, return the statistics of the durations (in seconds)"""
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def summarize(durations):
+    """Return the statistics of a list of durations (in seconds)"""
+    return {
+        "count": len(durations),
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+        "max": max(durations),
+    }
+
+
+def compare(group, baseline=BASELINE):
+    """Add the median relative to the median of the baseline to all results in the group"""
+    reference = group.get(baseline, {}).get("median")
+    if reference:
+        for result in group.values():
+            result["relative"] = result["median"] / reference
+    return group
+
+
+def write_results(results, filename=None, label=None):
+    """Write the results as JSON to filename (stdout if None), with some information on the environment"""
+    data = {
+        "meta": {
+            "label": label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "argv": sys.argv,
+        },
+        "results": results,
+    }
+    if filename is None:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(filename, "w", encoding="utf8") as fih:
+            json.dump(data, fih, indent=2, sort_keys=True)
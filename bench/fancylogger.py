@@ -0,0 +1,283 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of vsc.utils.fancylogger, compared with plain logging (the baseline)
+
+ - records: logging messages (creating, formatting and writing the log records), with and without fancyrecord,
+   and with or without the class name of the caller in the log format
+ - getlogger: getting a logger, also with the calling function and class in its name (and creating a Run instance,
+   which gets a logger)
+ - async: logging messages to a file, as seen by the logging thread, synchronously and via the queue
+   of enable_async_logging (with the block and drop_debug_first policies, the latter with a small queue)
+ - stream: streaming chunks of 1kB to a file with streamLog (as RunLoopLog does), flushing every chunk or buffered
+ - json: logging messages (with fancyrecord) with the default text format and as JSON, serialised with orjson
+   (if it is available) and with the json module
+
+The results (durations in seconds) are written as JSON, e.g. to compare releases:
+
+python bench/fancylogger.py --label 3.6.10 --output fancylogger-3.6.10.json
+python bench/fancylogger.py --only records --records 10000
+python bench/fancylogger.py --only getlogger --getloggers 1000
+python bench/fancylogger.py --only async --records 100000
+python bench/fancylogger.py --only stream --records 100000
+python bench/fancylogger.py --only json --records 100000
+"""
+
+import logging
+import os
+import sys
+import tempfile
+from unittest import mock
+
+from benchutils import BASELINE, compare, measure, write_results
+
+from vsc.utils import fancylogger
+from vsc.utils.generaloption import simple_option
+from vsc.utils.run import RunNoShell
+
+BENCHMARKS = ["records", "getlogger", "async", "stream", "json"]
+
+FORMAT = "%(asctime)-15s %(levelname)-10s %(name)-15s %(threadName)-10s  %(message)s"
+FORMAT_CLASSNAME = "%(asctime)-15s %(levelname)-10s %(name)-15s %(className)s %(threadName)-10s  %(message)s"
+
+
+class Logging:
+    """Log from a method, a few calls deep (like in a real application)"""
+
+    def __init__(self, logger, depth=10):
+        self.logger = logger
+        self.depth = depth
+
+    def log(self, count, depth=None):
+        """Log count messages from depth calls deep"""
+        if depth is None:
+            depth = self.depth
+        if depth:
+            self.log(count, depth - 1)
+            return
+        for idx in range(count):
+            self.logger.debug("message %s of %s", idx, count)
+
+
+def bench_records(count, records):
+    """Logging records messages with DEBUG level to /dev/null"""
+    results = {}
+    with open(os.devnull, "w", encoding="utf8") as devnull:
+        for name, fmt in [("default_format", FORMAT), ("classname_format", FORMAT_CLASSNAME)]:
+            handler = logging.StreamHandler(devnull)
+            handler.setFormatter(logging.Formatter(fmt))
+
+            loggers = {
+                BASELINE: logging.getLogger("bench_plain"),
+                "fancylogger": fancylogger.getLogger("bench_fancy", fancyrecord=False),
+                "fancylogger_fancyrecord": fancylogger.getLogger("bench_fancyrecord", fancyrecord=True),
+            }
+            funcs = {}
+            for key, logger in loggers.items():
+                logger.propagate = False
+                logger.handlers = [handler]
+                logger.setLevel(logging.DEBUG)
+                if key != "fancylogger_fancyrecord" and fmt == FORMAT_CLASSNAME:
+                    # plain log records have no className
+                    continue
+                funcs[key] = lambda runner=Logging(logger): runner.log(records)
+
+            results[name] = compare({key: measure(func, count) for key, func in funcs.items()})
+            for result in results[name].values():
+                result["records_per_s"] = records / result["median"]
+            for logger in loggers.values():
+                logger.handlers = []
+    return results
+
+
+class GetLogger:
+    """Get loggers from a method, a few calls deep (like in a real application)"""
+
+    def get(self, count, depth=10, **kwargs):
+        """Get count loggers from depth calls deep"""
+        if depth:
+            self.get(count, depth - 1, **kwargs)
+            return
+        for _ in range(count):
+            fancylogger.getLogger("bench_getlogger", **kwargs)
+
+
+def bench_getlogger(count, getloggers):
+    """Getting getloggers loggers"""
+    getter = GetLogger()
+
+    def run_instances():
+        for _ in range(getloggers):
+            RunNoShell(["true"])
+
+    funcs = {
+        BASELINE: lambda: [logging.getLogger("bench_getlogger") for _ in range(getloggers)],
+        "getlogger": lambda: getter.get(getloggers),
+        "getlogger_fname": lambda: getter.get(getloggers, fname=True),
+        "getlogger_fname_clsname": lambda: getter.get(getloggers, fname=True, clsname=True),
+        "run_instance": run_instances,
+    }
+    group = compare({name: measure(func, count) for name, func in funcs.items()})
+    for result in group.values():
+        result["getloggers_per_s"] = getloggers / result["median"]
+    return group
+
+
+def bench_async(count, records):
+    """Logging records messages with DEBUG level to a file, the durations only include the logging calls"""
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    variants = {
+        BASELINE: None,
+        "async_block": {"policy": "block"},
+        "async_drop_debug_first": {"policy": "drop_debug_first", "queue_size": 1000},
+    }
+    group = {}
+    for name, async_opts in variants.items():
+        logger = fancylogger.getLogger(f"bench_{name}", fancyrecord=False)
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.setLevel(logging.DEBUG)
+        queue_handler = None
+        if async_opts is not None:
+            queue_handler = fancylogger.enable_async_logging(name=f"bench_{name}", **async_opts)
+        runner = Logging(logger)
+        group[name] = measure(lambda runner=runner: runner.log(records), count)
+        if queue_handler is not None:
+            fancylogger.disable_async_logging(name=f"bench_{name}")
+            group[name]["dropped"] = queue_handler.queue.dropped
+        logger.handlers = []
+
+    group = compare(group)
+    for result in group.values():
+        result["records_per_s"] = records / result["median"]
+    handler.close()
+    os.remove(filename)
+    return group
+
+
+def bench_stream(count, chunks):
+    """Streaming chunks chunks of 1kB to a file"""
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    handler = logging.FileHandler(filename)
+    logger = fancylogger.getLogger("bench_stream")
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    chunk = "x" * 1023 + "\n"
+
+    def stream(buffered):
+        for _ in range(chunks):
+            logger.streamLog(logging.INFO, chunk, buffered=buffered)
+        logger.streamFlush()
+
+    funcs = {
+        BASELINE: lambda: stream(False),
+        "buffered": lambda: stream(True),
+    }
+    group = compare({name: measure(func, count) for name, func in funcs.items()})
+    for result in group.values():
+        result["chunks_per_s"] = chunks / result["median"]
+    logger.handlers = []
+    handler.close()
+    os.remove(filename)
+    return group
+
+
+def bench_json(count, records):
+    """Logging records messages with INFO level (and an extra field) to /dev/null, as text and as JSON"""
+    with mock.patch.object(fancylogger, "HAVE_ORJSON", False):
+        json_formatter = fancylogger.JsonFormatter()
+    formatters = {
+        BASELINE: logging.Formatter(fancylogger.DEFAULT_LOGGING_FORMAT),
+        "json": fancylogger.JsonFormatter(),
+        "json_stdlib": json_formatter,
+    }
+    if not fancylogger.HAVE_ORJSON:
+        del formatters["json"]
+
+    logger = fancylogger.getLogger("bench_json", fancyrecord=True)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    def log():
+        for idx in range(records):
+            logger.info("message %s of %s", idx, records, extra={"idx": idx})
+
+    group = {}
+    with open(os.devnull, "w", encoding="utf8") as devnull:
+        handler = logging.StreamHandler(devnull)
+        logger.handlers = [handler]
+        for name, formatter in formatters.items():
+            handler.setFormatter(formatter)
+            group[name] = measure(log, count)
+        logger.handlers = []
+
+    group = compare(group)
+    for result in group.values():
+        result["records_per_s"] = records / result["median"]
+    return group
+
+
+def main():
+    """Run the selected benchmarks and write the results"""
+    options = {
+        "only": ("Only run these benchmarks", "strlist", "store", BENCHMARKS),
+        "output": ("Write the results to this JSON file (default: stdout)", None, "store", None, "o"),
+        "label": ("Label for this run (e.g. the version)", None, "store", None),
+        "count": ("Number of times each benchmark is run", "int", "store", 5, "n"),
+        "records": ("Number of log records (or streamed chunks) per benchmark", "int", "store", 10000),
+        "getloggers": ("Number of loggers in the getlogger benchmark", "int", "store", 1000),
+    }
+    go = simple_option(options)
+    opts = go.options
+
+    results = {}
+    for name in opts.only:
+        go.log.info("Running benchmark %s", name)
+        if name == "records":
+            results[name] = bench_records(opts.count, opts.records)
+        elif name == "getlogger":
+            results[name] = bench_getlogger(opts.count, opts.getloggers)
+        elif name == "async":
+            results[name] = bench_async(opts.count, opts.records)
+        elif name == "stream":
+            results[name] = bench_stream(opts.count, opts.records)
+        elif name == "json":
+            results[name] = bench_json(opts.count, opts.records)
+        else:
+            go.log.error("Unknown benchmark %s (known: %s)", name, ", ".join(BENCHMARKS))
+            sys.exit(1)
+
+    write_results(results, filename=opts.output, label=opts.label)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of the vsc.utils.run wrappers, compared with plain subprocess.run (the baseline)
+
+ - spawn: latency of starting a command that does nothing (and spawns per second),
+   with fork/exec and with posix_spawn, optionally from a process with a large RSS
+ - throughput: reading outputs of several MB (or GB)
+ - qa: answering a question after a lot of output (eg 100 MB with --qa-mb 100), with many question patterns,
+   also with debug logging (to /dev/null) of the qa loop
+ - kill: killing a process tree with _killtasks and _killtree
+
+The results (durations in seconds) are written as JSON, e.g. to compare releases:
+
+python bench/run.py --label 3.6.10 --output run-3.6.10.json
+python bench/run.py --only spawn,qa --sizes 1,1000
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchutils import BASELINE, compare, measure, summarize, write_results
+
+from vsc.utils.fancylogger import getLogger
+from vsc.utils.generaloption import simple_option
+from vsc.utils.run import (
+    RunNoShell,
+    RunNoShellFile,
+    RunNoShellQA,
+    RunNoShellTimeout,
+    RunPool,
+    async_run,
+    asyncloop,
+    qa,
+    run,
+    run_simple,
+)
+
+BENCHMARKS = ["spawn", "throughput", "qa", "kill"]
+
+MB = 1024 * 1024
+
+SPAWN_CMD = ["true"]
+
+# prints lines of output, then asks the last question of the qa dict
+QA_SCRIPT = """
+import sys
+sys.stdout.write("".join("line %d of output\\n" % i for i in range(int(sys.argv[1]))))
+print("Question %s?" % sys.argv[2], end="", flush=True)
+print("Answer %s" % sys.stdin.readline().strip())
+"""
+
+# nested shells, all sleeping: width children with each 2 children
+TREE_CMD = 'for i in $(seq %d); do sh -c "sleep 300 & sleep 300 & wait" & done; wait'
+
+
+def bench_spawn(count, rss=0):
+    """Latency of running a command that does nothing, from a process that uses (at least) rss MB of memory"""
+    # the memory must be touched to be part of the RSS (and to be copied on fork)
+    memory = bytearray(rss * MB)
+    for idx in range(0, len(memory), 4096):
+        memory[idx] = 1
+    pool = RunPool()
+
+    funcs = {
+        BASELINE: lambda: subprocess.run(SPAWN_CMD, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False),
+        "run": lambda: run(SPAWN_CMD),
+        "run_posix_spawn": lambda: run(SPAWN_CMD, posix_spawn=True),
+        "run_simple": lambda: run_simple(SPAWN_CMD),
+        "run_simple_posix_spawn": lambda: run_simple(SPAWN_CMD, posix_spawn=True),
+        "async_run": lambda: async_run(SPAWN_CMD),
+        "asyncloop": lambda: asyncloop(SPAWN_CMD),
+        "asyncloop_event_driven": lambda: asyncloop(SPAWN_CMD, event_driven=True),
+        "timeout": lambda: RunNoShellTimeout.run(SPAWN_CMD, timeout=60),
+        "qa": lambda: qa(SPAWN_CMD, qa={"Question?": "answer"}),
+        "pool": lambda: pool.run(SPAWN_CMD),
+    }
+    group = compare({name: measure(func, count) for name, func in funcs.items()})
+    for result in group.values():
+        result["spawns_per_s"] = 1 / result["median"]
+    pool.close()
+    del memory
+    return group
+
+
+def bench_throughput(sizes, count, tmpdir):
+    """Reading the output of size MB"""
+    filename = os.path.join(tmpdir, "output")
+    results = {}
+    for size in sizes:
+        cmd = ["head", "-c", str(size * MB), "/dev/zero"]
+
+        def stream():
+            for _ in RunNoShell.stream(cmd, lines=False):
+                pass
+
+        funcs = {
+            BASELINE: lambda: subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False),
+            "asyncloop": lambda: asyncloop(cmd),
+            "asyncloop_event_driven": lambda: asyncloop(cmd, event_driven=True),
+            "asyncloop_binary": lambda: asyncloop(cmd, event_driven=True, binary=True),
+            "asyncloop_adaptive": lambda: asyncloop(cmd, adaptive_readsize=True),
+            "asyncloop_adaptive_pipe_1MB": lambda: asyncloop(cmd, adaptive_readsize=True, pipe_size=MB),
+            "timeout": lambda: RunNoShellTimeout.run(cmd, timeout=3600),
+            "stream": stream,
+            "file_tee": lambda: RunNoShellFile.run(cmd, filename=filename, tee=True),
+        }
+        group = compare({name: measure(func, count) for name, func in funcs.items()})
+        for result in group.values():
+            result["mb_per_s"] = size / result["median"]
+        results[f"{size}MB"] = group
+    return results
+
+
+def qa_lines_for_size(size):
+    """Return the number of lines the QA_SCRIPT prints for (at least) size bytes of output"""
+    lines = 0
+    # lines with the same number of digits have the same length
+    for digits in range(1, 20):
+        length = len(f"line {10 ** (digits - 1)} of output\n")
+        nr = 9 * 10 ** (digits - 1) + (digits == 1)
+        if size <= nr * length:
+            return lines + -(-size // length)
+        lines += nr
+        size -= nr * length
+    return lines
+
+
+def bench_qa(patterns, lines, count):
+    """Answering a question after lines of output, with a qa dict of patterns questions"""
+    results = {}
+    for nr_patterns in patterns:
+        cmd = [sys.executable, "-c", QA_SCRIPT, str(lines), str(nr_patterns - 1)]
+        qa_dict = {f"Question {idx}?": f"answer {idx}" for idx in range(nr_patterns)}
+        answer = f"answer {nr_patterns - 1}\n"
+
+        funcs = {
+            BASELINE: lambda: subprocess.run(cmd, input=answer.encode(), stdout=subprocess.PIPE, check=False),
+            "qa": lambda: RunNoShellQA.run(cmd, qa=qa_dict),
+            "qa_event_driven": lambda: RunNoShellQA.run(cmd, qa=qa_dict, event_driven=True),
+        }
+        timings = {name: measure(func, count) for name, func in funcs.items()}
+        with qa_debug_logging():
+            for name in ["qa", "qa_event_driven"]:
+                timings[f"{name}_debug"] = measure(funcs[name], count)
+        results[f"{nr_patterns}patterns"] = compare(timings)
+    return results
+
+
+@contextlib.contextmanager
+def qa_debug_logging():
+    """Log the debug messages of RunNoShellQA (to /dev/null)"""
+    log = getLogger(RunNoShellQA.__name__)
+    orig = (log.level, log.propagate, log.handlers)
+    with open(os.devnull, "w", encoding="utf8") as devnull:
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
+        log.handlers = [logging.StreamHandler(devnull)]
+        try:
+            yield
+        finally:
+            log.level, log.propagate, log.handlers = orig
+
+
+def session_pids(sid):
+    """Return the pids of all processes (excluding zombies) in session sid"""
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", encoding="utf8") as fih:
+                fields = fih.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        # fields after the command: state ppid pgrp session
+        if fields[0] != "Z" and int(fields[3]) == sid:
+            pids.append(int(pid))
+    return pids
+
+
+def start_tree(width):
+    """Start a process tree in a new session, return the process once all processes are started"""
+    proc = subprocess.Popen(["sh", "-c", TREE_CMD % width], start_new_session=True)
+    expected = 1 + width * 3
+    while len(session_pids(proc.pid)) < expected:
+        time.sleep(0.01)
+    return proc
+
+
+def bench_kill(widths, count):
+    """Killing a process tree, the number of processes that survive is reported as survivors"""
+    runner = RunNoShell(SPAWN_CMD)
+    kills = {
+        BASELINE: lambda proc: proc.kill(),
+        "killtasks": lambda proc: runner._killtasks(tasks=[proc.pid], kill_pgid=False),
+        "killtasks_pgid": lambda proc: runner._killtasks(tasks=[proc.pid], kill_pgid=True),
+        "killtree": lambda proc: runner._killtree(proc.pid, process=proc),
+        "killtree_sigkill": lambda proc: runner._killtree(proc.pid, grace=0, process=proc),
+    }
+
+    results = {}
+    for width in widths:
+        group = {}
+        for name, kill in kills.items():
+            durations = []
+            survivors = []
+            for _ in range(count):
+                proc = start_tree(width)
+                start = time.perf_counter()
+                kill(proc)
+                proc.wait()
+                durations.append(time.perf_counter() - start)
+                time.sleep(0.1)
+                survivors.append(len(session_pids(proc.pid)))
+                # cleanup whatever survived
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            group[name] = summarize(durations)
+            group[name]["survivors"] = max(survivors)
+        results[f"{1 + width * 3}processes"] = compare(group)
+    return results
+
+
+def main():
+    """Run the selected benchmarks and write the results"""
+    options = {
+        "only": ("Only run these benchmarks", "strlist", "store", BENCHMARKS),
+        "output": ("Write the results to this JSON file (default: stdout)", None, "store", None, "o"),
+        "label": ("Label for this run (e.g. the version)", None, "store", None),
+        "count": ("Number of times each command is run (for spawn: 10 times more)", "int", "store", 5, "n"),
+        "spawn-rss": ("Memory (in MB) used by this process during the spawn benchmark", "int", "store", 0),
+        "sizes": ("Output sizes in MB for the throughput benchmark", "strlist", "store", ["1", "10", "100"]),
+        "qa-patterns": ("Number of question patterns for the qa benchmark", "strlist", "store", ["1", "10", "100"]),
+        "qa-lines": ("Lines of output before the question in the qa benchmark", "int", "store", 10000),
+        "qa-mb": ("Output (in MB) before the question in the qa benchmark (overrides qa-lines)", "int", "store", 0),
+        "kill-widths": ("Number of subtrees of the process tree to kill", "strlist", "store", ["1", "10"]),
+    }
+    go = simple_option(options)
+    opts = go.options
+
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in opts.only:
+            go.log.info("Running benchmark %s", name)
+            if name == "spawn":
+                results[name] = bench_spawn(opts.count * 10, rss=opts.spawn_rss)
+            elif name == "throughput":
+                results[name] = bench_throughput([int(x) for x in opts.sizes], opts.count, tmpdir)
+            elif name == "qa":
+                lines = opts.qa_lines
+                if opts.qa_mb:
+                    lines = qa_lines_for_size(opts.qa_mb * MB)
+                results[name] = bench_qa([int(x) for x in opts.qa_patterns], lines, opts.count)
+            elif name == "kill":
+                results[name] = bench_kill([int(x) for x in opts.kill_widths], opts.count)
+            else:
+                go.log.error("Unknown benchmark %s (known: %s)", name, ", ".join(BENCHMARKS))
+                sys.exit(1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_results(results, filename=opts.output, label=opts.label)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,8 @@ Linux cpu affinity.
 Linux priority
     - Based on sys/resources.h and bits/resources.h see man pages for
       C{getpriority} and C{setpriority}
+NUMA
+    - the cpus of the NUMA nodes, and dividing cpus over workers (see C{spread_cpus})
 
 @author: Stijn De Weirdt (Ghent University)
 """
@@ -74,6 +76,9 @@ PRIO_PROCESS = 0
 PRIO_PGRP = 1
 PRIO_USER = 2
 
+# the NUMA nodes, with their cpus in nodeX/cpulist
+NODE_SYSFS_PATH = "/sys/devices/system/node"
+
 # /* using pid_t for __pid_t */
 # typedef unsigned pid_t;
 pid_t = ctypes.c_uint
@@ -353,3 +358,78 @@ def setpriority(prio, which=None, who=None):
         logging.debug("setpriority for which %s who %s prio %s", which, who, prio)
     else:
         logging.error("setpriority failed for which %s who %s prio %s", which, who, prio)
+
+
+def cpulist_to_cpus(txt):
+    """Convert a cpulist (eg 0-3,8 as in /sys/devices/system/node/node0/cpulist) into a list of cpu indices"""
+    cs = cpu_set_t()
+    cs.convert_hr_bits(txt.strip())
+    return [idx for idx, cpu in enumerate(cs.cpus) if cpu == 1]
+
+
+def get_allowed_cpus(pid=None):
+    """Return the list of cpu indices pid (default: this process) is allowed to run on"""
+    return [idx for idx, cpu in enumerate(sched_getaffinity(pid=pid).get_cpus()) if cpu == 1]
+
+
+def get_numa_nodes(path=NODE_SYSFS_PATH):
+    """Return dict with the list of cpu indices of each NUMA node (with cpus), from <path>/node*/cpulist"""
+    nodes = {}
+    try:
+        names = os.listdir(path)
+    except OSError as err:
+        logging.debug("get_numa_nodes: no NUMA information in %s: %s", path, err)
+        return nodes
+
+    for name in names:
+        if not (name.startswith("node") and name[4:].isdigit()):
+            continue
+        try:
+            with open(os.path.join(path, name, "cpulist"), encoding="ascii") as fih:
+                cpulist = fih.read().strip()
+        except OSError:
+            continue
+        if cpulist:
+            nodes[int(name[4:])] = cpulist_to_cpus(cpulist)
+    logging.debug("get_numa_nodes: found nodes %s", nodes)
+    return nodes
+
+
+def spread_cpus(count, numa=False, cpus=None, path=NODE_SYSFS_PATH):
+    """
+    Divide the cpus in (at most) count groups of neighbouring cpus, eg to pin count workers
+        @param count: number of groups
+        @param numa: one group per NUMA node (count is ignored), the cpus of a node are close to its memory
+        @param cpus: list of cpu indices (default: the cpus this process is allowed to run on)
+        @param path: sysfs path with the NUMA nodes
+    """
+    if cpus is None:
+        cpus = get_allowed_cpus()
+    cpus = sorted(cpus)
+    if not cpus:
+        logging.error("spread_cpus: no cpus")
+        raise ValueError("spread_cpus: no cpus")
+
+    if numa:
+        allowed = set(cpus)
+        groups = [[cpu for cpu in node if cpu in allowed] for _, node in sorted(get_numa_nodes(path=path).items())]
+        groups = [group for group in groups if group]
+        if groups:
+            return groups
+        logging.debug("spread_cpus: no NUMA nodes with cpus in %s, using all cpus as a single node", cpus)
+        return [cpus]
+
+    if count < 1:
+        logging.error("spread_cpus: count %s should be at least 1", count)
+        raise ValueError("spread_cpus: count should be at least 1")
+
+    # the first groups get one cpu more if the cpus can't be divided evenly
+    count = min(count, len(cpus))
+    size, extra = divmod(len(cpus), count)
+    groups = []
+    start = 0
+    for idx in range(count):
+        end = start + size + (1 if idx < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
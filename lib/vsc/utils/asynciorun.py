@@ -0,0 +1,243 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+asyncio counterparts of the vsc.utils.run functions
+
+The commands are started with C{asyncio.create_subprocess_exec} and the output is read by the event loop,
+so many commands can run concurrently without a thread per command. Usage:
+
+>>> from vsc.utils import asynciorun
+>>> exitcode, output = await asynciorun.run(["echo", "hello"])
+>>> results = await asyncio.gather(*[asynciorun.timeout(cmd, timeout=10) for cmd in cmds])
+
+The classes reuse the vsc.utils.run classes they are based on (command handling, logging, timeout and
+question/answer processing, ...); only starting the process and waiting for output are done via asyncio.
+They return the same (exitcode, output), and the same RUNRUN_TIMEOUT_EXITCODE / RUNRUN_QA_MAX_MISS_EXITCODE
+exitcodes as their vsc.utils.run counterparts.
+
+Unlike the vsc.utils.run classes, the startpath is passed to the process (the current directory is not changed).
+"""
+
+import asyncio
+import subprocess
+import time
+
+from vsc.utils.run import RunLoopException, RunNoShellLoop, RunNoShellQA, RunNoShellTimeout
+
+
+class AsyncioProcess:
+    """Minimal Popen-like interface to an asyncio process, as used by the Run classes"""
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self.stdin = process.stdin
+        self.stdout = None  # output is read by the event loop
+        self.stderr = None
+
+    def poll(self):
+        """Return the exitcode, or None if the process is still running"""
+        return self.process.returncode
+
+    def send(self, inp):
+        """Queue the input for the process (used by asyncprocess.send_all), the event loop writes it"""
+        if self.stdin is None or self.stdin.transport.is_closing():
+            return None
+        self.stdin.write(bytes(inp))
+        return len(inp)
+
+
+class RunAsyncio:
+    """
+    Mixin to run a RunLoop (sub)class with asyncio; the run and _run methods are coroutines.
+    """
+
+    @classmethod
+    async def run(cls, cmd, **kwargs):
+        """static coroutine
+        return (exitcode,output)
+        """
+        r = cls(cmd, **kwargs)
+        return await r._run()
+
+    async def _run(self):
+        """Start the process, wait for it and return the result"""
+        await self._run_pre()
+        await self._wait_for_process()
+        return self._run_post()
+
+    async def _run_pre(self):
+        """Start the process"""
+        if self._process_module is None:
+            self._prep_module()
+
+        if self.startpath is not None:
+            self._check_startpath()
+
+        if self._shellcmd is None:
+            self._make_shell_command()
+
+        if self._cgroup_limits and self._cgroup is None:
+            self._make_cgroup()
+
+        await self._init_process()
+
+        self._init_input()
+        await self._drain_input()
+
+    async def _init_process(self):
+        """Initialise the self._process"""
+        if self.resources is not None:
+            # the process is reaped by asyncio, so only the elapsed time and I/O counters are known
+            self.resources.start = time.time()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self._shellcmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE if self.separate_stderr else asyncio.subprocess.STDOUT,
+                cwd=self.startpath,
+                env=self.env,
+                preexec_fn=self._preexec if self._needs_preexec() else None,
+            )
+        except (OSError, subprocess.SubprocessError) as err:
+            self.log.exception("_init_process: start of shellcmd %s failed: %s", self._shellcmd, err)
+            raise
+        self._process = AsyncioProcess(process)
+        if self.pipe_size is not None or self.adaptive_readsize:
+            self._init_pipes()
+
+    def _output_pipes(self):
+        """
+        Return the file objects of the output pipes, from the transports of the event loop.
+
+        asyncio.subprocess.Process has no public accessor for its SubprocessTransport; it is the _transport
+        attribute in CPython 3.6 up to (at least) 3.13. If that is not available, no pipes are returned
+        (so pipe_size is not applied, and the adaptive readsize keeps the default maximum).
+        """
+        get_pipe_transport = getattr(getattr(self._process.process, "_transport", None), "get_pipe_transport", None)
+        if get_pipe_transport is None:
+            self.log.debug("_output_pipes: no transport of the asyncio process, output pipes unknown")
+            return []
+        pipes = [get_pipe_transport(fd) for fd in (1, 2)]
+        return [pipe.get_extra_info("pipe") for pipe in pipes if pipe is not None]
+
+    async def _drain_input(self):
+        """Wait until all input is passed to the process"""
+        stdin = self._process.stdin
+        if stdin is not None and not stdin.transport.is_closing():
+            try:
+                await stdin.drain()
+            except ConnectionError as err:
+                self.log.debug("_drain_input: process stdin closed: %s", err)
+
+    async def _read_stderr(self):
+        """Collect the stderr output (when it is separated from the output) until it is closed"""
+        stderr = self._process.process.stderr
+        while True:
+            err = await stderr.read(self.readsize)
+            if not err:
+                break
+            self._process_stderr_buffer.append(self._decode(err, stderr=True))
+        self._process_stderr_buffer.append(self._decode(b"", stderr=True, final=True))
+
+    async def _wait_for_process(self):
+        """
+        Loop over the output as it becomes available, like the event driven RunLoop:
+        the output is passed to _loop_process_output, which is called at least every _loop_poll_timeout() seconds
+        """
+        self._loop_start()
+
+        stdout = self._process.process.stdout
+        eof = False
+        # stderr is read concurrently, so the process never blocks on a full stderr pipe
+        # asyncio.create_task requires Python 3.7
+        stderr_task = asyncio.ensure_future(self._read_stderr()) if self.separate_stderr else None
+        try:
+            while self._loop_continue:
+                try:
+                    out = await asyncio.wait_for(stdout.read(self.readsize), self._loop_poll_timeout())
+                    self._adapt_readsize(len(out))
+                except asyncio.TimeoutError:
+                    out = None
+                if out == b"":
+                    eof = True
+                    # the decoder may still hold an incomplete character
+                    rest = self._decode(out, final=True)
+                    if rest:
+                        self._loop_step(rest)
+                    break
+                self._loop_step(self._decode(out) if out else self._empty_output)
+                await self._drain_input()
+
+            ec = self._process.poll()
+            # the output is closed, but the process may keep running: keep the loop (timeout, qa, ...) going
+            while eof and ec is None and self._loop_continue:
+                try:
+                    ec = await asyncio.wait_for(self._process.process.wait(), self._loop_poll_timeout())
+                except asyncio.TimeoutError:
+                    self._loop_step(self._empty_output)
+                    ec = self._process.poll()
+            self._loop_finish(ec)
+        except RunLoopException as err:
+            self._loop_exception(err)
+            # process was killed, reap it
+            await self._process.process.wait()
+        finally:
+            if stderr_task is not None:
+                await stderr_task
+
+    def _read_process(self, readsize=None):
+        """All output is read in the loop, nothing remains"""
+        return self._empty_output
+
+    def stop_tasks(self):
+        """Kill the process (reaping it is left to asyncio)"""
+        if self.kill_tree:
+            # the cgroup (if any) is only removed once the thread killed the whole tree, see _post_cgroup
+            self._killtree_thread = self._killtree(self._process.pid)
+        else:
+            self._killtasks(tasks=[self._process.pid])
+
+
+class RunNoShellAsyncio(RunAsyncio, RunNoShellLoop):
+    """Run command with asyncio"""
+
+
+class RunNoShellAsyncioTimeout(RunAsyncio, RunNoShellTimeout):
+    """Run command with asyncio for maximum timeout seconds"""
+
+
+class RunNoShellAsyncioQA(RunAsyncio, RunNoShellQA):
+    """Question/Answer processing with asyncio"""
+
+
+# convenient names, mirroring vsc.utils.run
+run = RunNoShellAsyncio.run
+# reads never block the event loop, so there's no need for a separate async variant
+async_run = RunNoShellAsyncio.run
+timeout = RunNoShellAsyncioTimeout.run
+qa = RunNoShellAsyncioQA.run
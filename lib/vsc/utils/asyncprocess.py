@@ -61,15 +61,17 @@ and the methods will return None.
   - modified
     - added STDOUT handle
     - added maxread to recv_some (2012-08-30)
+    - non-blocking pipes (set once) with a persistent selector per pipe, reading into a reusable buffer;
+      recv_some and send_all wait on the selector instead of sleeping (2026-10-18)
 
 @author: Josiah Carlson
 @author: Stijn De Weirdt (Ghent University)
 """
 
-import errno
-import fcntl  # @UnresolvedImport
+import codecs
+import io
 import os
-import select  # @UnresolvedImport
+import selectors
 import subprocess
 import time
 
@@ -79,6 +81,30 @@ MESSAGE = "Other end disconnected!"
 
 
 class Popen(subprocess.Popen):
+    """
+    Popen with non-blocking pipes
+
+    The pipes are made non-blocking (once) on first use by recv, recv_err or send, and are read directly
+    via their file descriptor (so no data is hidden in the buffer of the file object).
+    Each pipe has its own persistent selector, to wait for it with wait_pipe.
+    In text mode, each pipe has its own incremental decoder (with universal newlines), so characters that are
+    split over two reads are decoded correctly.
+    """
+
+    # size of the reusable read buffer, also used to read everything that is available (maxsize -1)
+    READ_BUFFER_SIZE = 64 * 1024
+    # default maxsize of recv and recv_err
+    RECV_MAXSIZE = 1024
+
+    def __init__(self, *args, **kwargs):
+        self._selectors = {}
+        self._decoders = {}
+        self._read_buffer = None
+        super().__init__(*args, **kwargs)
+        if not hasattr(self, "text_mode"):
+            # Popen has no text_mode in Python 3.6
+            self.text_mode = bool(self.encoding or self.errors or self.universal_newlines)
+
     def recv(self, maxsize=None):
         return self._recv("stdout", maxsize)
 
@@ -90,12 +116,52 @@ class Popen(subprocess.Popen):
 
     def get_conn_maxsize(self, which, maxsize):
         if maxsize is None:
-            maxsize = 1024
+            maxsize = self.RECV_MAXSIZE
         elif maxsize == 0:  # do not use < 1: -1 means all
             maxsize = 1
         return getattr(self, which), maxsize
 
+    def _selector(self, which):
+        """
+        Return the selector for pipe which (None if the pipe is closed)
+        The pipe is made non-blocking when the selector is created.
+        """
+        sel = self._selectors.get(which)
+        if sel is None:
+            conn = getattr(self, which)
+            if conn is None:
+                return None
+            os.set_blocking(conn.fileno(), False)
+            sel = selectors.DefaultSelector()
+            sel.register(conn.fileno(), selectors.EVENT_WRITE if which == "stdin" else selectors.EVENT_READ)
+            self._selectors[which] = sel
+        return sel
+
+    def wait_pipe(self, which, timeout=None):
+        """
+        Wait until pipe which is ready for reading (or writing for stdin), or closed
+            @param timeout: max time to wait (None: no limit)
+        Returns False if the timeout expired.
+        """
+        sel = self._selector(which)
+        if sel is None:
+            return True
+        return bool(sel.select(timeout))
+
+    def _decoder(self, which):
+        """Return the incremental decoder for the output of pipe which (text mode only)"""
+        decoder = self._decoders.get(which)
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(self.encoding or "utf8")(errors=self.errors or "strict")
+            decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+            self._decoders[which] = decoder
+        return decoder
+
     def _close(self, which):
+        self._decoders.pop(which, None)
+        sel = self._selectors.pop(which, None)
+        if sel is not None:
+            sel.close()
         getattr(self, which).close()
         setattr(self, which, None)
 
@@ -103,16 +169,13 @@ class Popen(subprocess.Popen):
         if not self.stdin:
             return None
 
-        if not select.select([], [self.stdin], [], 0)[1]:
-            return 0
-
+        self._selector("stdin")
         try:
             written = os.write(self.stdin.fileno(), inp)
-            self.stdin.flush()
-        except OSError as why:
-            if why.args[0] == errno.EPIPE:  # broken pipe
-                return self._close("stdin")
-            raise
+        except BlockingIOError:
+            return 0
+        except BrokenPipeError:  # other end disconnected
+            return self._close("stdin")
 
         return written
 
@@ -121,24 +184,53 @@ class Popen(subprocess.Popen):
         if conn is None:
             return None
 
-        flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-        if not conn.closed:
-            fcntl.fcntl(conn, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
-        try:
-            if not select.select([conn], [], [], 0)[0]:
-                return ""
-
-            r = conn.read(maxsize)
-            if not r:
-                return self._close(which)  # close when nothing left to read
+        self._selector(which)
+        if self._read_buffer is None:
+            self._read_buffer = bytearray(self.READ_BUFFER_SIZE)
+
+        fd = conn.fileno()
+        size = self.READ_BUFFER_SIZE if maxsize < 0 else maxsize
+        if len(self._read_buffer) < size:
+            self._read_buffer = bytearray(size)
+        view = memoryview(self._read_buffer)[:size]
+
+        chunks = []
+        while True:
+            try:
+                nread = os.readv(fd, [view])
+            except BlockingIOError:
+                break
+            if not nread:
+                if not chunks:
+                    if self.text_mode:
+                        # incomplete characters at the end are decoded (or raise) before the pipe is closed
+                        rest = self._decoder(which).decode(b"", final=True)
+                        if rest:
+                            return rest
+                    return self._close(which)  # close when nothing left to read
+                break  # report the end on the next call
+            chunks.append(bytes(view[:nread]))
+            # only -1 reads everything that is available
+            if maxsize >= 0 or nread < size:
+                break
 
-            if self.universal_newlines:
-                r = self._translate_newlines(r)
-            return r
-        finally:
-            if not conn.closed:
-                fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+        r = b"".join(chunks)
+        if self.text_mode:
+            r = self._decoder(which).decode(r)
+        return r
+
+    def recv_all(self, which="stdout"):
+        """Read from pipe which until it is closed (blocking), return all data"""
+        chunks = []
+        while True:
+            r = self._recv(which, -1)
+            if r is None:
+                break
+            if r:
+                chunks.append(r)
+            else:
+                self.wait_pipe(which)
+        return (b"" if not self.text_mode else "").join(chunks)
 
 
 def recv_some(p, t=0.1, e=False, tr=5, stderr=False, maxread=None):
@@ -146,28 +238,29 @@ def recv_some(p, t=0.1, e=False, tr=5, stderr=False, maxread=None):
     @param p: process
     @param t: max time to wait without any output before returning
     @param e: boolean, raise exception is process stopped
-    @param tr: time resolution used for intermediate sleep
+    @param tr: time resolution used for intermediate sleep (unused, waits on the pipe instead)
     @param stderr: boolean, read from stderr
     @param maxread: stop when max read bytes have been read (before timeout t kicks in) (-1: read all)
 
     Changes made wrt original:
       - add maxread here
       - set e to False by default
+      - wait on the pipe instead of sleeping
     """
     if maxread is None:
         maxread = -1
 
-    if tr < 1:
-        tr = 1
-    x = time.time() + t
-    y = []
-    len_y = 0
-    r = ""
+    which = "stdout"
     pr = p.recv
     if stderr:
+        which = "stderr"
         pr = p.recv_err
-    while (maxread < 0 or len_y <= maxread) and (time.time() < x or r):
-        r = pr(maxread)
+
+    x = time.time() + t
+    y = []
+    len_y = 0
+    while maxread < 0 or len_y < maxread:
+        r = pr(-1 if maxread < 0 else maxread - len_y)
         if r is None:
             if e:
                 raise Exception(MESSAGE)
@@ -177,7 +270,9 @@ def recv_some(p, t=0.1, e=False, tr=5, stderr=False, maxread=None):
             y.append(r)
             len_y += len(r)
         else:
-            time.sleep(max((x - time.time()) / tr, 0))
+            timeout = x - time.time()
+            if timeout <= 0 or not p.wait_pipe(which, timeout):
+                break
     return b"".join(y)
 
 
@@ -193,6 +288,9 @@ def send_all(p, data):
         sent = p.send(data)
         if sent is None:
             raise Exception(MESSAGE)
+        elif sent == 0:
+            # pipe is full
+            p.wait_pipe("stdin")
         allsent += sent
         data = memoryview(data)[sent:]
     return allsent
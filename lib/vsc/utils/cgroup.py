@@ -0,0 +1,214 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Linux cgroup v2: transient cgroups with resource limits, eg to run a command in (see vsc.utils.run).
+
+The cgroups are created under a parent cgroup that is delegated to the user (eg by systemd with Delegate=yes),
+by default the cgroup this process is in. The controllers for the limits are enabled in the parent
+(C{cgroup.subtree_control}), which is only possible if the parent has no processes of its own.
+
+>>> cgroup = Cgroup.create(limits={"memory.max": "1G", "pids.max": "100"})
+>>> proc = subprocess.Popen(cmd, preexec_fn=cgroup.attach)
+>>> proc.wait()
+>>> cgroup.stats()
+>>> cgroup.remove()
+"""
+
+import errno
+import itertools
+import os
+import time
+
+from vsc.utils.fancylogger import getLogger
+
+CGROUP_MOUNT = "/sys/fs/cgroup"
+
+# controller of the interface files (the part before the dot)
+CONTROLLERS = ("cpu", "cpuset", "io", "memory", "pids", "hugetlb", "rdma", "misc")
+
+_counter = itertools.count()
+
+
+def get_cgroup(pid="self", mount=CGROUP_MOUNT):
+    """Return the path of the cgroup v2 of pid (None if pid is not in a cgroup v2 hierarchy)"""
+    try:
+        with open(f"/proc/{pid}/cgroup", encoding="utf8") as fih:
+            lines = fih.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        # cgroup v2 is hierarchy 0, without controllers
+        if line.startswith("0::"):
+            return os.path.join(mount, line[3:].lstrip("/"))
+    return None
+
+
+class Cgroup:
+    """A cgroup v2, with its interface files"""
+
+    def __init__(self, path):
+        """
+        @param path: the directory of the cgroup (in the cgroup2 filesystem)
+        """
+        self.path = path
+        self.log = getLogger(self.__class__.__name__)
+
+    @classmethod
+    def create(cls, parent=None, name=None, limits=None):
+        """
+        Create a new cgroup
+            @param parent: path of the parent cgroup (default: the cgroup of this process)
+            @param name: name of the new cgroup (default: unique name based on the pid of this process)
+            @param limits: dict with interface files and values to write in them, eg {"memory.max": "1G"}
+        """
+        if parent is None:
+            parent = get_cgroup()
+            if parent is None:
+                msg = "Cgroup.create: this process is not in a cgroup v2 hierarchy"
+                getLogger(cls.__name__).error(msg)
+                raise OSError(msg)
+        if name is None:
+            name = f"vsc-run-{os.getpid()}-{next(_counter)}"
+
+        parent = cls(parent)
+        if limits:
+            parent.enable_controllers({key.split(".")[0] for key in limits})
+
+        cgroup = cls(os.path.join(parent.path, name))
+        try:
+            os.mkdir(cgroup.path)
+        except OSError as err:
+            msg = f"Cgroup.create: failed to create cgroup {cgroup.path}: {err}"
+            cgroup.log.error(msg)
+            raise OSError(msg) from err
+        cgroup.log.debug("create: created cgroup %s", cgroup.path)
+
+        try:
+            for key, value in (limits or {}).items():
+                cgroup.write(key, value)
+        except OSError:
+            cgroup.remove()
+            raise
+        return cgroup
+
+    def read(self, key):
+        """Return the content of interface file key, None if it doesn't exist"""
+        try:
+            with open(os.path.join(self.path, key), encoding="ascii") as fih:
+                return fih.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, value):
+        """Write value to interface file key"""
+        try:
+            with open(os.path.join(self.path, key), "w", encoding="ascii") as fih:
+                fih.write(str(value))
+        except OSError as err:
+            msg = f"Cgroup: failed to write {value} to {key} of cgroup {self.path}: {err}"
+            self.log.error(msg)
+            raise OSError(msg) from err
+
+    def enable_controllers(self, controllers):
+        """Enable the controllers for the children of this cgroup (if they are not enabled yet)"""
+        unknown = set(controllers) - set(CONTROLLERS)
+        if unknown:
+            msg = f"Cgroup: unknown controllers {sorted(unknown)}"
+            self.log.error(msg)
+            raise ValueError(msg)
+
+        enabled = (self.read("cgroup.subtree_control") or "").split()
+        missing = sorted(set(controllers) - set(enabled))
+        if missing:
+            self.log.debug("enable_controllers: enabling %s in cgroup %s", missing, self.path)
+            self.write("cgroup.subtree_control", " ".join(f"+{ctrl}" for ctrl in missing))
+
+    def attach(self, pid=None):
+        """
+        Move pid to this cgroup (default: the calling process)
+        Only uses os functions, so it can be used as preexec_fn of Popen.
+        """
+        if pid is None:
+            pid = os.getpid()
+        # O_CREAT and O_APPEND make no difference in a cgroup2 filesystem, but allow to use a fake layout (eg in tests)
+        fd = os.open(os.path.join(self.path, "cgroup.procs"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, f"{pid}\n".encode())
+        finally:
+            os.close(fd)
+
+    def procs(self):
+        """Return the pids of the processes in this cgroup"""
+        return [int(pid) for pid in (self.read("cgroup.procs") or "").split()]
+
+    def kill(self):
+        """Kill all processes in this cgroup (and its descendants) with SIGKILL via cgroup.kill (Linux >= 5.14)"""
+        if os.path.exists(os.path.join(self.path, "cgroup.kill")):
+            self.write("cgroup.kill", 1)
+            return True
+        self.log.debug("kill: no cgroup.kill in cgroup %s", self.path)
+        return False
+
+    def memory_peak(self):
+        """Return the maximum memory usage (bytes), from memory.peak (Linux >= 5.19), None if not available"""
+        peak = self.read("memory.peak")
+        return None if peak is None else int(peak)
+
+    def cpu_stat(self):
+        """Return the cpu.stat counters (usage_usec, user_usec, system_usec, nr_throttled, ...) as dict"""
+        stat = {}
+        for line in (self.read("cpu.stat") or "").splitlines():
+            key, _, value = line.partition(" ")
+            stat[key] = int(value)
+        return stat
+
+    def stats(self):
+        """Return memory.peak and cpu.stat as dict"""
+        return {"memory.peak": self.memory_peak(), "cpu.stat": self.cpu_stat()}
+
+    def remove(self, timeout=0):
+        """
+        Remove this cgroup, returns False if that failed
+            @param timeout: seconds to wait for the processes in the cgroup to exit (eg after kill)
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.rmdir(self.path)
+                break
+            except FileNotFoundError:
+                break
+            except OSError as err:
+                if err.errno == errno.EBUSY and time.time() < deadline:
+                    time.sleep(0.01)
+                    continue
+                if err.errno == errno.EBUSY:
+                    self.log.warning("remove: cgroup %s still has processes %s", self.path, self.procs())
+                else:
+                    self.log.warning("remove: failed to remove cgroup %s: %s", self.path, err)
+                return False
+        self.log.debug("remove: removed cgroup %s", self.path)
+        return True
@@ -37,6 +37,9 @@ class Daemon:
         do the UNIX double-fork magic, see Stevens' "Advanced
         Programming in the UNIX Environment" for details (ISBN 0201563177)
         http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16
+
+        asynchronous logging (see fancylogger.enable_async_logging) keeps working in the daemon,
+        the listener thread is restarted when the daemon logs for the first time
         """
         try:
             pid = os.fork()
@@ -33,6 +33,9 @@ It adds:
  - a default formatter.
  - easily setting loglevel
  - easily add extra specifiers in the log record
+ - asynchronous logging: the handlers run in a separate thread, behind a bounded queue
+ - logging to file as JSON (one object per line), also by setting the environment variable FANCYLOG_JSON
+   (serialised with orjson when it is available)
  - internal debugging through environment variables
     FANCYLOGGER_GETLOGGER_DEBUG for getLogger
     FANCYLOGGER_LOGLEVEL_DEBUG for setLogLevel
@@ -55,6 +58,11 @@ usage:
 >>> handler = fancylogger.logToFile("dir/filename")
 >>> formatstring = "%(asctime)-15s %(levelname)-10s %(mpirank)-5s %(funcname)-15s %(threadName)-10s %(message)s"
 >>> handler.setFormatter(logging.Formatter(formatstring))
+>>> # log one JSON object per line, with timestamp, level, name, className, mpirank, thread, message and extra fields
+>>> fancylogger.logToFile("dir/filename.json", json=True)
+>>> logger.info("job %s started", jobid, extra={"jobid": jobid})
+>>> # log asynchronously: formatting and I/O is done by a separate thread (also after forks, eg by daemon.Daemon)
+>>> fancylogger.enable_async_logging(policy="drop_debug_first")
 >>> # setting a global loglevel will impact all logers:
 >>> from vsc.utils import fancylogger
 >>> logger = fancylogger.getLogger("test")
@@ -74,12 +82,16 @@ Logging to a udp server:
 @author: Kenneth Hoste (Ghent University)
 """
 
-import inspect
+import atexit
+import copy
+import json
 import logging
 import logging.handlers
 import os
+import queue
 import sys
 import threading
+import time
 import traceback
 import weakref
 from distutils.version import LooseVersion
@@ -152,6 +164,13 @@ OPTIMIZED_ANSWER = "not available in optimized mode"
 
 HAVE_COLOREDLOGS_MODULE = False
 
+try:
+    import orjson
+
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
 # constants
 TEST_LOGGING_FORMAT = "%(levelname)-10s %(name)-15s %(threadName)-10s  %(message)s"
 DEFAULT_LOGGING_FORMAT = "%(asctime)-15s " + TEST_LOGGING_FORMAT
@@ -166,6 +185,12 @@ _orig_logging_root = [logging.root, logging.root.level, logging.root.handlers[:]
 
 FANCYLOG_LOGGING_FORMAT = None
 FANCYLOG_FANCYRECORD = None
+# log to file as JSON by default (see logToFile)
+FANCYLOG_JSON = _env_to_boolean("FANCYLOG_JSON")
+
+# the fields of the JSON log records (see JsonFormatter), the attributes of the log record that are not
+# standard are added as extra fields
+JSON_LOGGING_FIELDS = ("timestamp", "level", "name", "className", "mpirank", "thread", "message")
 
 # DEFAULT_LOGGING_FORMAT= '%(asctime)-15s %(levelname)-10s %(module)-15s %(threadName)-10s %(message)s'
 MAX_BYTES = 100 * 1024 * 1024  # max bytes in a file with rotating file handler
@@ -173,6 +198,12 @@ BACKUPCOUNT = 10  # number of rotating log files to save
 
 DEFAULT_UDP_PORT = 5005
 
+ASYNC_LOGGING_QUEUE_SIZE = 10000  # max number of log records waiting to be handled by the listener thread
+# what to do with a new log record when the queue is full: wait until there is room, drop the oldest record,
+# or drop a DEBUG record (the new one, or the oldest one in the queue; the oldest record if there are none)
+ASYNC_LOGGING_POLICIES = ("block", "drop_oldest", "drop_debug_first")
+ASYNC_LOGGING_POLICY = "block"
+
 APOCALYPTIC = "APOCALYPTIC"
 logging.addLevelName(logging.CRITICAL * 2 + 1, APOCALYPTIC)
 
@@ -242,6 +273,24 @@ class FancyStreamHandler(logging.StreamHandler):
         self.stream = stream
 
 
+# name of the root module, see getRootLoggerName
+_root_logger_name = None
+
+
+def _calling_class_name(frame):
+    """
+    Return the name of the class of the caller of a logger (the class of its self variable), as used in FancyLogRecord.
+    The variables of the frame are only read if its code has a self variable, and the frame is not kept.
+    """
+    code = frame.f_code
+    if "self" in code.co_varnames or "self" in code.co_freevars or "self" in code.co_cellvars:
+        try:
+            return frame.f_locals["self"].__class__.__name__
+        except Exception:
+            pass
+    return "unknown__getCallingClassName"
+
+
 class FancyLogRecord(logging.LogRecord):
     """
     This class defines a custom log record.
@@ -254,7 +303,11 @@ class FancyLogRecord(logging.LogRecord):
         # we won't do this when running with -O, becuase this might be a heavy operation
         # the __debug__ operation is actually recognised by the python compiler and it won't even do a single comparison
         if __debug__:
-            self.className = _getCallingClassName(depth=5)
+            # the caller of the log method: skip this method, makeRecord, _log and the log method
+            try:
+                self.className = _calling_class_name(sys._getframe(4))
+            except ValueError:
+                self.className = "unknown__getCallingClassName"
         else:
             self.className = "N/A"
         self.mpirank = _MPIRANK
@@ -279,6 +332,18 @@ class FancyLogger(logging.getLoggerClass()):
 
     RAISE_EXCEPTION_LOG_METHOD = log_method
 
+    # buffered streamLog: data is written to the handlers when this much is buffered (in characters),
+    # when the oldest buffered data is this old (in seconds), or with streamFlush
+    STREAM_BUFFER_SIZE = 64 * 1024
+    STREAM_FLUSH_INTERVAL = 1.0
+
+    # the handlers used by streamLog, with the handlers (and propagate) of the loggers they were determined from
+    _stream_handlers = (None, None)
+    # the buffered data per handler, with the total buffered size and the time of the oldest data
+    _stream_buffers = None
+    _stream_buffered_size = 0
+    _stream_buffered_time = None
+
     # method definition as it is in logging, can't change this
     # pylint: disable=unused-argument
     def makeRecord(self, name, level, pathname, lineno, msg, args, excinfo, func=None, extra=None, sinfo=None):
@@ -292,7 +357,14 @@ class FancyLogger(logging.getLoggerClass()):
             new_msg = str(msg)
         except UnicodeEncodeError:
             new_msg = msg.encode("utf8", "replace")
-        return logrecordcls(name, level, pathname, lineno, new_msg, args, excinfo)
+        record = logrecordcls(name, level, pathname, lineno, new_msg, args, excinfo)
+        if extra is not None:
+            # as logging.Logger.makeRecord does, eg for the extra fields of JsonFormatter
+            for key, value in extra.items():
+                if key in ("message", "asctime") or key in record.__dict__:
+                    raise KeyError(f"Attempt to overwrite {key!r} in LogRecord")
+                record.__dict__[key] = value
+        return record
 
     def fail(self, message, *args):
         """Log error message and raise exception."""
@@ -377,25 +449,100 @@ class FancyLogger(logging.getLoggerClass()):
         # This is supported in py27 setLevel code, but not in py24
         self.setLevel(getLevelInt(level_name))
 
-    def streamLog(self, levelno, data):
+    def _streamHandlers(self, cached=False):
+        """
+        Return the handlers like callHandlers would use them (for asynchronous logging, the handlers behind the queue)
+        @param cached: reuse the result as long as the handlers (and propagate) of the loggers do not change
+        """
+        # the handlers of all loggers in the chain (whatever added them, eg logging.basicConfig to the root logger)
+        key = []
+        c = self
+        while c:
+            key.append(c.propagate)
+            for hdlr in c.handlers:
+                key.append(hdlr)
+                if isinstance(hdlr, FancyQueueHandler):
+                    key.append(hdlr.handlers)
+            c = c.parent if c.propagate else None
+
+        cached_key, handlers = self._stream_handlers
+        if cached and key == cached_key:
+            return handlers
+
+        handlers = []
+        c = self
+        while c:
+            for hdlr in c.handlers:
+                if isinstance(hdlr, FancyQueueHandler):
+                    handlers.extend(hdlr.handlers)
+                else:
+                    handlers.append(hdlr)
+            if not c.propagate:
+                c = None  # break out
+            else:
+                c = c.parent
+        self._stream_handlers = (key, handlers)
+        return handlers
+
+    @staticmethod
+    def _streamWrite(hdlr, data):
+        """Write data to the stream of the handler and flush the handler"""
+        if (not hasattr(hdlr, "stream")) or hdlr.stream is None:
+            # no stream or not initialised.
+            raise Exception("write_and_flush_stream failed. No active stream attribute.")
+        hdlr.acquire()
+        try:
+            hdlr.stream.write(data)
+            hdlr.flush()
+        finally:
+            hdlr.release()
+
+    def streamLog(self, levelno, data, buffered=False):
         """
         Add (continuous) data to an existing message stream (eg a stream after a logging.info()
+
+        @param buffered: buffer the data per handler, instead of writing (and flushing) it for every call,
+                         until STREAM_BUFFER_SIZE characters are buffered, the oldest data is STREAM_FLUSH_INTERVAL
+                         seconds old (checked when data is added), or streamFlush is called
+                         (log records are not buffered, so they can end up
+                         before data that was streamed earlier)
         """
         if isinstance(levelno, str):
             levelno = getLevelInt(levelno)
 
-        def write_and_flush_stream(hdlr, data=None):
-            """Write to stream and flush the handler"""
-            if (not hasattr(hdlr, "stream")) or hdlr.stream is None:
-                # no stream or not initialised.
-                raise Exception("write_and_flush_stream failed. No active stream attribute.")
-            if data is not None:
-                hdlr.stream.write(data)
-                hdlr.flush()
-
         # only log when appropriate (see logging.Logger.log())
-        if self.isEnabledFor(levelno):
-            self._handleFunction(write_and_flush_stream, levelno, data=data)
+        if data is None or not self.isEnabledFor(levelno):
+            return
+
+        if not buffered:
+            for hdlr in self._streamHandlers():
+                if levelno >= hdlr.level:
+                    self._streamWrite(hdlr, data)
+            return
+
+        if self._stream_buffers is None:
+            self._stream_buffers = {}
+            self._stream_buffered_time = time.monotonic()
+        for hdlr in self._streamHandlers(cached=True):
+            if levelno >= hdlr.level:
+                self._stream_buffers.setdefault(hdlr, []).append(data)
+        self._stream_buffered_size += len(data)
+
+        if (
+            self._stream_buffered_size >= self.STREAM_BUFFER_SIZE
+            or time.monotonic() - self._stream_buffered_time >= self.STREAM_FLUSH_INTERVAL
+        ):
+            self.streamFlush()
+
+    def streamFlush(self):
+        """Write the data buffered by streamLog to the handlers"""
+        buffers = self._stream_buffers
+        if buffers is None:
+            return
+        self._stream_buffers = None
+        self._stream_buffered_size = 0
+        for hdlr, chunks in buffers.items():
+            self._streamWrite(hdlr, "".join(chunks))
 
     def streamDebug(self, data):
         """Get a DEBUG loglevel streamLog"""
@@ -501,7 +648,7 @@ def _getCallingFunctionName():
     """
     if __debug__:
         try:
-            return inspect.stack()[2][3]
+            return sys._getframe(2).f_code.co_name
         except Exception:
             return "unknown__getCallingFunctionName"
     else:
@@ -515,7 +662,7 @@ def _getCallingClassName(depth=2):
     """
     if __debug__:
         try:
-            return inspect.stack()[depth][0].f_locals["self"].__class__.__name__
+            return sys._getframe(depth).f_locals["self"].__class__.__name__
         except Exception:
             return "unknown__getCallingClassName"
     else:
@@ -526,16 +673,38 @@ def getRootLoggerName():
     """
     returns the name of the root module
     this is the module that is actually running everything and so doing the logging
+    (determined once per process)
     """
     if __debug__:
-        try:
-            return inspect.stack()[-1][1].split("/")[-1].split(".")[0]
-        except Exception:
-            return "unknown_getRootLoggerName"
+        if _root_logger_name is None:
+            _set_root_logger_name()
+        return _root_logger_name
     else:
         return OPTIMIZED_ANSWER
 
 
+def _set_root_logger_name():
+    """
+    Determine the name of the root module: from the file of the __main__ module (or the script in sys.argv[0]),
+    or else from the outermost frame (eg <stdin> for an interactive session)
+    """
+    global _root_logger_name
+
+    try:
+        main = sys.modules.get("__main__")
+        filename = getattr(main, "__file__", None)
+        if not filename and sys.argv and sys.argv[0] and os.path.isfile(sys.argv[0]):
+            filename = sys.argv[0]
+        if not filename:
+            frame = sys._getframe()
+            while frame.f_back is not None:
+                frame = frame.f_back
+            filename = frame.f_code.co_filename
+        _root_logger_name = filename.split("/")[-1].split(".")[0]
+    except Exception:
+        _root_logger_name = "unknown_getRootLoggerName"
+
+
 def logToScreen(enable=True, handler=None, name=None, stdout=False, colorize=None):
     """
     enable (or disable) logging to screen
@@ -568,13 +737,16 @@ def logToScreen(enable=True, handler=None, name=None, stdout=False, colorize=Non
     )
 
 
-def logToFile(filename, enable=True, filehandler=None, name=None, max_bytes=MAX_BYTES, backup_count=BACKUPCOUNT):
+def logToFile(
+    filename, enable=True, filehandler=None, name=None, max_bytes=MAX_BYTES, backup_count=BACKUPCOUNT, json=None
+):
     """
     enable (or disable) logging to file
     given filename
     will log to a file with the given name using a rotatingfilehandler
     this will let the file grow to MAX_BYTES and then rotate it
     saving the last BACKUPCOUNT files.
+    if json is True, log a JSON object per line (see JsonFormatter), default: FANCYLOG_JSON
 
     returns the filehandler (this can be used to later disable logging to file)
 
@@ -595,6 +767,9 @@ def logToFile(filename, enable=True, filehandler=None, name=None, max_bytes=MAX_
             exc, detail, tb = sys.exc_info()
             raise (exc(f"Cannot create logdirectory {directory}: {ex} \n detail: {detail}")).with_traceback(tb)
 
+    if json is None:
+        json = FANCYLOG_JSON
+
     return _logToSomething(
         logging.handlers.RotatingFileHandler,
         handleropts,
@@ -602,6 +777,7 @@ def logToFile(filename, enable=True, filehandler=None, name=None, max_bytes=MAX_
         name=name,
         enable=enable,
         handler=filehandler,
+        formatterclass=JsonFormatter if json else None,
     )
 
 
@@ -655,18 +831,19 @@ def _logToSomething(handlerclass, handleropts, loggeroption, enable=True, name=N
                 formatter = formatterclass(f_format)
                 handler = handlerclass(**handleropts)
                 handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            _addHandler(logger, handler)
             setattr(logger, loggeroption, handler)
         else:
             handler = getattr(logger, loggeroption)
     else:
         # stop logging to X
         if handler is None:
-            if len(logger.handlers) == 1:
+            handlers = _getHandlers(logger)
+            if len(handlers) == 1:
                 # removing the last logger doesn't work
                 # it will be re-added if only one handler is present
                 # so we will just make it quiet by setting the loglevel extremely high
-                zerohandler = logger.handlers[0]
+                zerohandler = handlers[0]
                 # no logging should be done with APOCALYPTIC, so silence happens
                 zerohandler.setLevel(getLevelInt(APOCALYPTIC))
                 if _env_to_boolean("FANCYLOGGER_LOGLEVEL_DEBUG"):
@@ -675,15 +852,341 @@ def _logToSomething(handlerclass, handleropts, loggeroption, enable=True, name=N
                     sys.stdout.flush()
             else:  # remove the handler set with this loggeroption
                 handler = getattr(logger, loggeroption)
-                logger.removeHandler(handler)
+                _removeHandler(logger, handler)
                 if hasattr(handler, "close") and callable(handler.close):
                     handler.close()
         else:
-            logger.removeHandler(handler)
+            _removeHandler(logger, handler)
         setattr(logger, loggeroption, False)
     return handler
 
 
+class AsyncLogQueue(queue.Queue):
+    """
+    Bounded queue of log records, with a policy for when it is full (see ASYNC_LOGGING_POLICIES)
+    and counters of the dropped records: dropped (total) and dropped_levels (per level name)
+    """
+
+    def __init__(self, maxsize=ASYNC_LOGGING_QUEUE_SIZE, policy=ASYNC_LOGGING_POLICY):
+        if policy not in ASYNC_LOGGING_POLICIES:
+            raise ValueError(f"Unknown async logging policy {policy}, should be one of {ASYNC_LOGGING_POLICIES}")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = 0
+        self.dropped_levels = {}
+
+    def _drop(self, record):
+        """Count the dropped record"""
+        self.dropped += 1
+        self.dropped_levels[record.levelname] = self.dropped_levels.get(record.levelname, 0) + 1
+
+    def put_nowait(self, item):
+        """Add a log record (as QueueHandler does), according to the policy if the queue is full"""
+        if self.policy == "block" or item is None:
+            # the sentinel of the listener is never dropped
+            self.put(item)
+            return
+
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                if self.policy == "drop_debug_first" and item.levelno <= logging.DEBUG:
+                    self._drop(item)
+                    return
+                idx = 0
+                if self.policy == "drop_debug_first":
+                    # the oldest DEBUG record, or else the oldest record
+                    idx = next(
+                        (idx for idx, record in enumerate(self.queue) if record and record.levelno <= logging.DEBUG), 0
+                    )
+                dropped = self.queue[idx]
+                del self.queue[idx]
+                self.unfinished_tasks -= 1
+                self._drop(dropped)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class FancyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler with a QueueListener thread that passes the log records to the handlers
+    (see enable_async_logging)
+    """
+
+    def __init__(self, handlers, queue_size=ASYNC_LOGGING_QUEUE_SIZE, policy=ASYNC_LOGGING_POLICY):
+        """
+        @param handlers: the handlers that handle the log records in the listener thread
+        @param queue_size: max number of log records in the queue
+        @param policy: what to do when the queue is full (see ASYNC_LOGGING_POLICIES)
+        """
+        super().__init__(AsyncLogQueue(queue_size, policy))
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.logger = None
+        # the process the listener thread runs in
+        self._pid = os.getpid()
+        self.listener.start()
+
+    @property
+    def handlers(self):
+        """The handlers of the listener"""
+        return self.listener.handlers
+
+    def add_handler(self, handler):
+        """Add a handler to the listener"""
+        if handler not in self.listener.handlers:
+            self.listener.handlers += (handler,)
+
+    def remove_handler(self, handler):
+        """Remove a handler from the listener"""
+        self.listener.handlers = tuple(hndlr for hndlr in self.listener.handlers if hndlr is not handler)
+
+    def emit(self, record):
+        """Queue the record, in a forked process (eg by daemon.Daemon) the listener is restarted first"""
+        if self._pid != os.getpid():
+            self.restart()
+        super().emit(record)
+
+    def prepare(self, record):
+        """
+        Prepare the record to be handled in the listener thread:
+        the message is merged with its arguments (they may change meanwhile) and the traceback is formatted,
+        the rest of the formatting is left to the handlers
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def stop(self):
+        """Stop the listener, once it handled all queued log records"""
+        if self._pid != os.getpid():
+            # forked process that did not log: the listener thread (and the queued records) are the parent's
+            return
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def restart(self):
+        """Restart with an empty queue and a new listener thread (eg in a forked process)"""
+        self._pid = os.getpid()
+        self.queue = AsyncLogQueue(self.queue.maxsize, self.queue.policy)
+        handlers = self.listener.handlers
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+
+_exception_formatter = logging.Formatter()
+
+# the FancyQueueHandlers of the loggers that log asynchronously
+_queue_handlers = []
+
+
+def enable_async_logging(name=None, queue_size=ASYNC_LOGGING_QUEUE_SIZE, policy=ASYNC_LOGGING_POLICY):
+    """
+    Log asynchronously: the handlers of the logger (eg added by logToScreen or logToFile, also later on)
+    are moved behind a bounded queue, and a listener thread formats the log records and passes them to the handlers.
+
+    The queued log records are handled before the process exits (or when async logging is disabled).
+    In forked processes (eg by daemon.Daemon), a new listener thread is started when the process logs for the
+    first time (so not in eg the child of subprocess.Popen with a preexec_fn), the log records that are still
+    queued at the time of the fork are only handled by the parent.
+
+    returns the FancyQueueHandler, with the counters of dropped log records in its queue (dropped, dropped_levels)
+
+    @param name: name of the logger (default: the root fancylogger)
+    @param queue_size: max number of log records in the queue
+    @param policy: what to do when the queue is full, one of ASYNC_LOGGING_POLICIES
+    """
+    logger = getLogger(name, fname=False, clsname=False)
+    queue_handler = getattr(logger, "logtoqueue", False)
+    if queue_handler:
+        return queue_handler
+
+    handlers = logger.handlers[:]
+    queue_handler = FancyQueueHandler(handlers, queue_size=queue_size, policy=policy)
+    queue_handler.logger = logger
+    for hndlr in handlers:
+        logger.removeHandler(hndlr)
+    logger.addHandler(queue_handler)
+    logger.logtoqueue = queue_handler
+    _queue_handlers.append(queue_handler)
+    return queue_handler
+
+
+def disable_async_logging(name=None):
+    """
+    Stop logging asynchronously (after all queued log records are handled), the handlers are moved back to the logger
+    returns the FancyQueueHandler, or None if the logger did not log asynchronously
+    """
+    logger = getLogger(name, fname=False, clsname=False)
+    queue_handler = getattr(logger, "logtoqueue", False)
+    if not queue_handler:
+        return None
+    _disable_queue_handler(queue_handler)
+    return queue_handler
+
+
+def _disable_queue_handler(queue_handler):
+    """Stop the listener of queue_handler and move its handlers back to the logger"""
+    logger = queue_handler.logger
+    queue_handler.stop()
+    logger.removeHandler(queue_handler)
+    for hndlr in queue_handler.handlers:
+        logger.addHandler(hndlr)
+    logger.logtoqueue = False
+    _queue_handlers.remove(queue_handler)
+
+    if queue_handler.queue.dropped:
+        logger.warning(
+            "Asynchronous logging dropped %s log records (per level: %s)",
+            queue_handler.queue.dropped,
+            queue_handler.queue.dropped_levels,
+        )
+
+
+def logToQueue(enable=True, name=None, queue_size=ASYNC_LOGGING_QUEUE_SIZE, policy=ASYNC_LOGGING_POLICY):
+    """
+    enable (or disable) asynchronous logging via a queue, see enable_async_logging
+    returns the FancyQueueHandler
+    """
+    if enable:
+        return enable_async_logging(name=name, queue_size=queue_size, policy=policy)
+    return disable_async_logging(name=name)
+
+
+def _disable_all_async_logging():
+    """Handle all queued log records before the process exits (and log synchronously from then on)"""
+    for queue_handler in _queue_handlers[:]:
+        _disable_queue_handler(queue_handler)
+
+
+# logging.shutdown (also registered with atexit) runs after this, so the handlers are still open
+atexit.register(_disable_all_async_logging)
+
+
+def _getHandlers(logger):
+    """Return the handlers of the logger (behind its queue, when it logs asynchronously)"""
+    queue_handler = getattr(logger, "logtoqueue", False)
+    if queue_handler:
+        return list(queue_handler.handlers)
+    return logger.handlers
+
+
+def _addHandler(logger, handler):
+    """Add handler to the logger (behind its queue, when it logs asynchronously)"""
+    queue_handler = getattr(logger, "logtoqueue", False)
+    if queue_handler:
+        queue_handler.add_handler(handler)
+    else:
+        logger.addHandler(handler)
+
+
+def _removeHandler(logger, handler):
+    """Remove handler from the logger (or from behind its queue)"""
+    queue_handler = getattr(logger, "logtoqueue", False)
+    if queue_handler:
+        queue_handler.remove_handler(handler)
+    else:
+        logger.removeHandler(handler)
+
+
+# the attributes of all log records, the other attributes are extra fields (see JsonFormatter)
+_LOG_RECORD_ATTRIBUTES = frozenset(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+    "className",
+    "mpirank",
+}
+
+
+def _json_dumps(data):
+    """Serialise data as JSON with the json module"""
+    return json.dumps(data, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+def _orjson_dumps(data):
+    """Serialise data as JSON with orjson"""
+    try:
+        return orjson.dumps(data, default=str).decode("utf8")
+    except TypeError:
+        # eg integers that don't fit in 64 bits
+        return _json_dumps(data)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as JSON objects (one per line), with the fields in JSON_LOGGING_FIELDS:
+    the timestamp (ISO 8601, with milliseconds and the UTC offset), the level name, the logger name, the className
+    and mpirank of fancy log records (null for other log records), the thread name and the message;
+    followed by the exception and stack info (if any) and the extra fields of the log record.
+
+    The fields are determined once, the message is only merged with its arguments when the record is formatted
+    (handlers only do that for records above their level), and the object is serialised with orjson if available.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, fields=JSON_LOGGING_FIELDS, extra=True):
+        """
+        @param fmt: ignored, for compatibility with logging.Formatter
+        @param datefmt: ignored, for compatibility with logging.Formatter
+        @param fields: the fields of the JSON objects (any other field is the attribute of the log record)
+        @param extra: add the attributes of the log record that are not standard (eg passed via extra)
+        """
+        super().__init__()
+        getters = {
+            "timestamp": self._timestamp,
+            "level": lambda record: record.levelname,
+            "name": lambda record: record.name,
+            "className": lambda record: getattr(record, "className", None),
+            "mpirank": lambda record: getattr(record, "mpirank", None),
+            "thread": lambda record: record.threadName,
+            "message": lambda record: record.getMessage(),
+        }
+        self.fields = tuple(fields)
+        self._fields = [
+            (field, getters.get(field, lambda record, field=field: getattr(record, field, None)))
+            for field in self.fields
+        ]
+        self.extra = extra
+        self._dumps = _orjson_dumps if HAVE_ORJSON else _json_dumps
+        # the timestamp up to the seconds, of the last second that was formatted
+        self._timestamp_cache = (None, None, None)
+
+    def _timestamp(self, record):
+        """Return the creation time of the record in ISO 8601 format"""
+        seconds = int(record.created)
+        cached_seconds, prefix, utcoffset = self._timestamp_cache
+        if seconds != cached_seconds:
+            localtime = time.localtime(seconds)
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", localtime)
+            utcoffset = time.strftime("%z", localtime)
+            utcoffset = f"{utcoffset[:3]}:{utcoffset[3:]}"
+            self._timestamp_cache = (seconds, prefix, utcoffset)
+        return f"{prefix}.{int(record.msecs):03d}{utcoffset}"
+
+    def format(self, record):
+        """Return the record as JSON object"""
+        data = {field: getter(record) for field, getter in self._fields}
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+
+        # most records have no extra fields
+        if self.extra and record.__dict__.keys() - _LOG_RECORD_ATTRIBUTES:
+            for key, value in record.__dict__.items():
+                if key not in _LOG_RECORD_ATTRIBUTES and key not in data:
+                    data[key] = value
+
+        return self._dumps(data)
+
+
 def _screenLogFormatterFactory(colorize=None, stream=None):
     """
     Return a log formatter class.
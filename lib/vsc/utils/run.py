@@ -63,16 +63,33 @@ Historical overview of existing equivalent code
 @author: Stijn De Weirdt (Ghent University)
 """
 
+import codecs
+import collections
 import errno
+import fcntl
 import logging
 import os
 import pty
+import queue
 import re
+import selectors
 import shlex
+import shutil
 import signal
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 
+from vsc.utils.affinity import (
+    PRIO_MAX,
+    PRIO_MIN,
+    cpulist_to_cpus,
+    get_allowed_cpus,
+    spread_cpus,
+)
+from vsc.utils.cgroup import Cgroup
 from vsc.utils.fancylogger import getLogger
 from vsc.utils.missing import ensure_ascii_string
 
@@ -86,6 +103,10 @@ RUNRUN_QA_MAX_MISS_EXITCODE = 124
 BASH = "/bin/bash"
 SHELL = BASH
 
+# fcntl commands to get and set the capacity of a pipe (Linux), only in the fcntl module since Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+
 
 class CmdList(list):
     """Wrapper for 'list' type to be used for constructing a list of options & arguments for a command."""
@@ -136,13 +157,357 @@ class DummyFunction:
         return dummy
 
 
+class OutputBuffer:
+    """
+    Output collected in chunks, only joined into a single string when the complete output is asked for.
+    Avoids the quadratic cost of repeatedly concatenating strings for large outputs.
+    The output can be str or bytes (the type of the initial data, str if there is none).
+
+    The size of the kept output can be limited to max_size characters (bytes for bytes output), with policy
+        - head_tail: keep the first half and the last half of max_size, drop the output in between
+        - tail: only keep the last max_size (ring buffer)
+        - spill: only keep the last max_size, and write the older output to a temporary file (spill_file)
+    Positions (as used by since and tail) and the length always count all output, including what was dropped.
+    """
+
+    POLICIES = ("head_tail", "tail", "spill")
+
+    def __init__(self, data=None, max_size=None, policy="head_tail", spill_encoding="utf-8"):
+        """
+        @param data: initial output
+        @param max_size: maximum size of the kept output (None: no limit)
+        @param policy: what to keep when there is more output than max_size (head_tail, tail or spill)
+        @param spill_encoding: encoding of str output in the spill file
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown output policy {policy}, should be one of {', '.join(self.POLICIES)}")
+        self._chunks = collections.deque()
+        self._length = 0  # all output
+        self._tail_length = 0  # output in _chunks
+        self._head = []
+        self._head_room = 0
+        self._max_tail = max_size
+        if max_size is not None and policy == "head_tail":
+            self._head_room = max_size // 2
+            self._max_tail = max_size - self._head_room
+        self._policy = policy
+        self._spill_encoding = spill_encoding
+        self._spill_fh = None
+        self._value = None
+        self.dropped = 0  # output that is dropped (or spilled)
+        self.spill_file = None
+        self._empty = "" if data is None else data[:0]
+        if data:
+            self.append(data)
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return repr(self.getvalue())
+
+    def append(self, data):
+        """Add a chunk of output"""
+        if not data:
+            return
+        self._value = None
+        self._length += len(data)
+        if self._head_room:
+            head = data[: self._head_room]
+            self._head.append(head)
+            self._head_room -= len(head)
+            data = data[len(head) :]
+            if not data:
+                return
+        self._chunks.append(data)
+        self._tail_length += len(data)
+        if self._max_tail is not None and self._tail_length > self._max_tail:
+            self._evict(self._tail_length - self._max_tail)
+
+    def _evict(self, size):
+        """Remove the oldest size characters of the tail, and drop (or spill) them"""
+        evicted = []
+        while size:
+            chunk = self._chunks.popleft()
+            if len(chunk) > size:
+                self._chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            evicted.append(chunk)
+            size -= len(chunk)
+            self._tail_length -= len(chunk)
+            self.dropped += len(chunk)
+
+        if self._policy == "spill":
+            if self._spill_fh is None:
+                self._spill_fh = tempfile.NamedTemporaryFile(prefix="vsc-run-output-", delete=False)
+                self.spill_file = self._spill_fh.name
+            elif self._spill_fh.closed:
+                self._spill_fh = open(self.spill_file, "ab")
+            for chunk in evicted:
+                self._spill_fh.write(chunk if isinstance(chunk, bytes) else chunk.encode(self._spill_encoding))
+
+    def close(self):
+        """Close the spill file (if any), it is reopened when more output is spilled"""
+        if self._spill_fh is not None and not self._spill_fh.closed:
+            self._spill_fh.close()
+
+    def getvalue(self):
+        """Return the complete (kept) output (the joined result is kept, so a second call is cheap)"""
+        if self._value is None:
+            if len(self._head) > 1:
+                self._head = [self._empty.join(self._head)]
+            if len(self._chunks) > 1:
+                self._chunks = collections.deque([self._empty.join(self._chunks)])
+            self._value = self._empty.join(self._head + list(self._chunks))
+        return self._value
+
+    def since(self, position):
+        """
+        Return the output from position onwards, only joining the chunks that are needed
+        (output that was dropped is skipped: once output was dropped, only the kept tail is returned, so the
+        head and the tail are never joined across the dropped output)
+        """
+        if position <= 0 and not self.dropped:
+            return self.getvalue()
+        needed = min(self._length - position, self._tail_length)
+        tail = self._empty
+        if needed > 0:
+            parts = []
+            size = 0
+            for chunk in reversed(self._chunks):
+                parts.append(chunk)
+                size += len(chunk)
+                if size >= needed:
+                    break
+            parts.reverse()
+            tail = self._empty.join(parts)[size - needed :]
+
+        head_length = self._length - self._tail_length - self.dropped
+        if position < head_length and not self.dropped:
+            return self._empty.join(self._head)[max(position, 0) :] + tail
+        return tail
+
+    def tail(self, size):
+        """Return the last size characters of the output"""
+        return self.since(self._length - size)
+
+
+def read_proc_io(pid):
+    """Return the I/O counters (rchar, wchar, read_bytes, write_bytes, ...) of pid from /proc/<pid>/io, or None"""
+    try:
+        with open(f"/proc/{pid}/io", encoding="ascii") as fih:
+            lines = fih.read().splitlines()
+    except OSError:
+        return None
+    counters = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        counters[name] = int(value)
+    return counters
+
+
+class RunResources:
+    """
+    Resources used by a command, None when not known
+        - start, end: timestamps (time.time()) of the start and the end (reaping) of the process
+        - utime, stime: user and system CPU time (seconds) of the process and its (reaped) descendants
+        - maxrss: maximum resident set size (bytes) of the process or its largest (reaped) descendant
+          (this includes the memory of this process that the new process had before it started the command)
+        - io: I/O counters of the process and its (reaped) descendants, as in /proc/<pid>/io
+        - cgroup: memory.peak and cpu.stat of the cgroup of the process (if it was started in one)
+    """
+
+    IO_COUNTERS = ("rchar", "wchar", "read_bytes", "write_bytes")
+
+    def __init__(self):
+        self.start = None
+        self.end = None
+        self.utime = None
+        self.stime = None
+        self.maxrss = None
+        self.io = {}
+        self.cgroup = None
+
+    @property
+    def wall(self):
+        """Elapsed time (seconds)"""
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def cpu(self):
+        """Total CPU time (seconds)"""
+        if self.utime is None or self.stime is None:
+            return None
+        return self.utime + self.stime
+
+    def set_rusage(self, rusage):
+        """Set the resources from the rusage returned by os.wait4"""
+        self.utime = rusage.ru_utime
+        self.stime = rusage.ru_stime
+        # in kilobytes on Linux
+        self.maxrss = rusage.ru_maxrss * 1024
+
+    def as_dict(self):
+        """Return the resources as a dict"""
+        res = {
+            "start": self.start,
+            "end": self.end,
+            "wall": self.wall,
+            "utime": self.utime,
+            "stime": self.stime,
+            "cpu": self.cpu,
+            "maxrss": self.maxrss,
+        }
+        for name in self.IO_COUNTERS:
+            res[name] = self.io.get(name)
+        if self.cgroup is not None:
+            res["cgroup"] = self.cgroup
+        return res
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v}' for k, v in self.as_dict().items())})"
+
+
+class RunResult(tuple):
+    """
+    The result of a command: the tuple (exitcode, output), or (exitcode, output, stderr) if stderr is separated
+    (preceded by the command for run_many), with the attributes
+        - cmd, exitcode, output, stderr (None if it is not separated)
+        - resources: RunResources (with accounting or log_resources, None otherwise)
+        - dropped: number of characters of the output that were dropped or spilled (with max_output, None otherwise)
+    """
+
+    def __new__(cls, exitcode, output, stderr=None, resources=None, dropped=None, cmd=None):
+        res = (exitcode, output) if stderr is None else (exitcode, output, stderr)
+        if cmd is not None:
+            res = (cmd, *res)
+        self = super().__new__(cls, res)
+        self.cmd = cmd
+        self.exitcode = exitcode
+        self.output = output
+        self.stderr = stderr
+        self.resources = resources
+        self.dropped = dropped
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (self.exitcode, self.output, self.stderr, self.resources, self.dropped, self.cmd))
+
+
+class AccountingPopen:
+    """
+    Popen mixin that reaps the process with os.wait4, to have its resource usage in rusage.
+    The I/O counters of the process are read just before it is reaped (in io).
+
+    Only the public poll and wait methods of Popen are replaced: the exit of the process is detected
+    with os.waitid and WNOWAIT (which leaves the process waitable), and the process is reaped with os.wait4.
+    Once the returncode is set, Popen itself (eg when it is garbage collected) does not wait anymore.
+    """
+
+    rusage = None
+    io = None
+    reaped = None  # timestamp of the reaping
+
+    WAIT_DELAY_MAX = 0.05  # maximal seconds between 2 polls in wait with a timeout
+
+    _classes = {}
+
+    @classmethod
+    def subclass(cls, popen):
+        """Return the subclass of Popen class popen with this mixin"""
+        if popen not in cls._classes:
+            cls._classes[popen] = type(f"Accounting{popen.__name__}", (cls, popen), {})
+        return cls._classes[popen]
+
+    def __init__(self, *args, **kwargs):
+        self._wait4_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _wait4(self, block):
+        """
+        Reap the process with os.wait4 once it exited, and set returncode, io, rusage and reaped
+
+        @param block: wait for the process to exit (otherwise, only reap the process if it exited already)
+        """
+        # like Popen.poll, don't wait for the lock when another thread is waiting for the process
+        if not self._wait4_lock.acquire(block):
+            return
+        try:
+            if self.returncode is not None:
+                return
+            try:
+                # wait without reaping first, the I/O counters can't be read once the process is reaped
+                if os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT | (0 if block else os.WNOHANG)) is None:
+                    return
+                self.io = read_proc_io(self.pid)
+                _, status, self.rusage = os.wait4(self.pid, 0)
+            except ChildProcessError:
+                # this happens if SIGCLD is set to be ignored or waiting for child processes has otherwise been
+                # disabled, or if the process was reaped by someone else; Popen reports 0 in that case too
+                self.returncode = 0
+                return
+            self.reaped = time.time()
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            elif os.WIFEXITED(status):
+                self.returncode = os.WEXITSTATUS(status)
+            else:
+                self.returncode = status
+        finally:
+            self._wait4_lock.release()
+
+    def poll(self):
+        """Check if the process has exited, reap it with os.wait4 if so"""
+        # Popen itself never waits for the process: it would reap it without the resource usage
+        self._wait4(False)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit, and reap it with os.wait4"""
+        if timeout is None:
+            self._wait4(True)
+        else:
+            # same as Popen: poll with an increasing delay
+            endtime = time.monotonic() + timeout
+            delay = 0.0005
+            while self.poll() is None:
+                remaining = endtime - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                delay = min(delay * 2, remaining, self.WAIT_DELAY_MAX)
+                time.sleep(delay)
+        return self.returncode
+
+
 class Run:
     """Base class for static run method"""
 
     INIT_INPUT_CLOSE = True
     USE_SHELL = True
+    SEPARATE_STDERR = False
+    STREAM_KEEP_OUTPUT = False
+    POSIX_SPAWN = False
     SHELL = SHELL  # set the shell via the module constant
     KILL_PGID = False
+    KILL_TREE = False
+    KILL_TREE_GRACE = 5  # seconds between SIGTERM and SIGKILL when killing a process tree
+    KILL_TREE_POLL = 0.1  # seconds between checks of killed processes without pidfd
+    STOP_TASKS_WAIT = 5  # seconds to wait (in the background) for a killed process to be reaped, see run_many
+    ACCOUNTING = False
+    LOG_RESOURCES = False
+    ACCOUNTING_IO_INTERVAL = 1  # minimal seconds between 2 reads of the I/O counters while the process runs
+    CGROUP_PARENT = None  # parent of the cgroups for processes with limits (None: the cgroup of this process)
+    CGROUP_CPU_PERIOD = 100000  # period (in microseconds) of cpu.max
+    CGROUP_REMOVE_WAIT = 1  # seconds to wait for the processes of a cgroup to exit before removing it
+    READSIZE = 1024  # number of bytes to read at once
+    ADAPTIVE_READSIZE = False
+    READSIZE_MIN = 1024  # the adaptive readsize is kept between READSIZE_MIN
+    READSIZE_MAX = 1024 * 1024  # and READSIZE_MAX (or the capacity of the output pipe, if that is known)
+    PIPE_SIZE = None  # capacity (bytes) of the output pipes, None: system default (usually 64kB)
+    MAX_OUTPUT = None  # maximum size of the kept output (and stderr), None: no limit
+    MAX_OUTPUT_POLICY = "head_tail"
 
     @classmethod
     def run(cls, cmd, **kwargs):
@@ -152,6 +517,29 @@ class Run:
         r = cls(cmd, **kwargs)
         return r._run()
 
+    @classmethod
+    def stream(cls, cmd, lines=True, keep_output=None, **kwargs):
+        """static method
+        return instance that yields the output as it becomes available when iterated over
+            @param lines: yield complete lines (with newline), otherwise chunks of at most readsize characters
+                (a line that is longer than max_output, or than READSIZE_MAX without max_output, is yielded in parts)
+            @param keep_output: also collect the complete output (default STREAM_KEEP_OUTPUT)
+
+        The exitcode is available via the exitcode attribute once the iteration is finished.
+        The output is only read when the consumer asks for it (so a slow consumer also slows down the command);
+        when the consumer stops early, the command is killed.
+
+        >>> r = RunNoShell.stream(["find", "/"])
+        >>> for line in r:
+        ...     handle(line)
+        >>> r.exitcode
+        """
+        r = cls(cmd, **kwargs)
+        r._stream_lines = lines
+        if keep_output is not None:
+            r._stream_keep_output = keep_output
+        return r
+
     def __init__(self, cmd=None, **kwargs):
         """
         Handle initiliastion
@@ -163,6 +551,34 @@ class Run:
             @param shell: change the shell
             @param env: environment settings to pass on
             @param post_exitcode: log errors on non zero exitcode (debug otherwise)
+            @param separate_stderr: do not merge stderr in the output, return (exitcode, output, stderr) instead
+                (see RunResult, for the results of all options)
+            @param binary: return the output as bytes
+            @param encoding: decode the output with this encoding
+                (default: ASCII, with backslash escapes for all other characters)
+            @param posix_spawn: start the process with posix_spawn instead of fork/exec, if possible
+            @param kill_tree: when the process is stopped (eg on timeout), also kill all its descendants
+            @param accounting: measure the resources used by the process, as RunResources in the resources attribute
+                (of the instance and of the returned RunResult)
+            @param log_resources: measure the resources used by the process, and log them (with the resources
+                as dict in the resources attribute of the log record)
+            @param cpu_max: start the process in a cgroup (v2) with this maximum number of cpus
+                (or the value for cpu.max, eg "50000 100000")
+            @param memory_max: start the process in a cgroup with this maximum memory (bytes, or eg "1G")
+            @param io_weight: start the process in a cgroup with this io weight (1-10000, default 100)
+            @param pids_max: start the process in a cgroup with this maximum number of processes
+            @param cgroup_parent: create the cgroup under this cgroup (path, default CGROUP_PARENT)
+            @param cpus: pin the process to these cpus (list of cpu indices or cpulist like "0-15,32")
+            @param nice: run the process with this nice value (priority)
+            @param readsize: number of bytes to read from the output at once (default READSIZE)
+            @param adaptive_readsize: double the readsize when a read returns readsize bytes, halve it when
+                reads return less than a quarter of it (sparse output)
+            @param pipe_size: set the capacity of the output pipes to this number of bytes (F_SETPIPE_SZ)
+            @param max_output: keep at most this many characters (bytes in binary mode) of the output (and of stderr,
+                if it is separated), the number of characters that were dropped (or spilled) is the dropped attribute
+                of the returned RunResult (and the output_dropped attribute of the instance)
+            @param max_output_policy: what to keep of larger output (see OutputBuffer): head_tail (default), tail,
+                or spill (the older output is written to a temporary file, see the output_spill_file attribute)
         """
         self.input = kwargs.pop("input", None)
         self.startpath = kwargs.pop("startpath", None)
@@ -170,6 +586,22 @@ class Run:
         self.shell = kwargs.pop("shell", self.SHELL)
         self.env = kwargs.pop("env", None)
         self.post_exitcode = kwargs.pop("post_exitcode", True)
+        self.separate_stderr = kwargs.pop("separate_stderr", self.SEPARATE_STDERR)
+        self.binary = kwargs.pop("binary", False)
+        self.encoding = kwargs.pop("encoding", None)
+        self.posix_spawn = kwargs.pop("posix_spawn", self.POSIX_SPAWN)
+        self.kill_tree = kwargs.pop("kill_tree", self.KILL_TREE)
+        self.accounting = kwargs.pop("accounting", self.ACCOUNTING)
+        self.log_resources = kwargs.pop("log_resources", self.LOG_RESOURCES)
+        self.cgroup_parent = kwargs.pop("cgroup_parent", self.CGROUP_PARENT)
+        self.cpus = kwargs.pop("cpus", None)
+        self.nice = kwargs.pop("nice", None)
+        self.readsize = kwargs.pop("readsize", self.READSIZE)  # number of bytes to read at once
+        self.adaptive_readsize = kwargs.pop("adaptive_readsize", self.ADAPTIVE_READSIZE)
+        self.pipe_size = kwargs.pop("pipe_size", self.PIPE_SIZE)
+        self.max_output = kwargs.pop("max_output", self.MAX_OUTPUT)
+        self.max_output_policy = kwargs.pop("max_output_policy", self.MAX_OUTPUT_POLICY)
+        cgroup_limits = {name: kwargs.pop(name, None) for name in ("cpu_max", "memory_max", "io_weight", "pids_max")}
 
         if kwargs.pop("disable_log", None):
             self.log = DummyFunction()  # No logging
@@ -178,23 +610,132 @@ class Run:
 
         self.cmd = cmd  # actual command
 
+        if self.binary and self.encoding is not None:
+            msg = f"Output can not be binary and decoded with encoding {self.encoding}"
+            self.log.error(msg)
+            raise ValueError(msg)
+
+        # the output is decoded incrementally, so characters split over multiple reads are decoded correctly
+        self._decoder = None
+        self._stderr_decoder = None
+        if self.encoding is not None:
+            self._decoder = codecs.getincrementaldecoder(self.encoding)(errors="backslashreplace")
+            self._stderr_decoder = codecs.getincrementaldecoder(self.encoding)(errors="backslashreplace")
+        self._empty_output = b"" if self.binary else ""
+
         self._cwd_before_startpath = None
 
         self._process_module = None
         self._process = None
+        self._cgroup = None  # Cgroup (v2) that contains only the process and its descendants
+        self._cgroup_limits = self._make_cgroup_limits(**cgroup_limits)
+        self.cgroup_stats = None
+        self._killtree_thread = None
+        # stop_tasks reaps (only) the killed process in a background thread (used by run_many)
+        self._stop_tasks_background = False
+        self._reap_thread = None
+        self._cpuset = None if self.cpus is None else self._make_cpuset()
+        if self.nice is not None and not (isinstance(self.nice, int) and PRIO_MIN <= self.nice <= PRIO_MAX):
+            msg = f"nice {self.nice} should be an integer between {PRIO_MIN} and {PRIO_MAX}"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if self.max_output_policy not in OutputBuffer.POLICIES:
+            msg = f"max_output_policy {self.max_output_policy} should be one of {', '.join(OutputBuffer.POLICIES)}"
+            self.log.error(msg)
+            raise ValueError(msg)
+        for name in ("readsize", "pipe_size", "max_output"):
+            value = getattr(self, name)
+            if value is not None and not (isinstance(value, int) and value > 0):
+                msg = f"{name} {value} should be a positive integer"
+                self.log.error(msg)
+                raise ValueError(msg)
+        self._readsize_max = max(self.READSIZE_MAX, self.readsize)
 
-        self.readsize = 1024  # number of bytes to read blocking
+        self.resources = RunResources() if self.accounting or self.log_resources else None
+        self._resources_io_sampled = None
 
         self._shellcmd = None
         self._popen_named_args = None
 
         self._process_exitcode = None
-        self._process_output = None
+        self._process_output_buffer = None
+        self._process_stderr_buffer = self._make_output_buffer(self._empty_output) if self.separate_stderr else None
 
         self._post_exitcode_log_failure = self.log.error
 
+        self._stream_lines = True
+        self._stream_keep_output = self.STREAM_KEEP_OUTPUT
+
         super().__init__(**kwargs)
 
+    def __iter__(self):
+        """Start the command and iterate over its output (see stream)"""
+        return self._stream()
+
+    @property
+    def exitcode(self):
+        """The exitcode of the command (None if it has not finished yet)"""
+        return self._process_exitcode
+
+    @property
+    def _process_output(self):
+        """The complete output, joined on demand from the output buffer"""
+        if self._process_output_buffer is None:
+            return None
+        return self._process_output_buffer.getvalue()
+
+    @_process_output.setter
+    def _process_output(self, value):
+        if value is None:
+            self._process_output_buffer = None
+        else:
+            self._process_output_buffer = self._make_output_buffer(value)
+
+    def _make_output_buffer(self, data):
+        """Return a new OutputBuffer for the output (or stderr), with the max_output limit"""
+        return OutputBuffer(
+            data, max_size=self.max_output, policy=self.max_output_policy, spill_encoding=self.encoding or "utf-8"
+        )
+
+    @property
+    def output_dropped(self):
+        """The number of characters of the output and stderr that were dropped (or spilled) because of max_output"""
+        return sum(buf.dropped for buf in (self._process_output_buffer, self._process_stderr_buffer) if buf is not None)
+
+    @property
+    def output_spill_file(self):
+        """The file with the output that was spilled (max_output_policy spill), None if nothing was spilled"""
+        if self._process_output_buffer is None:
+            return None
+        return self._process_output_buffer.spill_file
+
+    @property
+    def stderr_spill_file(self):
+        """The file with the stderr output that was spilled, None if nothing was spilled"""
+        if self._process_stderr_buffer is None:
+            return None
+        return self._process_stderr_buffer.spill_file
+
+    def _decode(self, out, stderr=False, final=False):
+        """
+        Convert the bytes read from the process to output: as is in binary mode, otherwise decoded
+            @param stderr: out was read from stderr
+            @param final: no more output will follow (so incomplete characters can't be completed anymore)
+        """
+        if self.binary:
+            return out
+        decoder = self._stderr_decoder if stderr else self._decoder
+        if decoder is None:
+            return ensure_ascii_string(out)
+        return decoder.decode(out, final)
+
+    @property
+    def _process_stderr(self):
+        """The complete stderr output (only when it is separated from the output)"""
+        if self._process_stderr_buffer is None:
+            return None
+        return self._process_stderr_buffer.getvalue()
+
     def _get_log_name(self):
         """Set the log name"""
         return self.__class__.__name__
@@ -230,7 +771,7 @@ class Run:
          - main
             - should capture exitcode and output
             - features
-                - separate stdout and stderr ?
+                - separate stdout and stderr - DONE
                 - simple single run
                     - no timeout/waiting - DONE
                 - flush to
@@ -273,11 +814,17 @@ class Run:
         if self._shellcmd is None:
             self._make_shell_command()
 
+        if self._cgroup_limits and self._cgroup is None:
+            self._make_cgroup()
+
         if self._popen_named_args is None:
             self._make_popen_named_args()
 
         self._init_process()
 
+        if self.pipe_size is not None or self.adaptive_readsize:
+            self._init_pipes()
+
         self._init_input()
 
     def _run_post(self):
@@ -285,9 +832,15 @@ class Run:
 
         self._post_exitcode()
 
+        if self._cgroup is not None:
+            self._post_cgroup()
+
+        if self.resources is not None:
+            self._post_resources()
+
         self._post_output()
 
-        if self.startpath is not None:
+        if self.startpath is not None and self._cwd_before_startpath is not None:
             self._return_to_previous_start_in_path()
 
         return self._run_return()
@@ -298,19 +851,21 @@ class Run:
             self.log.debug("_start_in_path: no startpath set")
             return
 
+        self._check_startpath()
+        try:
+            self._cwd_before_startpath = os.getcwd()  # store it some one can return to it
+            os.chdir(self.startpath)
+        except OSError as exc:
+            msg = (
+                f"_start_in_path: failed to change path from {self._cwd_before_startpath} to startpath {self.startpath}"
+            )
+            self.log.exception(msg)
+            raise OSError(msg) from exc
+
+    def _check_startpath(self):
+        """Verify that the startpath is an existing directory"""
         if os.path.exists(self.startpath):
-            if os.path.isdir(self.startpath):
-                try:
-                    self._cwd_before_startpath = os.getcwd()  # store it some one can return to it
-                    os.chdir(self.startpath)
-                except OSError as exc:
-                    msg = (
-                        f"_start_in_path: failed to change path from {self._cwd_before_startpath} "
-                        f"to startpath {self.startpath}"
-                    )
-                    self.log.exception(msg)
-                    raise OSError(msg) from exc
-            else:
+            if not os.path.isdir(self.startpath):
                 msg = f"_start_in_path: provided startpath {self.startpath} exists but is no directory"
                 self.log.error(msg)
                 raise ValueError(msg)
@@ -359,7 +914,7 @@ class Run:
         """Create the named args for Popen"""
         self._popen_named_args = {
             "stdout": self._process_module.PIPE,
-            "stderr": self._process_module.STDOUT,
+            "stderr": self._process_module.PIPE if self.separate_stderr else self._process_module.STDOUT,
             "stdin": self._process_module.PIPE,
             "close_fds": True,
             "shell": self.use_shell,
@@ -367,11 +922,75 @@ class Run:
             "env": self.env,
         }
 
+        if self._needs_preexec():
+            self._popen_named_args["preexec_fn"] = self._preexec
+
+        if self.posix_spawn:
+            # Popen uses posix_spawn (so this process is not forked) when there are no fds to close
+            # and the executable has a path. Closing fds is not needed: they are not inherited (PEP 446).
+            self._popen_named_args["close_fds"] = False
+            if self._popen_named_args["executable"] is None and not self.use_shell and self._shellcmd:
+                self._popen_named_args["executable"] = self._find_executable(self._shellcmd[0])
+
         if others is not None:
             self._popen_named_args.update(others)
 
         self.log.debug("_popen_named_args %s", self._popen_named_args)
 
+    def _make_cgroup_limits(self, cpu_max=None, memory_max=None, io_weight=None, pids_max=None):
+        """Return the cgroup interface files and values for the limits"""
+        limits = {}
+        if cpu_max is not None:
+            if isinstance(cpu_max, (int, float)):
+                cpu_max = f"{int(cpu_max * self.CGROUP_CPU_PERIOD)} {self.CGROUP_CPU_PERIOD}"
+            limits["cpu.max"] = cpu_max
+        if memory_max is not None:
+            limits["memory.max"] = memory_max
+        if io_weight is not None:
+            limits["io.weight"] = f"default {io_weight}"
+        if pids_max is not None:
+            limits["pids.max"] = pids_max
+        return limits
+
+    def _make_cgroup(self):
+        """Create the cgroup for the process, with the limits"""
+        self._cgroup = Cgroup.create(parent=self.cgroup_parent, limits=self._cgroup_limits)
+        self.log.debug("_make_cgroup: created cgroup %s with limits %s", self._cgroup.path, self._cgroup_limits)
+
+    def _make_cpuset(self):
+        """Return the set of cpus to pin the process to"""
+        cpus = cpulist_to_cpus(self.cpus) if isinstance(self.cpus, str) else list(self.cpus)
+        invalid = sorted(set(cpus) - set(get_allowed_cpus()))
+        if not cpus or invalid:
+            msg = f"Can't pin process to cpus {self.cpus}: no cpus or not allowed cpus {invalid}"
+            self.log.error(msg)
+            raise ValueError(msg)
+        return set(cpus)
+
+    def _needs_preexec(self):
+        """Does the process need to be set up before the command starts"""
+        return self._cgroup is not None or self._cpuset is not None or self.nice is not None
+
+    def _preexec(self):
+        """
+        Set up the new process before the command starts (as preexec_fn of Popen),
+        so the command never runs outside its cgroup, on other cpus or with another priority.
+        This runs in the forked child: only os functions are used (no logging, the locks of the logging
+        can be held by other threads), and any failure raises a SubprocessError in the parent.
+        """
+        if self._cgroup is not None:
+            self._cgroup.attach()
+        if self._cpuset is not None:
+            os.sched_setaffinity(0, self._cpuset)
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+
+    def _find_executable(self, name):
+        """Return the path of executable name, as found in the PATH of the environment of the process (or None)"""
+        if os.path.dirname(name):
+            return name
+        return shutil.which(name, path=os.pathsep.join(os.get_exec_path(self.env)))
+
     def _make_shell_command(self):
         """Convert cmd into shell command"""
         self.log.warning(
@@ -396,12 +1015,50 @@ class Run:
 
     def _init_process(self):
         """Initialise the self._process"""
+        popen = self._process_module.Popen
+        if self.resources is not None:
+            popen = AccountingPopen.subclass(popen)
+            self.resources.start = time.time()
         try:
-            self._process = self._process_module.Popen(self._shellcmd, **self._popen_named_args)
-        except OSError as err:
+            self._process = popen(self._shellcmd, **self._popen_named_args)
+        except (OSError, subprocess.SubprocessError) as err:
             self.log.exception("_init_process: init Popen shellcmd %s failed: %s", self._shellcmd, err)
             raise
 
+    def _output_pipes(self):
+        """Return the file objects of the output pipes of the process (stdout first)"""
+        return [fileobj for fileobj in (self._process.stdout, self._process.stderr) if fileobj is not None]
+
+    def _init_pipes(self):
+        """Set the capacity of the output pipes (pipe_size), and the maximum of the adaptive readsize"""
+        pipes = self._output_pipes()
+        if self.pipe_size is not None:
+            for fileobj in pipes:
+                try:
+                    fcntl.fcntl(fileobj, F_SETPIPE_SZ, self.pipe_size)
+                except OSError as err:
+                    # eg not a pipe, or more than /proc/sys/fs/pipe-max-size as unprivileged user
+                    self.log.warning("_init_pipes: failed to set pipe size to %s: %s", self.pipe_size, err)
+
+        if self.adaptive_readsize and pipes:
+            try:
+                capacity = fcntl.fcntl(pipes[0], F_GETPIPE_SZ)
+            except OSError as err:
+                self.log.debug("_init_pipes: no pipe size for the output: %s", err)
+            else:
+                # a single read never returns more than the pipe can hold
+                self._readsize_max = max(capacity, self.readsize)
+                self.log.debug("_init_pipes: output pipe size %s, max readsize %s", capacity, self._readsize_max)
+
+    def _adapt_readsize(self, nread):
+        """Adapt the readsize to the number of bytes nread that the last read (with the readsize) returned"""
+        if not self.adaptive_readsize:
+            return
+        if nread >= self.readsize:
+            self.readsize = min(self.readsize * 2, self._readsize_max)
+        elif nread < self.readsize // 4 and self.readsize > self.READSIZE_MIN:
+            self.readsize = max(self.readsize // 2, self.READSIZE_MIN)
+
     def _init_input(self):
         """Handle input, if any in a simple way"""
         if self.input is not None:  # allow empty string (whatever it may mean)
@@ -426,8 +1083,13 @@ class Run:
         This one has most simple loop
         """
         try:
-            self._process_exitcode = self._process.wait()
-            self._process_output = self._read_process(-1)  # -1 is read all
+            if self.separate_stderr or self.max_output is not None:
+                # read the output in chunks, so no more than max_output is kept
+                self._read_process_stdout_stderr()
+                self._process_exitcode = self._process.wait()
+            else:
+                self._process_exitcode = self._process.wait()
+                self._process_output = self._read_process(-1)  # -1 is read all
         except Exception as exc:
             msg = (
                 f"_wait_for_process: problem during wait exitcode {self._process_exitcode} "
@@ -436,26 +1098,107 @@ class Run:
             self.log.exception(msg)
             raise OSError(msg) from exc
 
+    def _read_process_stdout_stderr(self):
+        """
+        Read the output and stderr until both are closed.
+        Both are read together, so the process can not block on a full stderr pipe while the output is read
+        (or vice versa).
+        """
+        self._process_output = self._empty_output
+        self._read_process_stdout_stderr_remaining()
+
+    def _read_process_stdout_stderr_remaining(self):
+        """
+        Read the remaining output and stderr together until both are closed (see _read_process_stdout_stderr),
+        and add them to the output and stderr buffers. Returns the output that was read.
+        """
+        outputs = []
+        with selectors.DefaultSelector() as selector:
+            for fileobj in (self._process.stdout, self._process.stderr):
+                if fileobj is not None and not fileobj.closed:
+                    selector.register(fileobj, selectors.EVENT_READ, fileobj is self._process.stderr)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    out = self._read_process_nowait(stderr=key.data)
+                    if out is None:
+                        selector.unregister(key.fileobj)
+                    elif key.data:
+                        self._process_stderr_buffer.append(out)
+                    else:
+                        self._process_output_buffer.append(out)
+                        outputs.append(out)
+        return self._empty_output.join(outputs)
+
+    def _read_process_stderr_remaining(self):
+        """Read the remaining stderr output, until it is closed"""
+        if self._process.stderr is None:
+            return
+        while True:
+            out = self._read_process_nowait(stderr=True)
+            if out is None:
+                break
+            self._process_stderr_buffer.append(out)
+
     def _cleanup_process(self):
         """Cleanup any leftovers from the process"""
-        if self._process.stdout is not None and not self._process.stdout.closed:
-            try:
-                self._process.stdout.close()
-            except OSError as err:
-                self.log.raiseException(f"_cleanup_process: failed to close stdout of the process: {err}")
+        for buf in (self._process_output_buffer, self._process_stderr_buffer):
+            if buf is not None:
+                buf.close()
+        for name in ("stdout", "stderr"):
+            fileobj = getattr(self._process, name, None)
+            if fileobj is not None and not fileobj.closed:
+                try:
+                    fileobj.close()
+                except OSError as err:
+                    self.log.raiseException(f"_cleanup_process: failed to close {name} of the process: {err}")
 
     def _read_process(self, readsize=None):
         """Read from process, return out"""
+        adapt = readsize is None
         if readsize is None:
             readsize = self.readsize
         if readsize is None:
             readsize = -1  # read all
         self.log.debug("_read_process: going to read with readsize %s", readsize)
         out = self._process.stdout.read(readsize)
-        return ensure_ascii_string(out)
+        if adapt:
+            self._adapt_readsize(len(out))
+        return self._decode(out, final=readsize < 0)
+
+    def _read_process_nowait(self, readsize=None, stderr=False):
+        """
+        Read whatever is available from the process output (or stderr), return out
+        Only to be used when the output is known to be readable (eg reported by a selector),
+        returns None when the end of the output is reached.
+        """
+        adapt = not stderr and (readsize is None or readsize < 0)
+        if readsize is None or readsize < 0:
+            readsize = self.readsize
+        if readsize is None or readsize < 0:
+            readsize = self.READSIZE  # can't read all without blocking
+        fileobj = self._process.stderr if stderr else self._process.stdout
+        try:
+            out = os.read(fileobj.fileno(), readsize)
+        except BlockingIOError:
+            # non-blocking pipe (eg of asyncprocess.Popen) that is not readable yet
+            with selectors.DefaultSelector() as selector:
+                selector.register(fileobj, selectors.EVENT_READ)
+                selector.select()
+            out = os.read(fileobj.fileno(), readsize)
+        if adapt:
+            self._adapt_readsize(len(out))
+        if not out:
+            # end of output, but the decoder may still hold an incomplete character
+            return self._decode(out, stderr=stderr, final=True) or None
+        return self._decode(out, stderr=stderr)
 
     def _post_exitcode(self):
         """Postprocess the exitcode in self._process_exitcode"""
+        log_failure = self._post_exitcode_log_failure if self.post_exitcode else self.log.debug
+        if (self._process_exitcode == 0 or log_failure == self.log.debug) and not self.log.isEnabledFor(logging.DEBUG):
+            # nothing to log, don't convert the command and join the output for nothing
+            return
+
         cmd_ascii = ensure_ascii_string(self.cmd)
         if not self._process_exitcode == 0:
             shell_cmd_ascii = ensure_ascii_string(self._shellcmd)
@@ -463,19 +1206,154 @@ class Run:
                 f"_post_exitcode: problem occured with cmd {cmd_ascii}:"
                 f"(shellcmd {shell_cmd_ascii}) output {self._process_output}"
             )
-            if self.post_exitcode:
-                self._post_exitcode_log_failure(message)
-            else:
-                self.log.debug(message)
+            if self.separate_stderr:
+                message += f" stderr {self._process_stderr}"
+            log_failure(message)
         else:
             self.log.debug("_post_exitcode: success cmd %s: output %s", cmd_ascii, self._process_output)
 
     def _post_output(self):
         """Postprocess the output in self._process_output"""
 
+    def _post_cgroup(self):
+        """Collect the statistics of the cgroup of the process, and remove it"""
+        self.cgroup_stats = self._cgroup.stats()
+        self.log.debug("_post_cgroup: cgroup %s stats %s", self._cgroup.path, self.cgroup_stats)
+        if self.resources is not None:
+            self.resources.cgroup = self.cgroup_stats
+
+        if self._killtree_thread is not None and self._killtree_thread.is_alive():
+            self.log.debug("_post_cgroup: cgroup %s is removed once all processes are killed", self._cgroup.path)
+        else:
+            self._cgroup.remove(timeout=self.CGROUP_REMOVE_WAIT)
+
+    def _sample_resources(self):
+        """Read the I/O counters of the running process (at most every ACCOUNTING_IO_INTERVAL seconds)"""
+        now = time.time()
+        if self._resources_io_sampled is None or now - self._resources_io_sampled >= self.ACCOUNTING_IO_INTERVAL:
+            self._resources_io_sampled = now
+            counters = read_proc_io(self._process.pid)
+            if counters:
+                self.resources.io = counters
+
+    def _post_resources(self):
+        """Collect the resources used by the process in self.resources"""
+        resources = self.resources
+        rusage = getattr(self._process, "rusage", None)
+        if rusage is None:
+            # process is not reaped (yet), eg it was killed, or not started by AccountingPopen
+            resources.end = time.time()
+        else:
+            resources.set_rusage(rusage)
+            resources.end = self._process.reaped
+            if self._process.io:
+                resources.io = self._process.io
+
+        if self.log_resources:
+            self.log.info(
+                "_post_resources: cmd %s used %s",
+                ensure_ascii_string(self.cmd),
+                resources,
+                extra={"resources": resources.as_dict()},
+            )
+
     def _run_return(self):
-        """What to return"""
-        return self._process_exitcode, self._process_output
+        """What to return: a RunResult"""
+        stderr = None
+        if self.separate_stderr:
+            stderr = self._process_stderr
+            if stderr is None:
+                stderr = self._empty_output
+        return RunResult(
+            self._process_exitcode,
+            self._process_output,
+            stderr=stderr,
+            resources=self.resources,
+            dropped=self.output_dropped if self.max_output is not None else None,
+        )
+
+    def _stream(self):
+        """Generator that starts the command and yields its output (lines or chunks) as it becomes available"""
+        self._run_pre()
+        # the consumer runs in between the reads, so do not stay in the startpath
+        if self.startpath is not None and self._cwd_before_startpath is not None:
+            self._return_to_previous_start_in_path()
+            self._cwd_before_startpath = None
+
+        try:
+            if self._process.stdout is None:
+                msg = f"_stream: output of cmd {self.cmd} can not be streamed (it is not a pipe)"
+                self.log.error(msg)
+                raise ValueError(msg)
+
+            self._stream_start()
+            newline = b"\n" if self.binary else "\n"
+            pending = []  # incomplete last line
+            pending_size = 0
+            # a line without newline is not kept in memory forever, it is yielded in parts of at least this size
+            max_line = self.max_output if self.max_output is not None else self._readsize_max
+            while True:
+                output = self._stream_read()
+                if output is None:
+                    break
+                if self._stream_keep_output:
+                    self._process_output_buffer.append(output)
+                self._stream_process(output)
+
+                if not output:
+                    continue
+                if not self._stream_lines:
+                    yield output
+                elif newline not in output:
+                    pending.append(output)
+                    pending_size += len(output)
+                    if pending_size >= max_line:
+                        yield self._empty_output.join(pending)
+                        pending = []
+                        pending_size = 0
+                else:
+                    lines = output.split(newline)
+                    pending.append(lines[0])
+                    lines[0] = self._empty_output.join(pending)
+                    pending = [lines.pop()]
+                    pending_size = len(pending[0])
+                    for line in lines:
+                        yield line + newline
+
+            last = self._empty_output.join(pending)
+            if last:
+                yield last
+
+            if self._process_exitcode is None:
+                self._process_exitcode = self._process.wait()
+            self._run_post()
+        finally:
+            self._stream_stop()
+
+    def _stream_start(self):
+        """Prepare reading the output"""
+        if self.separate_stderr:
+            msg = "_stream: stderr can only be read separately while streaming by RunLoop classes"
+            self.log.error(msg)
+            raise ValueError(msg)
+        self._process_output = self._empty_output
+
+    def _stream_read(self):
+        """Return the next output (blocks until there is some), None when all output is read"""
+        return self._read_process_nowait()
+
+    def _stream_process(self, output):
+        """Process the output that is read in blocks while streaming"""
+
+    def _stream_stop(self):
+        """Cleanup after streaming, kill the process when the consumer stopped before the end of the output"""
+        if self._process_exitcode is None:
+            self.log.debug("_stream_stop: output not completely read, stopping cmd %s", self.cmd)
+            self.stop_tasks()
+            # the exitcode of the killed process is reported
+            self._reap_process(self._process)
+            self._process_exitcode = self._process.poll()
+            self._cleanup_process()
 
     def _killtasks(self, tasks=None, sig=signal.SIGKILL, kill_pgid=None):
         """
@@ -535,14 +1413,225 @@ class Run:
             if kill_pgid:
                 if pgid is None:
                     self.log.error("Can't kill pgid for pid %s, None found", pid)
+                elif pgid == os.getpgrp():
+                    self.log.error("Not killing pgid %s of pid %s, it is the process group of this process", pgid, pid)
+                else:
+                    do_something_with_pid(os.killpg, [pgid, sig], "kill pgid")
+
+    def _process_children(self, pid, children_map=None):
+        """
+        Return the pids of the children of pid, from /proc/<pid>/task/*/children
+        or from the children_map (as returned by _process_children_map) if that is passed
+        """
+        if children_map is not None:
+            return children_map.get(pid, [])
+
+        children = []
+        try:
+            tids = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            return children
+        for tid in tids:
+            try:
+                with open(f"/proc/{pid}/task/{tid}/children", encoding="ascii") as fih:
+                    children.extend(int(child) for child in fih.read().split())
+            except OSError:
+                pass
+        return children
+
+    def _process_children_map(self):
+        """
+        Return a dict with the pids of the children of all processes, or None if /proc/<pid>/task/*/children
+        is available (it requires CONFIG_PROC_CHILDREN, otherwise all /proc/<pid>/stat have to be read)
+        """
+        # the main thread has the pid as thread id
+        if os.path.exists(f"/proc/self/task/{os.getpid()}/children"):
+            return None
+
+        children_map = {}
+        for pid in os.listdir("/proc"):
+            if pid.isdigit():
+                ppid = self._process_ppid(pid)
+                if ppid is not None:
+                    children_map.setdefault(ppid, []).append(int(pid))
+        return children_map
+
+    def _process_stat(self, pid):
+        """Return the fields of /proc/<pid>/stat after the command (state, ppid, ...), None if pid doesn't exist"""
+        try:
+            with open(f"/proc/{pid}/stat", encoding="ascii", errors="replace") as fih:
+                # the command (between parentheses) can contain anything
+                return fih.read().rpartition(")")[2].split()
+        except OSError:
+            return None
+
+    def _process_ppid(self, pid):
+        """Return the parent pid of pid (None if it doesn't exist anymore)"""
+        fields = self._process_stat(pid)
+        return None if fields is None else int(fields[1])
+
+    def _pidfd_open(self, pid):
+        """Return a pidfd for pid, None if pidfds are not supported, False if pid does not exist"""
+        if not hasattr(os, "pidfd_open"):
+            return None
+        try:
+            return os.pidfd_open(pid)
+        except ProcessLookupError:
+            return False
+        except OSError as err:
+            self.log.debug("_pidfd_open: no pidfd for pid %s: %s", pid, err)
+            return None
+
+    def _pidfd_send_signal(self, pid, pidfd, sig):
+        """Send signal sig to pid, via its pidfd (if not None). Returns False if the process does not exist."""
+        try:
+            if pidfd is None:
+                os.kill(pid, sig)
+            else:
+                signal.pidfd_send_signal(pidfd, sig)
+        except ProcessLookupError:
+            return False
+        except OSError as err:
+            self.log.error("Failed to send signal %s to pid %s: %s", sig, pid, err)
+        return True
+
+    def _killtree(self, pid, grace=None, process=None):
+        """
+        Kill process pid and all its descendants: with SIGTERM, and with SIGKILL when they are still running
+        after grace seconds (default KILL_TREE_GRACE). Does not block: the SIGKILL is sent by a background thread.
+            @param pid: pid of the root of the tree
+            @param grace: seconds between SIGTERM and SIGKILL (SIGKILL immediately if 0)
+            @param process: Popen instance of pid, is reaped once it is killed
+
+        All processes are stopped (SIGSTOP) while the tree is collected, so they can't start new processes
+        (or exit, which makes their children orphans) in the mean time.
+        The signals are sent via pidfds (if supported), so they can't reach another process that reused a pid.
+        If the process was started in a cgroup of its own (self._cgroup), all processes in the cgroup are killed
+        via cgroup.kill after the grace period (including orphans that are no longer part of the tree).
+
+        Returns the background thread.
+        """
+        if grace is None:
+            grace = self.KILL_TREE_GRACE
+
+        pidfds = {}  # pid -> pidfd (None if not supported)
+        todo = [(pid, None)]
+        while todo:
+            # (pid, parent): the parent is used to verify that the pid was not reused
+            new = []
+            for tpid, parent in todo:
+                if tpid in pidfds:
+                    continue
+                pidfd = self._pidfd_open(tpid)
+                if pidfd is False:
+                    continue
+                if parent is not None and self._process_ppid(tpid) != parent:
+                    self.log.debug("_killtree: pid %s is no longer a child of %s", tpid, parent)
+                    if pidfd is not None:
+                        os.close(pidfd)
+                    continue
+                if self._pidfd_send_signal(tpid, pidfd, signal.SIGSTOP):
+                    pidfds[tpid] = pidfd
+                    new.append(tpid)
+                elif pidfd is not None:
+                    os.close(pidfd)
+
+            # once stopped, the processes can't fork anymore; collect the children until there are no new ones
+            children_map = self._process_children_map()
+            todo = [(child, ppid) for ppid in pidfds for child in self._process_children(ppid, children_map)]
+            todo = [(child, ppid) for child, ppid in todo if child not in pidfds]
+
+        self.log.debug("_killtree: killing tree of pid %s: %s", pid, sorted(pidfds))
+        first = signal.SIGTERM if grace > 0 else signal.SIGKILL
+        for tpid, pidfd in pidfds.items():
+            self._pidfd_send_signal(tpid, pidfd, first)
+            # stopped processes only handle the SIGTERM once they are continued
+            self._pidfd_send_signal(tpid, pidfd, signal.SIGCONT)
+
+        thread = threading.Thread(
+            target=self._killtree_finish, args=(pid, pidfds, grace, process), name=f"killtree-{pid}", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _killtree_finish(self, pid, pidfds, grace, process):
+        """Wait at most grace seconds for the processes to exit, then kill the remaining ones and reap process"""
+        deadline = time.time() + grace
+        running = dict(pidfds)
+        with selectors.DefaultSelector() as selector:
+            for tpid, pidfd in running.items():
+                if pidfd is not None:
+                    # a pidfd becomes readable when the process exits
+                    selector.register(pidfd, selectors.EVENT_READ, tpid)
+            while running and time.time() < deadline:
+                timeout = deadline - time.time()
+                polled = [tpid for tpid, pidfd in running.items() if pidfd is None]
+                if polled:
+                    timeout = min(timeout, self.KILL_TREE_POLL)
+                if selector.get_map():
+                    for key, _ in selector.select(max(timeout, 0)):
+                        selector.unregister(key.fileobj)
+                        running.pop(key.data)
                 else:
-                    do_something_with_pid(os.kill, [pgid, sig], "kill pgid")
+                    time.sleep(max(timeout, 0))
+                # without pidfd, exited processes are zombies (or gone)
+                for tpid in polled:
+                    fields = self._process_stat(tpid)
+                    if fields is None or fields[0] == "Z":
+                        running.pop(tpid)
+
+        if self._cgroup is not None:
+            self.log.debug("_killtree: killing all processes in cgroup %s", self._cgroup.path)
+            try:
+                self._cgroup.kill()
+            except OSError:
+                pass
+        if running:
+            self.log.debug("_killtree: pids %s still running after %ss, sending SIGKILL", sorted(running), grace)
+            for tpid, pidfd in running.items():
+                self._pidfd_send_signal(tpid, pidfd, signal.SIGKILL)
+
+        for pidfd in pidfds.values():
+            if pidfd is not None:
+                os.close(pidfd)
+
+        if process is not None:
+            self._reap_process(process)
+
+        if self._cgroup is not None and process is self._process:
+            self._cgroup.remove(timeout=self.CGROUP_REMOVE_WAIT)
 
     def stop_tasks(self):
         """Cleanup current run"""
+        if self.kill_tree:
+            # the process is reaped by the thread that kills the tree, this does not wait for it
+            self._killtree_thread = self._killtree(self._process.pid, process=self._process)
+            return
+
         self._killtasks(tasks=[self._process.pid])
+        if self._cgroup is not None:
+            # also kill all other processes in the cgroup
+            try:
+                self._cgroup.kill()
+            except OSError:
+                pass
+
+        if self._stop_tasks_background:
+            # only reap the killed process (not another child), without blocking the caller
+            self._reap_thread = threading.Thread(
+                target=self._reap_process, args=(self._process,), name=f"reap-{self._process.pid}", daemon=True
+            )
+            self._reap_thread.start()
+        else:
+            # reap the killed process if it exited already (not any other child, Popen would lose its exitcode)
+            self._process.poll()
+
+    def _reap_process(self, process):
+        """Wait at most STOP_TASKS_WAIT seconds for the killed process to exit, and reap it"""
         try:
-            os.waitpid(-1, os.WNOHANG)
+            process.wait(timeout=self.STOP_TASKS_WAIT)
+        except subprocess.TimeoutExpired:
+            self.log.warning("_reap_process: process %s did not stop after %ss", process.pid, self.STOP_TASKS_WAIT)
         except OSError:
             pass
 
@@ -595,62 +1684,238 @@ class RunLoop(Run):
     """Main process is a while loop which reads the output in blocks
     need to read from time to time.
     otherwise the stdout/stderr buffer gets filled and it all stops working
+
+    In event driven mode, the loop does not sleep, but blocks on the process output and the process exit
+    (via a pidfd, if supported), so it wakes up as soon as there is new output or the process has stopped.
     """
 
     LOOP_TIMEOUT_INIT = 0.1
     LOOP_TIMEOUT_MAIN = 1
+    LOOP_EVENT_DRIVEN = False
 
     def __init__(self, cmd, **kwargs):
+        """
+        Handle initialisation
+            @param event_driven: wait for output/exit of the process instead of sleeping (default LOOP_EVENT_DRIVEN)
+        """
+        self.event_driven = kwargs.pop("event_driven", self.LOOP_EVENT_DRIVEN)
         super().__init__(cmd, **kwargs)
+        if self.separate_stderr:
+            # output and stderr are read together via the selector
+            self.event_driven = True
         self._loop_count = None
         self._loop_continue = None  # intial state, change this to break out the loop
+        self._loop_selector = None
+        self._loop_selector_owned = False
+        self._loop_poll_fileobjs = set()
+        self._loop_pidfd = None
 
     def _wait_for_process(self):
         """Loop through the process in timesteps
         collected output is run through _loop_process_output
         """
-        # these are initialised outside the function (cannot be forgotten, but can be overwritten)
-        self._loop_count = 0  # internal counter
-        self._loop_continue = True
-        self._process_output = ""
-
-        # further initialisation
-        self._loop_initialise()
+        self._loop_start()
 
-        time.sleep(self.LOOP_TIMEOUT_INIT)
+        if self.event_driven:
+            self._loop_poll_register()
+        else:
+            time.sleep(self.LOOP_TIMEOUT_INIT)
         ec = self._process.poll()
         try:
             while self._loop_continue and (ec is None or ec < 0):
-                output = self._read_process()
-                self._process_output += output
-                # process after updating the self._process_ vars
-                self._loop_process_output(output)
+                if self.event_driven:
+                    output = self._loop_poll_read(self._loop_poll_timeout())
+                else:
+                    output = self._read_process()
+                self._loop_step(output)
 
-                if len(output) == 0:
+                if not self.event_driven and len(output) == 0:
                     time.sleep(self.LOOP_TIMEOUT_MAIN)
                 ec = self._process.poll()
 
-                self._loop_count += 1
+            self._loop_finish(ec)
+        except RunLoopException as err:
+            self._loop_exception(err)
+        finally:
+            self._loop_poll_unregister()
 
-            self.log.debug(
-                "_wait_for_process: loop stopped after %s iterations (ec %s loop_continue %s)",
-                self._loop_count,
-                ec,
-                self._loop_continue,
-            )
+    def _loop_start(self):
+        """Prepare the loop"""
+        # these are initialised outside the function (cannot be forgotten, but can be overwritten)
+        self._loop_count = 0  # internal counter
+        self._loop_continue = True
+        self._process_output = self._empty_output
 
-            # read remaining data (all of it)
+        # further initialisation
+        self._loop_initialise()
+
+    def _loop_step(self, output):
+        """Single iteration of the loop, with the output read in this iteration"""
+        if self.resources is not None:
+            self._sample_resources()
+        self._process_output_buffer.append(output)
+        # process after updating the self._process_ vars
+        self._loop_process_output(output)
+
+        self._loop_count += 1
+
+    def _loop_finish(self, ec):
+        """The loop stopped: read the remaining output and set the exitcode"""
+        self.log.debug(
+            "_wait_for_process: loop stopped after %s iterations (ec %s loop_continue %s)",
+            self._loop_count,
+            ec,
+            self._loop_continue,
+        )
+
+        # read remaining data (all of it)
+        if self._process.stderr is not None:
+            # output and stderr together: (a child of) the process can block on either pipe
+            output = self._read_process_stdout_stderr_remaining()
+        else:
             output = self._read_process(-1)
+            self._process_output_buffer.append(output)
+        self._process_exitcode = ec
+
+        # process after updating the self._process_ vars
+        self._loop_process_output_final(output)
+
+    def _loop_exception(self, err):
+        """The loop was stopped with a RunLoopException"""
+        self.log.debug("RunLoopException %s", err)
+        output = err.output
+        if self._process_output_buffer is not None and output is self._process_output_buffer.getvalue():
+            # the output collected so far (keep the buffer, with the dropped output count)
+            self._process_exitcode = err.code
+            return
+        if self.binary:
+            if isinstance(output, str):
+                output = output.encode("utf-8")
+        elif self._decoder is None:
+            output = ensure_ascii_string(output)
+        self._process_output = output
+        self._process_exitcode = err.code
+
+    def _loop_poll_register(self, selector=None):
+        """
+        Register the process output and the process exit with a selector
+        (a new one, unless a selector that is shared with other processes is passed)
+        Events are registered with (self, "stdout"), (self, "stderr") or (self, "exit") as data.
+        """
+        self._loop_selector_owned = selector is None
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self._loop_selector = selector
+
+        if self._process.stdout is not None:
+            self._loop_selector.register(self._process.stdout, selectors.EVENT_READ, (self, "stdout"))
+            self._loop_poll_fileobjs.add(self._process.stdout)
+
+        if self._process.stderr is not None:
+            self._loop_selector.register(self._process.stderr, selectors.EVENT_READ, (self, "stderr"))
+            self._loop_poll_fileobjs.add(self._process.stderr)
+
+        # a pidfd becomes readable when the process exits (Linux >= 5.3, Python >= 3.9)
+        if hasattr(os, "pidfd_open"):
+            try:
+                self._loop_pidfd = os.pidfd_open(self._process.pid)
+                self._loop_selector.register(self._loop_pidfd, selectors.EVENT_READ, (self, "exit"))
+                self._loop_poll_fileobjs.add(self._loop_pidfd)
+            except OSError as err:
+                self.log.debug("_loop_poll_register: no pidfd for pid %s: %s", self._process.pid, err)
+                self._loop_pidfd = None
+
+    def _loop_poll_unregister(self):
+        """Unregister from the selector (close it if we own it) and close the pidfd (if any)"""
+        if self._loop_selector is not None:
+            if self._loop_selector_owned:
+                self._loop_selector.close()
+            else:
+                for fileobj in self._loop_poll_fileobjs:
+                    self._loop_selector.unregister(fileobj)
+            self._loop_selector = None
+        self._loop_poll_fileobjs.clear()
+        if self._loop_pidfd is not None:
+            os.close(self._loop_pidfd)
+            self._loop_pidfd = None
+
+    def _loop_poll_timeout(self):
+        """Maximum time to wait for an event in the event driven loop"""
+        return self.LOOP_TIMEOUT_MAIN
+
+    def _loop_poll_read(self, timeout):
+        """
+        Wait at most timeout seconds for new output or process exit, return the output read
+        (stderr is collected while waiting, but does not end the wait)
+        """
+        end = time.time() + timeout
+        while True:
+            if not self._loop_poll_fileobjs:
+                # output is closed and there's no pidfd, so only the process exit is left to wait for
+                try:
+                    self._process.wait(timeout=max(end - time.time(), 0))
+                except subprocess.TimeoutExpired:
+                    pass
+                return self._empty_output
+
+            events = [key.data[1] for key, _ in self._loop_selector.select(max(end - time.time(), 0))]
+            output = self._loop_poll_events(events)
+            if events != ["stderr"] or time.time() >= end:
+                return output
+
+    def _loop_poll_events(self, events):
+        """Handle the events reported by the selector, return the output read"""
+        output = self._empty_output
+        if "stdout" in events:
+            res = self._read_process_nowait()
+            if res is None:
+                # end of output reached, only wait for the process exit from now on
+                self._loop_selector.unregister(self._process.stdout)
+                self._loop_poll_fileobjs.discard(self._process.stdout)
+            else:
+                output = res
+        if "stderr" in events:
+            res = self._read_process_nowait(stderr=True)
+            if res is None:
+                self._loop_selector.unregister(self._process.stderr)
+                self._loop_poll_fileobjs.discard(self._process.stderr)
+            else:
+                self._process_stderr_buffer.append(res)
+        return output
 
-            self._process_output += output
-            self._process_exitcode = ec
+    def _stream_start(self):
+        """Prepare the loop, wait for the output with a selector"""
+        self._loop_start()
+        self._loop_poll_register()
 
-            # process after updating the self._process_ vars
-            self._loop_process_output_final(output)
+    def _stream_read(self):
+        """
+        Wait for new output, at most _loop_poll_timeout() seconds, so _loop_process_output keeps being called.
+        Returns an empty string when there was no new output, None when all output is read.
+        """
+        if self._process_exitcode is not None:
+            # stopped by a RunLoopException
+            return None
+        if self._loop_continue and self._process.poll() is None:
+            return self._loop_poll_read(self._loop_poll_timeout())
+        # the process has stopped: read the remaining output
+        output = super()._stream_read()
+        if output is None:
+            self._read_process_stderr_remaining()
+        return output
+
+    def _stream_process(self, output):
+        """Pass the output to _loop_process_output"""
+        try:
+            self._loop_process_output(output)
         except RunLoopException as err:
-            self.log.debug("RunLoopException %s", err)
-            self._process_output = ensure_ascii_string(err.output)
-            self._process_exitcode = err.code
+            self._loop_exception(err)
+        self._loop_count += 1
+
+    def _stream_stop(self):
+        """Stop the process if needed and unregister from the selector"""
+        super()._stream_stop()
+        self._loop_poll_unregister()
 
     def _loop_initialise(self):
         """Initialisation before the loop starts"""
@@ -676,19 +1941,36 @@ class RunNoShellLoop(RunNoShell, RunLoop):
 
 class RunLoopLog(RunLoop):
     LOOP_LOG_LEVEL = logging.INFO
+    LOOP_LOG_BUFFERED = False
 
-    def _wait_for_process(self):
+    def __init__(self, cmd, **kwargs):
+        """
+        Handle initialisation
+            @param log_buffered: buffer the output in the logger (see FancyLogger.streamLog),
+                                 instead of writing and flushing each block of output (default LOOP_LOG_BUFFERED)
+        """
+        self.log_buffered = kwargs.pop("log_buffered", self.LOOP_LOG_BUFFERED)
+        super().__init__(cmd, **kwargs)
+
+    def _loop_start(self):
         # initialise the info logger
         self.log.info("Going to run cmd %s", self._shellcmd)
-        super()._wait_for_process()
+        super()._loop_start()
 
     def _loop_process_output(self, output):
         """Process the output that is read in blocks
         send it to the logger. The logger need to be stream-like
         """
-        self.log.streamLog(self.LOOP_LOG_LEVEL, output)
+        output_str = ensure_ascii_string(output) if self.binary else output
+        self.log.streamLog(self.LOOP_LOG_LEVEL, output_str, buffered=self.log_buffered)
         super()._loop_process_output(output)
 
+    def _cleanup_process(self):
+        """Write the output that is still buffered in the logger"""
+        if self.log_buffered:
+            self.log.streamFlush()
+        super()._cleanup_process()
+
 
 class RunNoShellLoopLog(RunNoShell, RunLoopLog):
     pass
@@ -699,8 +1981,13 @@ class RunLoopStdout(RunLoop):
         """Process the output that is read in blocks
         send it to the stdout
         """
-        sys.stdout.write(output)
-        sys.stdout.flush()
+        if isinstance(output, bytes):
+            sys.stdout.flush()
+            sys.stdout.buffer.write(output)
+            sys.stdout.buffer.flush()
+        else:
+            sys.stdout.write(output)
+            sys.stdout.flush()
         super()._loop_process_output(output)
 
 
@@ -721,25 +2008,28 @@ class RunAsync(Run):
 
     def _read_process(self, readsize=None):
         """Read from async process, return out"""
+        adapt = readsize is None
         if readsize is None:
             readsize = self.readsize
 
         if self._process.stdout is None:
             # Nothing yet/anymore
-            return ""
+            return self._empty_output
 
         try:
             if readsize is not None and readsize < 0:
                 # read all blocking (it's not why we should use async
-                out = self._process.stdout.read()
+                return self._decode(self._process.recv_all(), final=True)
             else:
                 # non-blocking read (readsize is a maximum to return !
                 out = self._process_module.recv_some(self._process, maxread=readsize)
-            return ensure_ascii_string(out)
+            if adapt:
+                self._adapt_readsize(len(out))
+            return self._decode(out)
         except (OSError, Exception):
             # recv_some may throw Exception
             self.log.exception("_read_process: read failed")
-            return ""
+            return self._empty_output
 
 
 class RunNoShellAsync(RunNoShell, RunAsync):
@@ -747,10 +2037,25 @@ class RunNoShellAsync(RunNoShell, RunAsync):
 
 
 class RunFile(Run):
-    """Popen to filehandle"""
+    """Popen to filehandle
+
+    In tee mode, the output is passed via a pipe, and moved to the file without decoding it
+    (with os.splice, if supported). Only the last TEE_TAIL_SIZE bytes are kept, and returned as output.
+    """
+
+    TEE = False
+    TEE_CHUNK_SIZE = 1024 * 1024
+    TEE_TAIL_SIZE = 64 * 1024
+    TEE_SPLICE = hasattr(os, "splice")  # Linux, Python >= 3.10
 
     def __init__(self, cmd, **kwargs):
+        """
+        Handle initialisation
+            @param filename: file to write the output to
+            @param tee: also return the end of the output (default TEE)
+        """
         self.filename = kwargs.pop("filename", None)
+        self.tee = kwargs.pop("tee", self.TEE)
         self.filehandle = None
         super().__init__(cmd, **kwargs)
 
@@ -784,18 +2089,87 @@ class RunFile(Run):
                         raise OSError(msg) from OSError
 
             try:
-                self.filehandle = open(self.filename, "w", encoding="utf8")  # pylint: disable=consider-using-with
+                if self.tee:
+                    # only raw bytes are written (and the end is read back)
+                    self.filehandle = open(self.filename, "w+b", buffering=0)  # pylint: disable=consider-using-with
+                else:
+                    self.filehandle = open(self.filename, "w", encoding="utf8")  # pylint: disable=consider-using-with
             except OSError:
                 self.log.raiseException(f"_make_popen_named_args: failed to open filehandle for file {self.filename}")
 
-            others = {
-                "stdout": self.filehandle,
-            }
+            if self.tee:
+                others = {}  # output via a pipe
+            else:
+                others = {
+                    "stdout": self.filehandle,
+                }
 
         super()._make_popen_named_args(others=others)
 
+    def _wait_for_process(self):
+        """In tee mode, move the output to the file until the process closes it"""
+        if not self.tee:
+            super()._wait_for_process()
+            return
+
+        try:
+            self._tee_process_output()
+            self._process_exitcode = self._process.wait()
+            self._process_output = self._tee_tail()
+        except Exception as exc:
+            msg = f"_wait_for_process: problem during tee to file {self.filename} exitcode {self._process_exitcode}"
+            self.log.exception(msg)
+            raise OSError(msg) from exc
+
+    def _tee_process_output(self):
+        """
+        Move the output from the pipe to the file, in chunks of TEE_CHUNK_SIZE bytes
+        (stderr, if separate, is read meanwhile)
+        """
+        src = self._process.stdout.fileno()
+        dst = self.filehandle.fileno()
+        use_splice = self.TEE_SPLICE
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._process.stdout, selectors.EVENT_READ, False)
+            if self._process.stderr is not None:
+                selector.register(self._process.stderr, selectors.EVENT_READ, True)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    if key.data:
+                        out = self._read_process_nowait(stderr=True)
+                        if out is None:
+                            selector.unregister(key.fileobj)
+                        else:
+                            self._process_stderr_buffer.append(out)
+                        continue
+
+                    size = None
+                    if use_splice:
+                        try:
+                            size = os.splice(src, dst, self.TEE_CHUNK_SIZE)
+                        except OSError as err:
+                            if err.errno not in (errno.EINVAL, errno.ENOSYS):
+                                raise
+                            self.log.debug("_tee_process_output: splice to %s not supported: %s", self.filename, err)
+                            use_splice = False
+                    if size is None:
+                        data = os.read(src, self.TEE_CHUNK_SIZE)
+                        size = len(data)
+                        view = memoryview(data)
+                        while view:
+                            view = view[os.write(dst, view) :]
+                    if size == 0:
+                        selector.unregister(key.fileobj)
+
+    def _tee_tail(self):
+        """Return the last TEE_TAIL_SIZE bytes written to the file"""
+        fd = self.filehandle.fileno()
+        end = os.lseek(fd, 0, os.SEEK_CUR)
+        return self._decode(os.pread(fd, min(end, self.TEE_TAIL_SIZE), max(end - self.TEE_TAIL_SIZE, 0)), final=True)
+
     def _cleanup_process(self):
         """Close the filehandle"""
+        super()._cleanup_process()
         try:
             self.filehandle.close()
         except OSError:
@@ -803,7 +2177,7 @@ class RunFile(Run):
 
     def _read_process(self, readsize=None):
         """Meaningless for filehandle"""
-        return ""
+        return self._empty_output
 
 
 class RunNoShellFile(RunNoShell, RunFile):
@@ -815,7 +2189,7 @@ class RunPty(Run):
 
     def _read_process(self, readsize=None):
         """This does not work for pty"""
-        return ""
+        return self._empty_output
 
     def _make_popen_named_args(self, others=None):
         if others is None:
@@ -836,6 +2210,11 @@ class RunTimeout(RunLoop, RunAsync):
         self.start = time.time()
         super().__init__(cmd, **kwargs)
 
+    def _loop_poll_timeout(self):
+        """Do not wait longer than the time left"""
+        time_left = self.timeout - (time.time() - self.start)
+        return max(min(time_left, super()._loop_poll_timeout()), 0)
+
     def _loop_process_output(self, output):
         """"""
         time_passed = time.time() - self.start
@@ -853,11 +2232,17 @@ class RunNoShellTimeout(RunNoShell, RunTimeout):
 
 
 class RunQA(RunLoop, RunAsync):
-    """Question/Answer processing"""
+    """Question/Answer processing
+
+    All questions (and no_qa patterns) are anchored at the end of the output,
+    so they are only matched against the last QA_MATCH_WINDOW characters of the output.
+    """
 
     LOOP_MAX_MISS_COUNT = 20
     INIT_INPUT_CLOSE = False
     CYCLE_ANSWERS = True
+    QA_MATCH_WINDOW = 8192
+    STREAM_KEEP_OUTPUT = True  # the questions are matched against the collected output
 
     def __init__(self, cmd, **kwargs):
         """
@@ -875,10 +2260,19 @@ class RunQA(RunLoop, RunAsync):
         self._loop_miss_count = None  # maximum number of misses
         self._loop_previous_ouput_length = None  # track length of output through loop
         self.hit_position = 0
+        self._qa_all = None  # ordered list of (question, answers) tuples
+        self._qa_any = None  # combined regex that matches if any question matches
+        self._no_qa_any = None  # combined regex that matches if any no_qa matches
 
         super().__init__(cmd, **kwargs)
 
+        if self.binary:
+            msg = "Questions can not be matched against binary output, use encoding instead"
+            self.log.error(msg)
+            raise ValueError(msg)
+
         self.qa, self.qa_reg, self.no_qa = self._parse_qa(qa, qa_reg, no_qa)
+        self._make_qa_matcher()
 
     def _parse_qa(self, qa, qa_reg, no_qa):
         """
@@ -948,6 +2342,44 @@ class RunQA(RunLoop, RunAsync):
 
         return new_qa, new_qa_reg, new_no_qa
 
+    def _make_qa_matcher(self):
+        """
+        Prepare the question matching, once per run
+            - qa first and then qa_reg, each sorted on the pattern for consistency
+            - combine all questions (and all no_qa patterns) in a single regex,
+              so a chunk of output without a question is checked with a single search
+        """
+
+        def pattern_key(item):
+            return item[0].pattern
+
+        self._qa_all = sorted(self.qa.items(), key=pattern_key) + sorted(self.qa_reg.items(), key=pattern_key)
+        self._qa_any = self._combine_regexes([question for question, _ in self._qa_all])
+        self._no_qa_any = self._combine_regexes(self.no_qa)
+
+    def _combine_regexes(self, regexes):
+        """
+        Return single regex that matches if any of the regexes matches, or None if they can't be combined
+        (eg because of conflicting named groups or backreferences, which are renumbered by combining)
+        """
+        if len(regexes) < 2:
+            return None
+
+        patterns = [regex.pattern for regex in regexes]
+        if any(re.search(r"\\[1-9]|\(\?P=", pattern) for pattern in patterns):
+            self.log.debug("_combine_regexes: backreferences found, not combining %s", patterns)
+            return None
+
+        try:
+            return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+        except re.error as err:
+            self.log.debug("_combine_regexes: failed to combine %s: %s", patterns, err)
+            return None
+
+    def _qa_window(self, position):
+        """Return the output from position, limited to the last QA_MATCH_WINDOW characters"""
+        return self._process_output_buffer.since(max(position, len(self._process_output_buffer) - self.QA_MATCH_WINDOW))
+
     def _loop_initialise(self):
         """Initialisation before the loop starts"""
         self._loop_miss_count = 0
@@ -958,25 +2390,29 @@ class RunQA(RunLoop, RunAsync):
         check the output passed to questions available
         """
         hit = False
+        since_latest_match = self._qa_window(self.hit_position)
 
         # use a dict so the formatting shows all characters explicitly (and quoted)
         self.log.debug(
             "output %s",
             {
                 "latest": output,
-                "all": self._process_output,
-                "since_latest_match": self._process_output[self.hit_position :],
+                "all": self._process_output_buffer,  # only joined when the message is formatted
+                "since_latest_match": since_latest_match,
             },
         )
 
-        # qa first and then qa_reg
+        # a question can only be answered if there is new output;
+        # a single search with the combined regex tells if there is any question to look for
+        if output and (self._qa_any is None or self._qa_any.search(since_latest_match)):
+            candidates = self._qa_all
+        else:
+            candidates = []
+
         nr_qa = len(self.qa)
-        # ensure consistency by sorting, and concatenate
-        # (which can't be done directly since .items() returns a generator in Python 3)
-        all_qa = sorted(self.qa.items()) + sorted(self.qa_reg.items())
-        for idx, (question, answers) in enumerate(all_qa):
-            res = question.search(self._process_output[self.hit_position :])
-            if output and res:
+        for idx, (question, answers) in enumerate(candidates):
+            res = question.search(since_latest_match)
+            if res:
                 answer = answers[0] % res.groupdict()
                 if len(answers) > 1:
                     prev_answer = answers.pop(0)
@@ -989,27 +2425,29 @@ class RunQA(RunLoop, RunAsync):
                     question.pattern,
                     idx >= nr_qa,
                     output,
-                    self._process_output[-50:],
+                    self._process_output_buffer.tail(50),
                 )
                 written = self._process_module.send_all(self._process, answer)
                 if written != len(answer):
                     self.log.warning("answer '%s' not fully written: %s out of %s bytes", answer, written, len(answer))
                 hit = True
-                self.hit_position = len(self._process_output)  # position of next possible match
+                self.hit_position = len(self._process_output_buffer)  # position of next possible match
                 break
 
         if not hit:
-            curoutlen = len(self._process_output)
+            curoutlen = len(self._process_output_buffer)
             if curoutlen > self._loop_previous_ouput_length:
                 # still progress in output, just continue (but don't reset miss counter either)
                 self._loop_previous_ouput_length = curoutlen
             else:
-                noqa = False
-                for r in self.no_qa:
-                    if r.search(self._process_output):
-                        self.log.debug("_loop_process_output: no_qa found for out %s", self._process_output[-50:])
-                        noqa = True
-                if not noqa:
+                window = self._qa_window(0)
+                if self._no_qa_any is None:
+                    noqa = any(r.search(window) for r in self.no_qa)
+                else:
+                    noqa = bool(self._no_qa_any.search(window))
+                if noqa:
+                    self.log.debug("_loop_process_output: no_qa found for out %s", self._process_output_buffer.tail(50))
+                else:
                     self._loop_miss_count += 1
         else:
             self._loop_miss_count = 0  # reset miss counter on hit
@@ -1018,7 +2456,7 @@ class RunQA(RunLoop, RunAsync):
             self.log.debug(
                 "loop_process_output: max misses LOOP_MAX_MISS_COUNT %s reached. End of output: %s",
                 self.LOOP_MAX_MISS_COUNT,
-                self._process_output[-500:],
+                self._process_output_buffer.tail(500),
             )
             self.stop_tasks()
 
@@ -1071,6 +2509,434 @@ class RunNoShellAsyncLoopStdout(RunNoShellLoopStdout, RunNoShellAsync):
     """Async read, flush to stdout"""
 
 
+def run_many(cmds, max_workers=None, cls=None, spread=None, **kwargs):
+    """
+    Run commands concurrently, with at most max_workers processes running at the same time.
+    The output of all processes is handled in a single selector loop.
+
+    Generator that yields (cmd, exitcode, output) for each command, in the order they finish:
+    a RunResult with the command, so also (cmd, exitcode, output, stderr) with separate_stderr.
+
+        @param cmds: iterable of commands
+        @param max_workers: maximum number of processes running at the same time (default: number of cores)
+        @param cls: RunLoop (sub)class used to run each command (default RunNoShellAsyncLoop),
+                    eg RunNoShellTimeout to stop each command after a timeout or RunNoShellQA to answer questions
+        @param spread: pin the processes to cpus: "cores" divides the cpus in max_workers groups of neighbouring
+                       cpus, "numa" uses the cpus of a NUMA node; each process gets the group with the least processes
+        @param kwargs: named arguments passed to cls for each command (eg timeout, qa, startpath, ...)
+
+    Commands that are still running when the generator is closed are killed.
+    """
+    if cls is None:
+        cls = RunNoShellAsyncLoop
+    if not issubclass(cls, RunLoop):
+        raise ValueError(f"run_many: class {cls.__name__} is not a RunLoop subclass")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers < 1:
+        raise ValueError(f"run_many: max_workers should be at least 1, got {max_workers}")
+    if spread not in (None, "cores", "numa"):
+        raise ValueError(f"run_many: spread should be cores or numa, got {spread}")
+
+    # cpu groups and the runners that use them
+    groups = [] if spread is None else spread_cpus(max_workers, numa=spread == "numa")
+    group_runners = [set() for _ in groups]
+
+    cmds = iter(cmds)
+    selector = selectors.DefaultSelector()
+    active = {}  # runner -> (cmd, deadline of next loop iteration without output)
+
+    def start(cmd):
+        if groups:
+            idx = min(range(len(groups)), key=lambda idx: len(group_runners[idx]))
+            runner = cls(cmd, cpus=groups[idx], **kwargs)
+            group_runners[idx].add(runner)
+        else:
+            runner = cls(cmd, **kwargs)
+        # a killed process that does not exit (eg in D state) should not block the other processes
+        runner._stop_tasks_background = True
+        runner._run_pre()
+        if runner.startpath is not None:
+            # the process is started, so go back immediately: there is only one cwd for all processes
+            runner._return_to_previous_start_in_path()
+            runner._cwd_before_startpath = None
+        runner._loop_start()
+        runner._loop_poll_register(selector)
+        active[runner] = (cmd, time.time() + runner._loop_poll_timeout())
+
+    def finish(runner, ec=None, err=None):
+        try:
+            if err is None:
+                runner._loop_finish(ec)
+            else:
+                runner._loop_exception(err)
+        except RunLoopException as exc:
+            runner._loop_exception(exc)
+        runner._loop_poll_unregister()
+        cmd, _ = active.pop(runner)
+        for runners in group_runners:
+            runners.discard(runner)
+        result = runner._run_post()
+        return RunResult(
+            result.exitcode, result.output, result.stderr, resources=result.resources, dropped=result.dropped, cmd=cmd
+        )
+
+    try:
+        while True:
+            while len(active) < max_workers:
+                try:
+                    start(next(cmds))
+                except StopIteration:
+                    break
+            if not active:
+                break
+
+            # processes without output and pidfd (if any) are polled for their exit
+            now = time.time()
+            timeout = min(deadline for _, deadline in active.values()) - now
+            if any(not runner._loop_poll_fileobjs for runner in active):
+                timeout = min(timeout, RunLoop.LOOP_TIMEOUT_INIT)
+
+            ready = {}
+            for key, _ in selector.select(max(timeout, 0)):
+                runner, event = key.data
+                ready.setdefault(runner, []).append(event)
+
+            now = time.time()
+            for runner, (cmd, deadline) in list(active.items()):
+                due = runner in ready or now >= deadline
+                if not due and runner._loop_poll_fileobjs:
+                    continue
+
+                try:
+                    if due:
+                        events = ready.get(runner, [])
+                        output = runner._loop_poll_events(events)
+                        if events == ["stderr"] and now < deadline:
+                            # only stderr was read, keep waiting for output or exit
+                            continue
+                        runner._loop_step(output)
+                        active[runner] = (cmd, time.time() + runner._loop_poll_timeout())
+                    ec = runner._process.poll()
+                    if runner._loop_continue and (ec is None or ec < 0):
+                        continue
+                    result = finish(runner, ec=ec)
+                except RunLoopException as err:
+                    result = finish(runner, err=err)
+                yield result
+    finally:
+        # generator closed (or failed) before all commands finished
+        for runner in list(active):
+            runner.stop_tasks()
+            runner._loop_poll_unregister()
+            runner._cleanup_process()
+        selector.close()
+
+
+class ShellWorker:
+    """
+    Long-lived shell that runs commands one after the other (see RunPool)
+
+    Each command is sent as a single line to the shell, the output of the command is followed by a sentinel
+    that is only known to this worker and the exitcode of the command: everything before the sentinel is the output.
+    The command is evaluated in a subshell with stdin from /dev/null, so it can't change the state of the worker
+    (current directory, environment, ...) or read the commands that follow, and a syntax error in the command is
+    an error of the command.
+    """
+
+    SENTINEL_PREFIX = "__VSC_RUN_SHELL_WORKER_"
+    # function that runs the command in $1, the sentinel and exitcode follow the output
+    FUNCTION = "__vsc_run"
+    FUNCTION_TEMPLATE = """{name}() {{ ( eval "$1" ) </dev/null; printf '{sentinel}%d\\n' "$?"; }}\n"""
+
+    def __init__(self, shell=BASH, env=None, log=None):
+        """
+        Start the shell
+            @param shell: the shell to start (should be bash, the commands use bash features)
+            @param env: environment of the shell (and the default environment of the commands)
+            @param log: logger to use
+        """
+        self.log = log if log is not None else getLogger(self.__class__.__name__)
+        self.commands = 0  # number of commands that were run
+        self.sentinel = f"{self.SENTINEL_PREFIX}{os.urandom(16).hex()}_"
+        self._sentinel = self.sentinel.encode()
+
+        # new session, so the shell and all its commands can be killed at once
+        self.process = subprocess.Popen(
+            [shell, "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            start_new_session=True,
+        )
+        self.log.debug("ShellWorker: started shell %s with pid %s", shell, self.process.pid)
+
+        # the shell reads its input one byte at a time, so keep the lines with the commands short
+        function = self.FUNCTION_TEMPLATE.format(name=self.FUNCTION, sentinel=self.sentinel)
+        self.process.stdin.write(function.encode())
+
+    @property
+    def pid(self):
+        """The pid of the shell"""
+        return self.process.pid
+
+    def alive(self):
+        """Is the shell still running"""
+        return self.process.poll() is None
+
+    def make_script(self, cmd, startpath=None, env=None):
+        """
+        Return the line that runs cmd (and prints the sentinel and exitcode)
+            @param cmd: the command, a string is passed to the shell as is, a list is quoted
+            @param startpath: directory to run the command in
+            @param env: environment of the command (replaces the environment of the shell)
+        """
+        if isinstance(cmd, (list, tuple)):
+            cmd = " ".join(shlex.quote(str(arg)) for arg in cmd)
+
+        parts = []
+        if startpath is not None:
+            parts.append(f"cd -- {shlex.quote(startpath)} || exit")
+        if env is not None:
+            # readonly variables can't be unset, but those are not in the environment of a fresh shell
+            parts.append("unset $(compgen -e) 2>/dev/null")
+            parts.extend(f"export {name}={shlex.quote(str(value))}" for name, value in env.items())
+            parts.append("hash -r")
+        parts.append(cmd)
+
+        return f"{self.FUNCTION} {shlex.quote('; '.join(parts))}\n"
+
+    def run(self, cmd, startpath=None, env=None, timeout=None, readsize=65536):
+        """
+        Run cmd, return (exitcode, output) with the output as bytes.
+        When the command did not finish after timeout seconds, the exitcode is None and the shell is killed.
+        When the shell died, the exitcode is the exitcode of the shell.
+        """
+        self.commands += 1
+        try:
+            self.process.stdin.write(self.make_script(cmd, startpath=startpath, env=env).encode())
+            self.process.stdin.flush()
+        except OSError as err:
+            self.log.error("ShellWorker: failed to send cmd %s to shell %s: %s", cmd, self.pid, err)
+            return self.process.wait(), b""
+
+        output = bytearray()
+        searched = 0  # no sentinel before this position
+        fd = self.process.stdout.fileno()
+        deadline = None if timeout is None else time.time() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                idx = output.find(self._sentinel, searched)
+                if idx >= 0:
+                    end = output.find(b"\n", idx)
+                    if end >= 0:
+                        return int(output[idx + len(self._sentinel) : end]), bytes(output[:idx])
+                else:
+                    # the sentinel might be split over 2 reads
+                    searched = max(0, len(output) - len(self._sentinel))
+
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    self.log.debug("ShellWorker: cmd %s timed out after %ss, killing shell %s", cmd, timeout, self.pid)
+                    self.kill()
+                    return None, bytes(output)
+                if not selector.select(wait):
+                    continue
+
+                out = os.read(fd, readsize)
+                if not out:
+                    ec = self.process.wait()
+                    self.log.error(
+                        "ShellWorker: shell %s died with exitcode %s while running cmd %s", self.pid, ec, cmd
+                    )
+                    return ec, bytes(output)
+                output += out
+
+    def kill(self):
+        """Kill the shell and all the commands it started"""
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                self.log.error("ShellWorker: failed to kill shell %s: %s", self.pid, err)
+        self.process.wait()
+        self.close()
+
+    def stop(self):
+        """Stop the shell (it exits when there is no more input)"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=Run.STOP_TASKS_WAIT)
+        except subprocess.TimeoutExpired:
+            self.log.warning("ShellWorker: shell %s did not stop, killing it", self.pid)
+            self.kill()
+        self.close()
+
+    def close(self):
+        """Close the pipes to the shell"""
+        for fileobj in (self.process.stdin, self.process.stdout):
+            try:
+                fileobj.close()
+            except OSError:
+                pass
+
+
+class RunPool:
+    """
+    Run (short) commands in a pool of long-lived shells, so running a command does not have to start a new process
+    (and setup a Run instance and its logger) from this process.
+
+    >>> with RunPool(workers=2) as pool:
+    ...     exitcode, output = pool.run(["cat", "/proc/loadavg"])
+
+    The commands run in a subshell of a bash shell, without input. A shell is replaced by a new one after
+    max_commands commands, or when a command times out (the shell and the command are killed).
+    The run method can be used from multiple threads, each command gets a shell of its own.
+    """
+
+    WORKERS = 1
+    MAX_COMMANDS = 1000
+    SHELL = BASH
+
+    def __init__(self, workers=None, max_commands=None, **kwargs):
+        """
+        Handle initialisation, the shells are started when they are needed
+            @param workers: number of shells
+            @param max_commands: replace a shell after this many commands
+            @param shell: the shell to use (bash or compatible)
+            @param env: environment of the shells (default: the environment of this process)
+            @param post_exitcode: log errors on non zero exitcode (debug otherwise)
+            @param encoding: decode the output with this encoding
+                (default: ASCII, with backslash escapes for all other characters)
+            @param disable_log: use fake logger (won't log anything)
+        """
+        self.workers = self.WORKERS if workers is None else workers
+        self.max_commands = self.MAX_COMMANDS if max_commands is None else max_commands
+        self.shell = kwargs.pop("shell", self.SHELL)
+        self.env = kwargs.pop("env", None)
+        self.post_exitcode = kwargs.pop("post_exitcode", True)
+        self.encoding = kwargs.pop("encoding", None)
+
+        if kwargs.pop("disable_log", None):
+            self.log = DummyFunction()  # No logging
+        else:
+            self.log = getLogger(self.__class__.__name__)
+
+        if kwargs:
+            msg = f"RunPool: unknown named arguments {sorted(kwargs)}"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if self.workers < 1:
+            msg = f"RunPool: workers should be at least 1, got {self.workers}"
+            self.log.error(msg)
+            raise ValueError(msg)
+
+        # most recently used shell first; None is a shell that is not started (yet)
+        self._idle = queue.LifoQueue()
+        for _ in range(self.workers):
+            self._idle.put(None)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_worker(self):
+        """Return an idle (started) shell, waits until one is available"""
+        worker = self._idle.get()
+        if self._closed:
+            self._idle.put(worker)
+            msg = "RunPool: pool is closed"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if worker is not None and not worker.alive():
+            self.log.debug("_get_worker: shell %s died, starting a new one", worker.pid)
+            worker.close()
+            worker = None
+        if worker is None:
+            worker = ShellWorker(shell=self.shell, env=self.env, log=self.log)
+        return worker
+
+    def _put_worker(self, worker):
+        """Make the shell available again, or replace it when it is no longer usable"""
+        if worker is not None:
+            if self._closed or not worker.alive():
+                worker.stop()
+                worker = None
+            elif worker.commands >= self.max_commands:
+                self.log.debug("_put_worker: shell %s ran %s commands, replacing it", worker.pid, worker.commands)
+                worker.stop()
+                worker = None
+        self._idle.put(worker)
+
+    def run(self, cmd, startpath=None, env=None, timeout=None):
+        """
+        Run cmd in one of the shells, return (exitcode, output) like run
+            @param cmd: command to run, a string is passed to the shell, a list is run without shell expansion
+            @param startpath: directory to run the command in
+            @param env: environment of the command (replaces the environment of the shell)
+            @param timeout: kill the command after timeout seconds
+                (exitcode RUNRUN_TIMEOUT_EXITCODE and output RUNRUN_TIMEOUT_OUTPUT, like RunTimeout)
+        """
+        if self._closed:
+            msg = f"RunPool: can't run cmd {cmd}, pool is closed"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if startpath is not None and not os.path.isdir(startpath):
+            msg = f"RunPool: startpath {startpath} is not an existing directory"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if env is not None:
+            invalid = [name for name in env if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name)]
+            if invalid:
+                msg = f"RunPool: invalid environment variable names {invalid}"
+                self.log.error(msg)
+                raise ValueError(msg)
+
+        worker = self._get_worker()
+        try:
+            ec, out = worker.run(cmd, startpath=startpath, env=env, timeout=timeout)
+        finally:
+            self._put_worker(worker)
+
+        if self.encoding is None:
+            output = ensure_ascii_string(out)
+        else:
+            output = out.decode(self.encoding, errors="backslashreplace")
+
+        if ec is None:
+            self.log.debug("run: cmd %s timed out after %ss: output %s", cmd, timeout, output)
+            ec, output = RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT
+        elif ec != 0:
+            message = f"run: problem occured with cmd {ensure_ascii_string(cmd)}: exitcode {ec} output {output}"
+            if self.post_exitcode:
+                self.log.error(message)
+            else:
+                self.log.debug(message)
+        else:
+            self.log.debug("run: success cmd %s: output %s", cmd, output)
+
+        return ec, output
+
+    def close(self):
+        """Stop all idle shells, shells that are in use are stopped when their command finishes"""
+        self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+
+
 # convenient names
 # eg: from vsc.utils.run import trivial
 
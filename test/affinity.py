@@ -0,0 +1,89 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the NUMA functions of the vsc.utils.affinity module
+"""
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+
+from vsc.utils.affinity import cpulist_to_cpus, get_allowed_cpus, get_numa_nodes, spread_cpus
+
+
+class AffinityTest(TestCase):
+    """Tests for affinity"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        # fake sysfs with 2 NUMA nodes and a node without cpus
+        for node, cpulist in [(0, '0-3,8-11'), (1, '4-7,12-15'), (2, '')]:
+            os.makedirs(os.path.join(self.tempdir, f'node{node}'))
+            with open(os.path.join(self.tempdir, f'node{node}', 'cpulist'), 'w') as fih:
+                fih.write(cpulist + '\n')
+        os.makedirs(os.path.join(self.tempdir, 'power'))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_cpulist(self):
+        """Test converting cpulists"""
+        self.assertEqual(cpulist_to_cpus('0'), [0])
+        self.assertEqual(cpulist_to_cpus('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertErrorRegex(ValueError, 'end is lower', cpulist_to_cpus, '3-1')
+
+        allowed = get_allowed_cpus()
+        self.assertEqual(allowed, sorted(os.sched_getaffinity(0)))
+
+    def test_numa_nodes(self):
+        """Test reading the NUMA nodes"""
+        nodes = get_numa_nodes(path=self.tempdir)
+        self.assertEqual(nodes, {0: [0, 1, 2, 3, 8, 9, 10, 11], 1: [4, 5, 6, 7, 12, 13, 14, 15]})
+        self.assertEqual(get_numa_nodes(path=os.path.join(self.tempdir, 'nosuchdir')), {})
+
+    def test_spread_cpus(self):
+        """Test dividing cpus in groups"""
+        cpus = list(range(16))
+        self.assertEqual(spread_cpus(4, cpus=cpus), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12, 13, 14, 15]])
+        self.assertEqual(spread_cpus(3, cpus=cpus[:8]), [[0, 1, 2], [3, 4, 5], [6, 7]])
+        self.assertEqual(spread_cpus(4, cpus=[2, 0]), [[0], [2]])
+        self.assertEqual(spread_cpus(1, cpus=cpus), [cpus])
+
+        numa = spread_cpus(4, numa=True, cpus=cpus, path=self.tempdir)
+        self.assertEqual(numa, [[0, 1, 2, 3, 8, 9, 10, 11], [4, 5, 6, 7, 12, 13, 14, 15]])
+        numa = spread_cpus(4, numa=True, cpus=[1, 2, 3], path=self.tempdir)
+        self.assertEqual(numa, [[1, 2, 3]])
+        # no NUMA information
+        numa = spread_cpus(4, numa=True, cpus=[1, 2, 3], path=os.path.join(self.tempdir, 'nosuchdir'))
+        self.assertEqual(numa, [[1, 2, 3]])
+
+        self.assertEqual(sum(spread_cpus(2), []), get_allowed_cpus())
+
+        self.assertErrorRegex(ValueError, 'no cpus', spread_cpus, 2, cpus=[])
+        self.assertErrorRegex(ValueError, 'at least 1', spread_cpus, 0, cpus=cpus)
@@ -0,0 +1,220 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the vsc.utils.asynciorun module.
+"""
+import asyncio
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from vsc.utils import asynciorun
+from vsc.utils.asynciorun import RunNoShellAsyncioQA
+from vsc.utils.run import RUNRUN_TIMEOUT_OUTPUT, RUNRUN_TIMEOUT_EXITCODE, RUNRUN_QA_MAX_MISS_EXITCODE
+from vsc.install.testing import TestCase
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtests')
+SCRIPT_SIMPLE = os.path.join(SCRIPTS_DIR, 'simple.py')
+SCRIPT_QA = os.path.join(SCRIPTS_DIR, 'qa.py')
+
+
+def run_async(coro):
+    """Run coroutine coro in a new event loop (asyncio.run requires Python 3.7)"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class RunAsyncioQAShort(RunNoShellAsyncioQA):
+    LOOP_MAX_MISS_COUNT = 3  # approx 3 sec
+
+
+class TestAsyncioRun(TestCase):
+    """Tests for the asynciorun module."""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_run(self):
+        """Test run and async_run"""
+        for fn in (asynciorun.run, asynciorun.async_run):
+            ec, output = run_async(fn([sys.executable, SCRIPT_SIMPLE, 'shortsleep']))
+            self.assertEqual(ec, 0)
+            self.assertEqual(output, "Shortsleep completed\n")
+
+            ec, output = run_async(fn("ls /no/such/path"))
+            self.assertTrue(ec > 0)
+            self.assertTrue('No such file or directory' in output)
+
+        # unicode is escaped, like vsc.utils.run does
+        ec, output = run_async(asynciorun.run(['echo', 'this -> ¢ <- is unicode']))
+        self.assertEqual(output, 'this -> \\xc2\\xa2 <- is unicode\n')
+
+    def test_env_input_startpath(self):
+        """Test env, input and startpath"""
+        ec, output = run_async(asynciorun.run(['/usr/bin/env'], env={"MYENVVAR": "something"}))
+        self.assertEqual(ec, 0)
+        self.assertTrue('myenvvar=something' in output.lower())
+
+        for inp in ['foo', b'foo', 'testing, 1, 2, 3\n' * 10000]:
+            ec, output = run_async(asynciorun.run(['cat'], input=inp))
+            self.assertEqual(ec, 0)
+            if not isinstance(inp, str):
+                inp = inp.decode(encoding='utf-8')
+            self.assertEqual(output, inp)
+
+        cwd = os.getcwd()
+        ec, output = run_async(asynciorun.run(['pwd'], startpath=self.tempdir))
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, os.path.realpath(self.tempdir) + '\n')
+        self.assertEqual(os.getcwd(), cwd)
+
+        self.assertErrorRegex(ValueError, "does not exist", run_async,
+                              asynciorun.run(['pwd'], startpath='/no/such/directory'))
+
+    def test_timeout(self):
+        """Test timeout"""
+        start = time.time()
+        ec, output = run_async(asynciorun.timeout([sys.executable, SCRIPT_SIMPLE, 'longsleep'], timeout=1))
+        self.assertEqual(ec, RUNRUN_TIMEOUT_EXITCODE)
+        self.assertEqual(output, RUNRUN_TIMEOUT_OUTPUT)
+        self.assertTrue(time.time() - start < 2)
+
+        ec, output = run_async(asynciorun.timeout([sys.executable, SCRIPT_SIMPLE, 'shortsleep'], timeout=5))
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, "Shortsleep completed\n")
+
+        # the tree is killed by a thread, that is kept until it is done
+        runner = asynciorun.RunNoShellAsyncioTimeout(['sh', '-c', 'sleep 30 & sleep 30'], timeout=0.5, kill_tree=True)
+        self.assertEqual(run_async(runner._run()), (RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT))
+        self.assertTrue(runner._killtree_thread is not None)
+        runner._killtree_thread.join()
+
+        # the process keeps running after closing its output
+        start = time.time()
+        ec, output = run_async(asynciorun.timeout(['sh', '-c', 'exec >&- 2>&-; sleep 6'], timeout=1))
+        self.assertEqual((ec, output), (RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_separate_stderr(self):
+        """Test separating the stderr from the output"""
+        code = 'import sys; sys.stderr.write("e" * 200000); sys.stdout.write("o" * 200000)'
+        ec, output, stderr = run_async(asynciorun.run([sys.executable, '-c', code], separate_stderr=True))
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'o' * 200000)
+        self.assertEqual(stderr, 'e' * 200000)
+
+    def test_binary_encoding(self):
+        """Test returning the output as bytes, or decoded with an encoding"""
+        text = 'a' + '\u00e9' * 3000
+        cmd = [sys.executable, '-c', f'import sys; sys.stdout.buffer.write({text.encode()!r})']
+        self.assertEqual(run_async(asynciorun.run(cmd, binary=True)), (0, text.encode()))
+        self.assertEqual(run_async(asynciorun.run(cmd, encoding='utf-8')), (0, text))
+
+    def test_accounting(self):
+        """Test measuring the resources, the process is reaped by asyncio so only time and I/O are known"""
+        res = run_async(asynciorun.run(['sleep', '0.5'], accounting=True))
+        self.assertEqual(res, (0, ''))
+        resources = res.resources
+        self.assertTrue(0.5 <= resources.wall < 5)
+        self.assertEqual(resources.cpu, None)
+
+    def test_readsize(self):
+        """Test the adaptive readsize and the pipe size"""
+        size = 4 * 1024 * 1024
+        cmd = ['head', '-c', str(size), '/dev/zero']
+        r = asynciorun.RunNoShellAsyncio(cmd, binary=True, adaptive_readsize=True, pipe_size=1024 * 1024)
+        self.assertEqual(run_async(r._run()), (0, b'\0' * size))
+        self.assertEqual(r._readsize_max, 1024 * 1024)
+        self.assertTrue(r.readsize > r.READSIZE)
+
+        # no (private) transport of the asyncio process: no pipes
+        r._process = asynciorun.AsyncioProcess(types.SimpleNamespace(pid=1, stdin=None))
+        self.assertEqual(r._output_pipes(), [])
+
+    def test_binary_empty(self):
+        """No remaining output is empty bytes in binary mode"""
+        runner = asynciorun.RunNoShellAsyncio(['true'], binary=True)
+        self.assertEqual(runner._read_process(), b'')
+
+    def test_max_output(self):
+        """Test limiting the output"""
+        cmd = ['head', '-c', '1000000', '/dev/zero']
+        res = run_async(asynciorun.run(cmd, binary=True, max_output=1000, max_output_policy='tail'))
+        self.assertEqual((res, res.dropped), ((0, b'\0' * 1000), 999000))
+
+    def test_concurrent(self):
+        """Test running many commands concurrently in a single event loop"""
+        cmd = [sys.executable, '-c', 'import time; time.sleep(1); print("done")']
+
+        async def run_all():
+            return await asyncio.gather(*[asynciorun.timeout(cmd, timeout=10) for _ in range(20)])
+
+        start = time.time()
+        res = run_async(run_all())
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(res, [(0, 'done\n')] * 20)
+
+    def test_qa(self):
+        """Test qa, qa_reg and no_qa"""
+        qa_dict = {
+            "Enter a number ('0' to stop):": ['1', '2', '4', '0'],
+        }
+        ec, output = run_async(asynciorun.qa([sys.executable, SCRIPT_QA, 'ask_number', '4'], qa=qa_dict))
+        self.assertEqual(ec, 0)
+        answer_re = re.compile(".*Answer: 7$")
+        self.assertTrue(answer_re.match(output), f"'{output}' matches pattern '{answer_re.pattern}'")
+
+        qa_reg_dict = {
+            r'\s(?P<time>\d+(?:\.\d+)?).*?What time is it\?': '%(time)s',
+        }
+        ec, output = run_async(asynciorun.qa([sys.executable, SCRIPT_QA, 'whattime'], qa_reg=qa_reg_dict))
+        self.assertEqual(ec, 0)
+
+        qa_dict = {
+            'Now is the time.': 'OK',
+        }
+        cmd = [sys.executable, SCRIPT_QA, 'waitforit']
+        ec, output = run_async(RunAsyncioQAShort.run(cmd, qa=qa_dict))
+        self.assertEqual(ec, RUNRUN_QA_MAX_MISS_EXITCODE)
+
+        no_qa = [r'Wait for it \(\d+ seconds\)']
+        ec, output = run_async(RunAsyncioQAShort.run(cmd, qa=qa_dict, no_qa=no_qa))
+        self.assertEqual(ec, 0)
@@ -71,3 +71,62 @@ class AsyncProcessTest(TestCase):
     def tearDown(self):
         """cleanup"""
         os.chdir(self.cwd)
+
+
+class AsyncProcessPipeTest(TestCase):
+    """Tests for the non-blocking pipes of asyncprocess.Popen"""
+
+    def test_recv_some_wait(self):
+        """recv_some returns as soon as maxread bytes are available, instead of sleeping"""
+        shell = Popen(['sh', '-c', 'sleep 0.2; echo hello; sleep 5'], stdout=p.PIPE)
+        start = time.time()
+        self.assertEqual(p.recv_some(shell, t=3, maxread=6), b"hello\n")
+        self.assertTrue(time.time() - start < 2)
+        # nothing else, returns after timeout
+        self.assertEqual(p.recv_some(shell, t=0.1), b"")
+        # pipe is made non-blocking once
+        self.assertFalse(os.get_blocking(shell.stdout.fileno()))
+        shell.kill()
+        shell.wait()
+
+    def test_large_output(self):
+        """Read a large output, also on stderr"""
+        size = 10 * 1024 * 1024
+        cmd = ['sh', '-c', f'head -c {size} /dev/zero; head -c 10 /dev/zero >&2']
+        shell = Popen(cmd, stdout=p.PIPE, stderr=p.PIPE)
+        self.assertEqual(len(p.recv_some(shell, t=5, e=False)), size)
+        self.assertEqual(shell.recv(), None)
+        self.assertEqual(p.recv_some(shell, stderr=True, t=5), b"\0" * 10)
+        self.assertEqual(shell.recv_all("stderr"), b"")
+        shell.wait()
+
+    def test_send_all_large(self):
+        """Send more data than fits in the pipe"""
+        data = "x" * (1024 * 1024)
+        shell = Popen(['wc', '-c'], stdin=p.PIPE, stdout=p.PIPE)
+        # send_all waits for the pipe to be writable
+        self.assertEqual(p.send_all(shell, data), len(data))
+        shell.stdin.close()
+        self.assertEqual(shell.recv_all().strip(), str(len(data)).encode())
+        shell.wait()
+
+    def test_text_mode(self):
+        """Multibyte characters split over reads are decoded, newlines are translated"""
+        shell = Popen(['printf', '\\303\\251\\303\\251\\r\\na\\rb\\r'], stdout=p.PIPE, universal_newlines=True)
+        chunks = []
+        while True:
+            shell.wait_pipe('stdout')
+            r = shell.recv(1)
+            if r is None:
+                break
+            chunks.append(r)
+        self.assertEqual(''.join(chunks), '\xe9\xe9\na\nb\n')
+        shell.wait()
+
+        # incomplete character at the end is an error, like for the file object of the pipe
+        shell = Popen(['printf', '\\303'], stdout=p.PIPE, universal_newlines=True)
+        self.assertRaises(UnicodeDecodeError, shell.recv_all)
+        shell.wait()
+        shell = Popen(['printf', 'a\\303'], stdout=p.PIPE, encoding='utf8', errors='replace')
+        self.assertEqual(shell.recv_all(), 'a\ufffd')
+        shell.wait()
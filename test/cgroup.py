@@ -0,0 +1,113 @@
+#
+# Copyright 2026-2026 Ghent University
+#
+# This file is part of vsc-base,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-base
+#
+# vsc-base is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-base is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-base. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the vsc.utils.cgroup module, with a fake cgroup layout (plain directories and files)
+"""
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+
+from vsc.utils.cgroup import Cgroup, get_cgroup
+
+
+class CgroupTest(TestCase):
+    """Tests for cgroup"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.parent = os.path.join(self.tempdir, 'delegated')
+        os.mkdir(self.parent)
+        with open(os.path.join(self.parent, 'cgroup.subtree_control'), 'w') as fih:
+            fih.write('cpu pids\n')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def read(self, *path):
+        """Return the content of a file in the fake layout"""
+        with open(os.path.join(self.tempdir, *path)) as fih:
+            return fih.read()
+
+    def test_get_cgroup(self):
+        """Test finding the cgroup of a process"""
+        cgroup = get_cgroup()
+        if cgroup is not None:
+            self.assertTrue(cgroup.startswith('/sys/fs/cgroup'))
+        self.assertEqual(get_cgroup(pid=2**30), None)
+
+    def test_create(self):
+        """Test creating a cgroup with limits"""
+        cgroup = Cgroup.create(parent=self.parent, name='test', limits={'memory.max': '1G', 'pids.max': 10})
+        self.assertEqual(cgroup.path, os.path.join(self.parent, 'test'))
+        # only the missing controllers are enabled
+        self.assertEqual(self.read('delegated', 'cgroup.subtree_control'), '+memory')
+        self.assertEqual(self.read('delegated', 'test', 'memory.max'), '1G')
+        self.assertEqual(self.read('delegated', 'test', 'pids.max'), '10')
+
+        cgroup.attach(123)
+        cgroup.attach(456)
+        self.assertEqual(cgroup.procs(), [123, 456])
+
+        # no statistics
+        self.assertEqual(cgroup.stats(), {'memory.peak': None, 'cpu.stat': {}})
+        with open(os.path.join(cgroup.path, 'memory.peak'), 'w') as fih:
+            fih.write('1234\n')
+        with open(os.path.join(cgroup.path, 'cpu.stat'), 'w') as fih:
+            fih.write('usage_usec 100\nuser_usec 60\nsystem_usec 40\n')
+        stats = {'memory.peak': 1234, 'cpu.stat': {'usage_usec': 100, 'user_usec': 60, 'system_usec': 40}}
+        self.assertEqual(cgroup.stats(), stats)
+
+        self.assertFalse(cgroup.kill())
+        open(os.path.join(cgroup.path, 'cgroup.kill'), 'w').close()
+        self.assertTrue(cgroup.kill())
+        self.assertEqual(self.read('delegated', 'test', 'cgroup.kill'), '1')
+
+        # the fake cgroup is not empty
+        self.assertFalse(cgroup.remove())
+
+        cgroup = Cgroup.create(parent=self.parent)
+        self.assertTrue(os.path.basename(cgroup.path).startswith(f'vsc-run-{os.getpid()}-'))
+        self.assertTrue(cgroup.remove())
+        self.assertFalse(os.path.exists(cgroup.path))
+
+    def test_errors(self):
+        """Test errors"""
+        self.assertErrorRegex(ValueError, 'unknown controllers', Cgroup.create, parent=self.parent,
+                              limits={'foo.max': 1})
+        self.assertErrorRegex(OSError, 'failed to create cgroup', Cgroup.create,
+                              parent=os.path.join(self.tempdir, 'no', 'such', 'cgroup'))
+        os.chmod(self.parent, 0o500)
+        try:
+            if os.access(self.parent, os.W_OK):
+                # eg as root
+                return
+            self.assertErrorRegex(OSError, 'failed to write', Cgroup(self.parent).write, 'pids.max', 1)
+        finally:
+            os.chmod(self.parent, 0o700)
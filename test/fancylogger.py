@@ -29,15 +29,20 @@ Unit tests for fancylogger.
 @author: Kenneth Hoste (Ghent University)
 @author: Stijn De Weirdt (Ghent University)
 """
+import gc
+import json
 import logging
 import os
 import re
 import sys
 import shutil
+import subprocess
 import tempfile
+import threading
+import weakref
 from io import StringIO
 from random import randint
-from unittest import TestLoader, main, TestSuite
+from unittest import TestLoader, main, TestSuite, mock
 
 from unittest import skipUnless
 from vsc.utils import fancylogger
@@ -413,6 +418,156 @@ class FancyLoggerTest(TestCase):
         # log to stderr, check stdout
         self._stream_stdouterr(False, False)
 
+    def test_stream_buffered(self):
+        """Test buffered streamLog"""
+        class CountingHandler(logging.StreamHandler):
+            flushes = 0
+
+            def flush(self):
+                self.flushes += 1
+                super().flush()
+
+        logger = fancylogger.getLogger('stream')
+        logger.setLevel('INFO')
+        handler = CountingHandler(StringIO())
+        logger.addHandler(handler)
+
+        for idx in range(10):
+            logger.streamInfo("chunk %s\n" % idx)
+        self.assertEqual(handler.flushes, 10)
+        self.assertEqual(handler.stream.getvalue(), ''.join("chunk %s\n" % idx for idx in range(10)))
+
+        handler.stream = StringIO()
+        handler.flushes = 0
+        for idx in range(10):
+            logger.streamLog('INFO', "chunk %s\n" % idx, buffered=True)
+        # below the level
+        logger.streamLog('DEBUG', "debug\n", buffered=True)
+        self.assertEqual(handler.stream.getvalue(), '')
+        # the handlers are cached, until they change
+        handler2 = CountingHandler(StringIO())
+        logger.addHandler(handler2)
+        logger.streamLog('INFO', "chunk 10\n", buffered=True)
+        logger.streamFlush()
+        logger.streamFlush()
+        self.assertEqual(handler.flushes, 1)
+        self.assertEqual(handler.stream.getvalue(), ''.join("chunk %s\n" % idx for idx in range(11)))
+        self.assertEqual(handler2.stream.getvalue(), "chunk 10\n")
+
+        # also handlers that are added to non-fancy loggers (eg by logging.basicConfig to the root logger)
+        # or changes of propagate are noticed
+        parent = logging.Logger('plainparent')
+        handler3 = CountingHandler(StringIO())
+        orig_parent, logger.parent = logger.parent, parent
+        try:
+            logger.streamLog('INFO', "chunk 11\n", buffered=True)
+            parent.addHandler(handler3)
+            logger.streamLog('INFO', "chunk 12\n", buffered=True)
+            logger.propagate = False
+            logger.streamLog('INFO', "chunk 13\n", buffered=True)
+            logger.streamFlush()
+        finally:
+            logger.parent = orig_parent
+            logger.propagate = True
+        self.assertEqual(handler3.stream.getvalue(), "chunk 12\n")
+        self.assertTrue(handler.stream.getvalue().endswith("chunk 11\nchunk 12\nchunk 13\n"))
+
+        # flush at the size threshold
+        logger.STREAM_BUFFER_SIZE = 20
+        handler.stream = StringIO()
+        for idx in range(5):
+            logger.streamLog('INFO', "chunk %s\n" % idx, buffered=True)
+        self.assertEqual(handler.stream.getvalue(), "chunk 0\nchunk 1\nchunk 2\n")
+        logger.streamFlush()
+        self.assertEqual(handler.stream.getvalue(), ''.join("chunk %s\n" % idx for idx in range(5)))
+
+        # flush at the time interval
+        logger.STREAM_BUFFER_SIZE = fancylogger.FancyLogger.STREAM_BUFFER_SIZE
+        logger.STREAM_FLUSH_INTERVAL = 0
+        handler.stream = StringIO()
+        logger.streamLog('INFO', "chunk\n", buffered=True)
+        self.assertEqual(handler.stream.getvalue(), "chunk\n")
+
+        # the handlers behind the queue of asynchronous logging
+        logger.removeHandler(handler2)
+        logger.propagate = False
+        fancylogger.enable_async_logging(name='stream')
+        handler.stream = StringIO()
+        logger.streamLog('INFO', "async\n", buffered=True)
+        logger.streamInfo("unbuffered\n")
+        fancylogger.disable_async_logging(name='stream')
+        self.assertEqual(handler.stream.getvalue(), "async\nunbuffered\n")
+        logger.removeHandler(handler)
+
+    def test_json(self):
+        """Test logging to file as JSON"""
+        fd, logfn = tempfile.mkstemp()
+        os.close(fd)
+        handler = fancylogger.logToFile(logfn, json=True)
+        self.assertTrue(isinstance(handler.formatter, fancylogger.JsonFormatter))
+
+        class Foobar:
+            def log(self):
+                logger = fancylogger.getLogger('json', fancyrecord=True)
+                logger.warning("message %s", 1, extra={'jobid': 123, 'obj': Foobar})
+                try:
+                    raise ValueError("oops")
+                except ValueError:
+                    logger.exception("failed")
+
+        Foobar().log()
+        fancylogger.getLogger('json', fancyrecord=False).warning("not fancy")
+        handler.flush()
+        with open(logfn) as fih:
+            records = [json.loads(line) for line in fih]
+
+        self.assertEqual(len(records), 3)
+        fields = list(fancylogger.JSON_LOGGING_FIELDS)
+        self.assertEqual(list(records[0]), fields + ['jobid', 'obj'])
+        self.assertTrue(re.match(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}[+-]\d\d:\d\d$', records[0]['timestamp']))
+        self.assertEqual(records[0]['level'], 'WARNING')
+        self.assertTrue(records[0]['name'].endswith('.json'))
+        self.assertEqual(records[0]['className'], 'Foobar')
+        self.assertEqual(records[0]['mpirank'], fancylogger.MPIRANK_NO_MPI)
+        self.assertEqual(records[0]['thread'], 'MainThread')
+        self.assertEqual(records[0]['message'], 'message 1')
+        self.assertEqual(records[0]['jobid'], 123)
+        # not serialisable: the string representation
+        self.assertEqual(records[0]['obj'], str(Foobar))
+        self.assertEqual(list(records[1]), fields + ['exception'])
+        self.assertTrue(records[1]['exception'].endswith("ValueError: oops"))
+        self.assertEqual((records[2]['className'], records[2]['mpirank']), (None, None))
+
+        # extra fields can't overwrite the standard attributes
+        self.assertErrorRegex(KeyError, "overwrite 'name'", fancylogger.getLogger('json').warning, 'x',
+                              extra={'name': 'foo'})
+        fancylogger.logToFile(logfn, enable=False)
+
+        # FANCYLOG_JSON is the default
+        orig = fancylogger.FANCYLOG_JSON
+        fancylogger.FANCYLOG_JSON = True
+        handler = fancylogger.logToFile(logfn)
+        fancylogger.FANCYLOG_JSON = orig
+        self.assertTrue(isinstance(handler.formatter, fancylogger.JsonFormatter))
+        fancylogger.logToFile(logfn, enable=False)
+        os.remove(logfn)
+
+    def test_json_formatter(self):
+        """Test the fields and serialisation of JsonFormatter"""
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, "a %s", ('message',), None)
+        record.big = 2 ** 70
+        formatter = fancylogger.JsonFormatter(fields=['level', 'lineno', 'foo'])
+        expected = {'level': 'INFO', 'lineno': 1, 'foo': None, 'big': 2 ** 70}
+        self.assertEqual(json.loads(formatter.format(record)), expected)
+        formatter = fancylogger.JsonFormatter(fields=['message'], extra=False)
+        self.assertEqual(formatter.format(record), '{"message":"a message"}')
+
+        # with the json module
+        with mock.patch.object(fancylogger, 'HAVE_ORJSON', False):
+            formatter = fancylogger.JsonFormatter(fields=['level', 'lineno', 'foo'])
+        self.assertEqual(formatter._dumps, fancylogger._json_dumps)
+        self.assertEqual(json.loads(formatter.format(record)), expected)
+
     def test_classname_in_log(self):
         """Do a log and check if the classname is correctly in it"""
         _stderr = sys.stderr
@@ -457,6 +612,78 @@ class FancyLoggerTest(TestCase):
         fancylogger.logToScreen(enable=False, handler=handler)
         sys.stderr = _stderr
 
+    def test_fancyrecord_classname(self):
+        """Test the className of the fancy log records, the caller frame is not kept"""
+        records = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = fancylogger.getLogger('fancyrecord_classname', fancyrecord=True)
+        logger.addHandler(Collect())
+
+        class Foobar:
+            def method(self):
+                logger.warning('from method')
+
+                def inner():
+                    logger.warning('from closure %s', self)
+                inner()
+
+        def function():
+            logger.warning('from function')
+
+        Foobar().method()
+        function()
+        logger.handlers = []
+
+        self.assertEqual([record.className for record in records],
+                         ['Foobar', 'Foobar', 'unknown__getCallingClassName'])
+
+        # the records don't keep the variables of the caller alive
+        class Tracked:
+            def method(self):
+                logger.warning('from a method')
+
+        logger.addHandler(Collect())
+        obj = Tracked()
+        ref = weakref.ref(obj)
+        obj.method()
+        logger.handlers = []
+        del obj
+        gc.collect()
+        self.assertEqual(ref(), None)
+        self.assertEqual(records[-1].className, 'Tracked')
+
+    def test_getRootLoggerName(self):
+        """Test the name of the root module, which is determined once"""
+        name = fancylogger.getRootLoggerName()
+        self.assertEqual(fancylogger._root_logger_name, name)
+        self.assertEqual(fancylogger.getRootLoggerName(), name)
+
+        code = 'from vsc.utils.fancylogger import getRootLoggerName; print(getRootLoggerName())'
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        tmpdir = tempfile.mkdtemp()
+        script = os.path.join(tmpdir, 'some_script.py')
+        with open(script, 'w') as fih:
+            fih.write(code)
+        for cmd, expected in [([script], 'some_script'), (['-c', code], '<string>')]:
+            out = subprocess.check_output([sys.executable] + cmd, env=env)
+            self.assertEqual(out.decode().strip(), expected)
+        shutil.rmtree(tmpdir)
+
+    def test_getLogger_fname_clsname(self):
+        """Test the logger names with the calling function and class"""
+        class Foobar:
+            def somefunction(self):
+                return fancylogger.getLogger('foo', fname=True, clsname=True)
+
+        root = fancylogger.getRootLoggerName()
+        self.assertEqual(Foobar().somefunction().name, f'{root}.foo.Foobar.somefunction')
+        logger = fancylogger.getLogger('foo', fname=True, clsname=True)
+        self.assertEqual(logger.name, f'{root}.foo.FancyLoggerTest.test_getLogger_fname_clsname')
+
     def test_getDetailsLogLevels(self):
         """
         Test the getDetailsLogLevels selection logic
@@ -610,6 +837,148 @@ class FancyLoggerTest(TestCase):
 
         fancylogger.FANCYLOG_FANCYRECORD = orig
 
+    def test_async_logging(self):
+        """Test logging via a queue and a listener thread"""
+        logger = fancylogger.getLogger('async')
+        logger.setLevel('DEBUG')
+        queue_handler = fancylogger.logToQueue()
+        self.assertTrue(isinstance(queue_handler, fancylogger.FancyQueueHandler))
+        self.assertEqual(fancylogger.enable_async_logging(), queue_handler)
+        self.assertEqual(fancylogger.getLogger().handlers, [queue_handler])
+        self.assertEqual(queue_handler.handlers, (self.handler,))
+
+        args = ['some', 'args']
+        logger.info("message with %s", args)
+        # the message is formatted when it is logged, not when it is handled
+        args.append('more')
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            logger.exception("something failed")
+
+        # handlers are added and removed behind the queue
+        stringio = StringIO()
+        handler = fancylogger.logToScreen(handler=logging.StreamHandler(stringio))
+        self.assertEqual(fancylogger.getLogger().handlers, [queue_handler])
+        self.assertTrue(handler in queue_handler.handlers)
+        logger.debug("also to the screen")
+
+        self.assertEqual(fancylogger.disable_async_logging(), queue_handler)
+        self.assertEqual(fancylogger.logToQueue(enable=False), None)
+        self.assertEqual(fancylogger.getLogger().handlers, [self.handler, handler])
+        fancylogger.logToScreen(enable=False, handler=handler)
+
+        log = self.read_log()
+        self.assertTrue(re.search(r"INFO .* message with \['some', 'args'\]\n", log), log)
+        self.assertTrue(re.search(r"ERROR .* something failed\nTraceback.*\nValueError: oops\n", log, re.S), log)
+        self.assertTrue(log.endswith("also to the screen\n"), log)
+        self.assertTrue(stringio.getvalue().endswith("also to the screen\n"))
+
+    def test_async_logging_classname(self):
+        """Test the className of log records that are handled in the listener thread"""
+        handler = logging.StreamHandler(StringIO())
+        handler.setFormatter(logging.Formatter("%(className)s %(message)s"))
+        fancylogger.logToScreen(handler=handler)
+        fancylogger.enable_async_logging()
+
+        class Foobar:
+            def log(self):
+                fancylogger.getLogger().warning("from a method")
+
+        Foobar().log()
+        fancylogger.disable_async_logging()
+        fancylogger.logToScreen(enable=False, handler=handler)
+        self.assertEqual(handler.stream.getvalue(), "Foobar from a method\n")
+
+    def test_async_logging_policies(self):
+        """Test the policies of the queue when it is full"""
+        def record(level, msg):
+            return logging.LogRecord('test', getattr(logging, level), __file__, 1, msg, None, None)
+
+        self.assertErrorRegex(ValueError, 'Unknown async logging policy', fancylogger.AsyncLogQueue, policy='foo')
+
+        # queue after the first 4 records, dropped levels and queue after one more INFO record
+        expected = {
+            'drop_oldest': (['debug 1', 'info 1', 'debug 2'], {'INFO': 1, 'DEBUG': 1}, ['info 1', 'debug 2', 'info 2']),
+            'drop_debug_first': (['info 0', 'debug 1', 'info 1'], {'DEBUG': 2}, ['info 0', 'info 1', 'info 2']),
+        }
+        for policy, (first, dropped, second) in expected.items():
+            log_queue = fancylogger.AsyncLogQueue(maxsize=3, policy=policy)
+            for msg in ['info 0', 'debug 1', 'info 1', 'debug 2']:
+                log_queue.put_nowait(record(msg.split()[0].upper(), msg))
+            self.assertEqual([rec.msg for rec in log_queue.queue], first)
+            log_queue.put_nowait(record('INFO', 'info 2'))
+            self.assertEqual(log_queue.dropped, 2)
+            self.assertEqual(log_queue.dropped_levels, dropped)
+            self.assertEqual([rec.msg for rec in log_queue.queue], second)
+            self.assertEqual(log_queue.qsize(), 3)
+            # the sentinel of the listener is never dropped (it waits for room in the queue)
+            for _ in range(3):
+                log_queue.get_nowait()
+                log_queue.task_done()
+            log_queue.put_nowait(None)
+            self.assertEqual(list(log_queue.queue), [None])
+            log_queue.get_nowait()
+            log_queue.task_done()
+            log_queue.join()
+
+        # the dropped records are reported when async logging is disabled
+        queue_handler = fancylogger.enable_async_logging(queue_size=1, policy='drop_oldest')
+        queue_handler.queue.dropped = 5
+        fancylogger.disable_async_logging()
+        self.assertTrue(re.search("Asynchronous logging dropped 5 log records", self.read_log()))
+
+    def test_async_logging_fork(self):
+        """Test async logging in a forked process"""
+        fancylogger.enable_async_logging()
+        logger = fancylogger.getLogger('fork')
+        logger.warning("before fork")
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            try:
+                # the listener thread is only started when the child logs (eg not for Popen with a preexec_fn)
+                threads = threading.active_count()
+                logger.warning("in child %s", os.getpid())
+                if threads == 1 and threading.active_count() == 2:
+                    exitcode = 0
+                fancylogger.disable_async_logging()
+            finally:
+                os._exit(exitcode)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        logger.warning("after fork")
+        child = pid
+
+        # a child that doesn't log
+        pid = os.fork()
+        if pid == 0:
+            try:
+                fancylogger.disable_async_logging()
+            finally:
+                os._exit(threading.active_count())
+        self.assertEqual(os.waitpid(pid, 0)[1], 1 << 8)
+        fancylogger.disable_async_logging()
+        log = self.read_log()
+        for msg in ["before fork", "in child %s" % child, "after fork"]:
+            self.assertTrue(msg in log, log)
+
+    def test_async_logging_exit(self):
+        """Test that all queued log records are handled when the process exits"""
+        code = '\n'.join([
+            'import sys',
+            'from vsc.utils import fancylogger',
+            'fancylogger.logToFile(sys.argv[1])',
+            'fancylogger.enable_async_logging()',
+            'for idx in range(1000):',
+            '    fancylogger.getLogger().warning("message %s", idx)',
+        ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.check_call([sys.executable, '-c', code, self.logfn], env=env)
+        with open(self.logfn) as fih:
+            lines = fih.read().splitlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(lines[-1].endswith("message 999"))
+
     def tearDown(self):
         fancylogger.logToFile(self.logfn, enable=False)
         self.handle.close()
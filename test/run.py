@@ -29,22 +29,30 @@ Tests for the vsc.utils.run module.
 @author: Stijn De Weirdt (Ghent University)
 @author: Kenneth Hoste (Ghent University)
 """
+import errno
+import logging
 import os
 import re
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import shutil
+import signal
+
+from io import StringIO
+from unittest import mock
 
 # Uncomment when debugging, cannot enable permanetnly, messes up tests that toggle debugging
 #logging.basicConfig(level=logging.DEBUG)
 
 from vsc.utils.missing import shell_quote
 from vsc.utils.run import (
-    CmdList, run, run_simple, asyncloop, run_asyncloop,
-    run_timeout, RunTimeout,
-    RunQA, RunNoShellQA,
-    async_to_stdout, run_async_to_stdout,
+    AccountingPopen, CmdList, OutputBuffer, RunNoShell, RunNoShellAsync, run, run_simple, asyncloop, run_asyncloop,
+    run_timeout, RunTimeout, RunNoShellTimeout,
+    RunQA, RunNoShellQA, RunNoShellAsyncLoop, RunNoShellLoop, RunNoShellLoopStdout, RunNoShellLoopLog,
+    async_to_stdout, run_async_to_stdout, run_many, RunNoShellFile, RunPool, RunPty,
 )
 from vsc.utils.run import RUNRUN_TIMEOUT_OUTPUT, RUNRUN_TIMEOUT_EXITCODE, RUNRUN_QA_MAX_MISS_EXITCODE
 from vsc.install.testing import TestCase
@@ -58,14 +66,27 @@ SCRIPT_NESTED = os.path.join(SCRIPTS_DIR, 'run_nested.sh')
 
 TEST_GLOB = ['ls','test/sandbox/testpkg/*']
 
+def process_running(pid):
+    """pid exists and is not a zombie"""
+    try:
+        with open(f'/proc/{pid}/stat') as fih:
+            return fih.read().rpartition(')')[2].split()[0] != 'Z'
+    except OSError:
+        return False
+
+
 class RunQAShort(RunNoShellQA):
     LOOP_MAX_MISS_COUNT = 3  # approx 3 sec
 
 class RunLegQAShort(RunQA):
     LOOP_MAX_MISS_COUNT = 3  # approx 3 sec
 
+class RunQAShortEvent(RunQAShort):
+    LOOP_EVENT_DRIVEN = True
+
 run_qas = RunQAShort.run
 run_legacy_qas = RunLegQAShort.run
+run_qas_event = RunQAShortEvent.run
 
 
 class TestRun(TestCase):
@@ -289,6 +310,721 @@ class TestRun(TestCase):
         #       It's ok not to test, as it is not the default, and it's not easy to change it
         #do_test(True)
 
+    def test_kill_tree(self):
+        """Test killing the process and all its descendants on timeout"""
+        res_fn = os.path.join(self.tempdir, 'nested_kill_tree')
+        # the deepest process ignores SIGTERM, and starts a process in a new session
+        script = os.path.join(self.tempdir, 'ignore_term.sh')
+        with open(script, 'w') as fih:
+            fih.write("#!/bin/bash\ntrap '' TERM\necho \"-1 $$ $PPID\" >> %s\n" % res_fn)
+            fih.write("setsid sleep 30 &\necho \"-2 $! $$\" >> %s\nsleep 30\n" % res_fn)
+        os.chmod(script, 0o755)
+
+        class RunKillTree(RunNoShellTimeout):
+            KILL_TREE_GRACE = 1
+
+        start = time.time()
+        cmd = ['bash', '-c', f'{script} & {SCRIPT_NESTED} 2 {res_fn}']
+        ec, output = RunKillTree.run(cmd, timeout=2, kill_tree=True)
+        self.assertEqual(ec, RUNRUN_TIMEOUT_EXITCODE)
+        # does not wait for the processes that ignore SIGTERM
+        self.assertTrue(time.time() - start < 3)
+
+        with open(res_fn) as fih:
+            pids = [int(line.split()[1]) for line in fih]
+        self.assertEqual(len(pids), 5)
+
+        time.sleep(2)
+        self.assertEqual([pid for pid in pids if process_running(pid)], [])
+
+    def test_killtasks_pgid(self):
+        """Test killing the process group of a process"""
+        cmd = ['bash', '-c', 'sleep 30 & echo $!; sleep 30 & echo $!; wait']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, start_new_session=True)
+        pids = [int(proc.stdout.readline()) for _ in range(2)]
+        RunNoShell('true')._killtasks(tasks=[proc.pid], sig=signal.SIGTERM, kill_pgid=True)
+        self.assertEqual(proc.wait(), -signal.SIGTERM)
+        proc.stdout.close()
+        time.sleep(0.5)
+        self.assertEqual([pid for pid in pids if process_running(pid)], [])
+
+        # never the process group of this process
+        proc = subprocess.Popen(['sleep', '30'])
+        RunNoShell('true')._killtasks(tasks=[proc.pid], kill_pgid=True)
+        self.assertEqual(proc.wait(), -signal.SIGKILL)
+
+    def test_event_driven(self):
+        """Test event driven loop mode"""
+        # no initial sleep, and no sleeping while waiting for the process to finish
+        start = time.time()
+        for _ in range(5):
+            ec, output = RunNoShellAsyncLoop.run(['echo', 'hello'], event_driven=True)
+            self.assertEqual(ec, 0)
+            self.assertEqual(output, 'hello\n')
+        self.assertTrue(time.time() - start < RunNoShellAsyncLoop.LOOP_TIMEOUT_INIT * 5)
+
+        # wakes up on output, not after LOOP_TIMEOUT_MAIN
+        cmd = [sys.executable, '-c', 'import time; print("a", flush=True); time.sleep(0.2); print("b")']
+        start = time.time()
+        ec, output = RunNoShellAsyncLoop.run(cmd, event_driven=True)
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'a\nb\n')
+        self.assertTrue(time.time() - start < RunNoShellAsyncLoop.LOOP_TIMEOUT_MAIN)
+
+        # also works with blocking (non-async) reads
+        self.mock_stdout(True)
+        ec, output = RunNoShellLoopStdout.run(cmd, event_driven=True)
+        stdout = self.get_stdout()
+        self.mock_stdout(False)
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'a\nb\n')
+        self.assertEqual(stdout, output)
+
+        # timeout is honoured without waiting for a full LOOP_TIMEOUT_MAIN
+        start = time.time()
+        ec, output = RunNoShellTimeout.run([sys.executable, SCRIPT_SIMPLE, 'longsleep'], timeout=0.5, event_driven=True)
+        self.assertEqual(ec, RUNRUN_TIMEOUT_EXITCODE)
+        self.assertEqual(output, RUNRUN_TIMEOUT_OUTPUT)
+        self.assertTrue(time.time() - start < 1)
+
+        # qa
+        qa_dict = {
+            "Enter a number ('0' to stop):": ['1', '2', '4', '0'],
+        }
+        ec, output = run_qas_event([sys.executable, SCRIPT_QA, 'ask_number', '4'], qa=qa_dict)
+        self.assertEqual(ec, 0)
+        answer_re = re.compile(".*Answer: 7$")
+        self.assertTrue(answer_re.match(output), f"'{output}' matches pattern '{answer_re.pattern}'")
+
+        qa_dict = {
+            'Now is the time.': 'OK',
+        }
+        no_qa = [r'Wait for it \(\d+ seconds\)']
+        ec, output = run_qas_event([sys.executable, SCRIPT_QA, 'waitforit'], qa=qa_dict, no_qa=no_qa)
+        self.assertEqual(ec, 0)
+
+    def test_output_buffer(self):
+        """Test OutputBuffer"""
+        buf = OutputBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.getvalue(), '')
+        self.assertEqual(buf.since(0), '')
+        self.assertEqual(buf.tail(10), '')
+
+        for chunk in ['foo', '', 'bar', 'baz\n', 'last']:
+            buf.append(chunk)
+        self.assertEqual(len(buf), 14)
+        self.assertEqual(buf.since(0), 'foobarbaz\nlast')
+        self.assertEqual(buf.since(4), 'arbaz\nlast')
+        self.assertEqual(buf.since(10), 'last')
+        self.assertEqual(buf.since(14), '')
+        self.assertEqual(buf.since(20), '')
+        self.assertEqual(buf.tail(6), 'z\nlast')
+        self.assertEqual(buf.tail(100), 'foobarbaz\nlast')
+        self.assertEqual(repr(buf), repr('foobarbaz\nlast'))
+        self.assertEqual(buf.getvalue(), 'foobarbaz\nlast')
+        buf.append('more')
+        self.assertEqual(buf.getvalue(), 'foobarbaz\nlastmore')
+        self.assertEqual(buf.tail(5), 'tmore')
+
+        self.assertEqual(OutputBuffer('init').getvalue(), 'init')
+
+        # large output in many chunks
+        cmd = [sys.executable, '-c', 'import sys; [sys.stdout.write("%09d\\n" % i) for i in range(200000)]']
+        ec, output = asyncloop(cmd)
+        self.assertEqual(ec, 0)
+        self.assertEqual(len(output), 2000000)
+        self.assertTrue(output.endswith('000199999\n'))
+
+        buf = OutputBuffer(b'')
+        self.assertEqual(buf.getvalue(), b'')
+        buf.append(b'abc')
+        buf.append(b'def')
+        self.assertEqual(buf.since(2), b'cdef')
+        self.assertEqual(buf.tail(10), b'abcdef')
+        self.assertEqual(OutputBuffer().getvalue(), '')
+
+    def test_output_buffer_limit(self):
+        """Test OutputBuffer with a maximum size"""
+        data = ''.join(f'{i:03d}\n' for i in range(100))
+
+        buf = OutputBuffer(max_size=20)
+        for idx in range(0, len(data), 7):
+            buf.append(data[idx:idx + 7])
+        self.assertEqual(len(buf), 400)
+        self.assertEqual(buf.dropped, 380)
+        self.assertEqual(buf.getvalue(), data[:10] + data[-10:])
+        # the head and the tail are not joined across the dropped output
+        self.assertEqual(buf.since(5), data[-10:])
+        self.assertEqual(buf.since(200), data[-10:])
+        self.assertEqual(buf.tail(4), '099\n')
+        self.assertEqual(buf.tail(100), data[-10:])
+
+        # nothing dropped (yet): head and tail are contiguous
+        buf = OutputBuffer(max_size=20)
+        buf.append('Ques')
+        buf.append('tion? ')
+        self.assertEqual(buf.since(2), 'estion? ')
+        buf.append('x' * 30)
+        self.assertEqual(buf.dropped, 20)
+        self.assertFalse('Question?' in buf.since(0))
+        self.assertEqual(buf.since(0), 'x' * 10)
+
+        buf = OutputBuffer(b'', max_size=20, policy='tail')
+        for idx in range(0, len(data), 7):
+            buf.append(data[idx:idx + 7].encode())
+        self.assertEqual(buf.getvalue(), data[-20:].encode())
+        self.assertEqual(buf.since(0), data[-20:].encode())
+        self.assertEqual(buf.dropped, 380)
+        self.assertEqual(buf.spill_file, None)
+
+        buf = OutputBuffer(max_size=20, policy='spill')
+        for idx in range(0, len(data), 7):
+            buf.append(data[idx:idx + 7])
+        buf.close()
+        self.assertEqual(buf.getvalue(), data[-20:])
+        with open(buf.spill_file) as fih:
+            self.assertEqual(fih.read(), data[:-20])
+        buf.append('more')
+        buf.close()
+        with open(buf.spill_file) as fih:
+            self.assertEqual(fih.read(), data[:-16])
+        os.remove(buf.spill_file)
+
+        self.assertErrorRegex(ValueError, 'Unknown output policy foo', OutputBuffer, policy='foo')
+
+    def test_max_output(self):
+        """Test limiting the output"""
+        script = 'import sys; [sys.stdout.write("%09d\\n" % i) for i in range(100000)]; sys.stderr.write("err")'
+        cmd = [sys.executable, '-c', script]
+        full = ''.join(f'{i:09d}\n' for i in range(100000))
+
+        for func in [run, asyncloop, RunNoShellQA.run]:
+            res = func(cmd, max_output=100)
+            ec, output = res
+            self.assertEqual(ec, 0)
+            self.assertEqual(output, full[:50] + (full + 'err')[-50:])
+            self.assertEqual(res.dropped, len(full) + 3 - 100)
+
+        res = asyncloop(cmd, max_output=100, max_output_policy='tail', separate_stderr=True)
+        self.assertEqual(res, (0, full[-100:], 'err'))
+        self.assertEqual(res.dropped, len(full) - 100)
+
+        runner = RunNoShell(cmd, max_output=100, max_output_policy='spill')
+        ec, output = runner._run()
+        self.assertEqual(output, (full + 'err')[-100:])
+        with open(runner.output_spill_file) as fih:
+            self.assertEqual(fih.read() + output, full + 'err')
+        os.remove(runner.output_spill_file)
+        self.assertEqual(runner.stderr_spill_file, None)
+
+        # no limit, no dropped
+        res = asyncloop(cmd)
+        self.assertEqual(res, (0, full + 'err'))
+        self.assertEqual(res.dropped, None)
+
+        self.assertErrorRegex(ValueError, 'max_output_policy foo should be', run, cmd, max_output=1,
+                              max_output_policy='foo')
+        self.assertErrorRegex(ValueError, 'max_output -1 should be', run, cmd, max_output=-1)
+
+        # questions are found in the kept tail
+        qa_script = 'import sys; sys.stdout.write("x" * 1000000 + "Question?"); sys.stdout.flush(); print(input())'
+        res = RunNoShellQA.run([sys.executable, '-c', qa_script], qa={'Question?': 'answer'},
+                               max_output=100, max_output_policy='tail')
+        self.assertEqual(res.exitcode, 0)
+        self.assertTrue(res.output.endswith('xQuestion?answer\n'))
+        self.assertEqual(res.dropped, 1000000 + len('Question?answer\n') - 100)
+
+    def test_run_many(self):
+        """Test running commands concurrently"""
+        cmds = [['echo', str(idx)] for idx in range(20)]
+        res = list(run_many(cmds, max_workers=4))
+        self.assertEqual(sorted(res), sorted((cmd, 0, f"{cmd[1]}\n") for cmd in cmds))
+
+        # commands run concurrently, but never more than max_workers
+        sleep = [sys.executable, '-c', 'import time; time.sleep(0.5); print("done")']
+        start = time.time()
+        res = list(run_many([sleep] * 4, max_workers=4))
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(res, [(sleep, 0, 'done\n')] * 4)
+
+        start = time.time()
+        res = list(run_many([sleep] * 4, max_workers=2))
+        self.assertTrue(time.time() - start >= 1)
+
+        # timeout and exitcodes of the class are used
+        cmds = [[sys.executable, SCRIPT_SIMPLE, 'longsleep'], ['false'], [sys.executable, SCRIPT_SIMPLE, 'shortsleep']]
+        start = time.time()
+        res = list(run_many(cmds, max_workers=3, cls=RunNoShellTimeout, timeout=1))
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual([x[0] for x in res], cmds[1:] + cmds[:1])
+        self.assertEqual(res[0][1], 1)
+        self.assertEqual(res[1][1:], (0, "Shortsleep completed\n"))
+        self.assertEqual(res[2][1:], (RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT))
+
+        # a killed process that does not exit (eg in D state) does not block the other processes
+        class RunStuckTimeout(RunNoShellTimeout):
+            STOP_TASKS_WAIT = 2
+
+            def _killtasks(self, *args, **kwargs):
+                pass
+
+        start = time.time()
+        cmds = [['sleep', '3']] * 2 + [['echo', 'fast']]
+        res = list(run_many(cmds, max_workers=3, cls=RunStuckTimeout, timeout=0.5, disable_log=True))
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(res[0], (['echo', 'fast'], 0, 'fast\n'))
+        self.assertEqual([x.exitcode for x in res[1:]], [RUNRUN_TIMEOUT_EXITCODE] * 2)
+
+        # stop_tasks of a single command does not wait for the process either
+        start = time.time()
+        self.assertEqual(RunStuckTimeout.run(['sleep', '3'], timeout=0.5, disable_log=True)[0], RUNRUN_TIMEOUT_EXITCODE)
+        self.assertTrue(time.time() - start < 2)
+
+        # qa
+        qa_dict = {
+            "Enter a number ('0' to stop):": ['1', '2', '4', '0'],
+        }
+        cmds = [[sys.executable, SCRIPT_QA, 'ask_number', '4']] * 3
+        for _, ec, output in run_many(cmds, max_workers=3, cls=RunQAShort, qa=qa_dict):
+            self.assertEqual(ec, 0)
+            self.assertTrue(output.endswith('Answer: 7\n'), output)
+
+        # startpath
+        cwd = os.getcwd()
+        res = list(run_many([["pwd"]] * 3, max_workers=3, startpath=self.tempdir))
+        self.assertEqual([x[1:] for x in res], [(0, os.path.realpath(self.tempdir) + '\n')] * 3)
+        self.assertEqual([(x.cmd, x.exitcode, x.resources) for x in res], [(["pwd"], 0, None)] * 3)
+        self.assertEqual(os.getcwd(), cwd)
+
+        # processes are killed when generator is closed
+        gen = run_many([['echo', 'fast'], [sys.executable, SCRIPT_SIMPLE, 'longsleep']], max_workers=2)
+        self.assertEqual(next(gen), (['echo', 'fast'], 0, 'fast\n'))
+        gen.close()
+
+        self.assertErrorRegex(ValueError, "not a RunLoop subclass", list, run_many([['true']], cls=RunNoShell))
+        self.assertErrorRegex(ValueError, "max_workers should be", list, run_many([['true']], max_workers=0))
+
+    def test_separate_stderr(self):
+        """Test separating the stderr from the output"""
+        # more than a pipe buffer on both, so both must be read together
+        code = 'import sys; sys.stderr.write("e" * 200000); sys.stdout.write("o" * 200000); sys.exit(2)'
+        cmd = [sys.executable, '-c', code]
+        for cls in [RunNoShell, RunNoShellAsync, RunNoShellAsyncLoop, RunNoShellLoopStdout, RunNoShellTimeout]:
+            kwargs = {'timeout': 10} if cls is RunNoShellTimeout else {}
+            ec, output, stderr = cls.run(cmd, separate_stderr=True, **kwargs)
+            self.assertEqual(ec, 2)
+            self.assertEqual(output, 'o' * 200000)
+            self.assertEqual(stderr, 'e' * 200000)
+
+        ec, output = asyncloop(cmd)
+        self.assertEqual(len(output), 400000)
+
+        # a child that outlives the process and fills the stderr pipe after the loop stopped
+        cmd = ['sh', '-c', '(sleep 0.5; head -c 200000 /dev/zero >&2; echo done) & exit 0']
+        for cls in [RunNoShellLoop, RunNoShellAsyncLoop]:
+            ec, output, stderr = cls.run(cmd, separate_stderr=True)
+            self.assertEqual((ec, output, len(stderr)), (0, 'done\n', 200000))
+        res = list(run_many([cmd] * 2, max_workers=2, separate_stderr=True))
+        self.assertEqual([(x[1], x[2], len(x[3])) for x in res], [(0, 'done\n', 200000)] * 2)
+
+        # both are returned by run_many
+        res = list(run_many([['sh', '-c', 'echo out; echo err >&2']] * 2, max_workers=2, separate_stderr=True))
+        self.assertEqual([x[1:] for x in res], [(0, 'out\n', 'err\n')] * 2)
+
+        # only questions in the output are answered
+        qa_dict = {'Simple question:': 'simple answer'}
+        ec, output, stderr = run_qas([sys.executable, SCRIPT_QA, 'simple'], qa=qa_dict, separate_stderr=True)
+        self.assertEqual(ec, 0)
+        self.assertEqual(stderr, '')
+
+        # streaming
+        r = RunNoShellAsyncLoop.stream(['sh', '-c', 'echo out; echo err >&2; echo out2'], separate_stderr=True)
+        self.assertEqual(list(r), ['out\n', 'out2\n'])
+        self.assertEqual(r._process_stderr, 'err\n')
+        self.assertErrorRegex(ValueError, 'only be read separately', list, RunNoShell.stream(['true'], separate_stderr=True))
+
+    def test_file_tee(self):
+        """Test passing the output to a file, and returning the end of it"""
+        fn = os.path.join(self.tempdir, 'subdir', 'out')
+        code = 'import sys; sys.stdout.write("".join("line %d\\n" % i for i in range(500000))); sys.exit(2)'
+        expected = ''.join(f"line {i}\n" for i in range(500000))
+
+        class RunNoShellFileReadWrite(RunNoShellFile):
+            TEE_SPLICE = False
+
+        for cls in [RunNoShellFile, RunNoShellFileReadWrite]:
+            ec, output = cls.run([sys.executable, '-c', code], filename=fn, tee=True)
+            self.assertEqual(ec, 2)
+            self.assertEqual(output, expected[-RunNoShellFile.TEE_TAIL_SIZE:])
+            with open(fn) as fih:
+                self.assertEqual(fih.read(), expected)
+
+        # stderr is read meanwhile
+        code = 'import sys; sys.stderr.write("e" * 200000); sys.stdout.write("o" * 200000)'
+        ec, output, stderr = RunNoShellFile.run([sys.executable, '-c', code], filename=fn, tee=True,
+                                                separate_stderr=True)
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'o' * RunNoShellFile.TEE_TAIL_SIZE)
+        self.assertEqual(stderr, 'e' * 200000)
+
+        # without tee, nothing is returned
+        ec, output = RunNoShellFile.run(['echo', 'hello'], filename=fn)
+        self.assertEqual((ec, output), (0, ''))
+        with open(fn) as fih:
+            self.assertEqual(fih.read(), 'hello\n')
+
+    def test_binary_encoding(self):
+        """Test returning the output as bytes, or decoded with an encoding"""
+        # the odd number of single byte characters makes the 2-byte characters span the reads
+        text = 'a' + '\u00e9' * 3000 + '\n'
+        code = f'import sys; sys.stdout.buffer.write({text.encode()!r})'
+        cmd = [sys.executable, '-c', code]
+        for cls in [RunNoShell, RunNoShellAsync, RunNoShellAsyncLoop, RunNoShellTimeout]:
+            kwargs = {'timeout': 10} if cls is RunNoShellTimeout else {}
+            self.assertEqual(cls.run(cmd, binary=True, **kwargs), (0, text.encode()))
+            self.assertEqual(cls.run(cmd, encoding='utf-8', **kwargs), (0, text))
+            # default is ASCII with backslash escapes
+            ec, output = cls.run(cmd, **kwargs)
+            self.assertEqual(output, text.encode().decode('ascii', 'backslashreplace'))
+
+        ec, output, stderr = asyncloop([sys.executable, '-c', code + '; sys.stderr.buffer.write(b"\\xc3\\xa9")'],
+                                       encoding='utf-8', separate_stderr=True)
+        self.assertEqual((output, stderr), (text, '\u00e9'))
+
+        self.assertEqual(list(RunNoShell.stream(['printf', 'a\\nb'], binary=True)), [b'a\n', b'b'])
+        self.assertEqual(run_timeout([sys.executable, SCRIPT_SIMPLE, 'longsleep'], timeout=0.5, binary=True),
+                         (RUNRUN_TIMEOUT_EXITCODE, b''))
+
+        # no output is always empty bytes, also while only waiting for the exit (no pidfd)
+        runner = RunNoShellAsyncLoop(['sh', '-c', 'exec >&- 2>&-; sleep 0.3'], binary=True)
+        with mock.patch.object(os, 'pidfd_open', side_effect=OSError(errno.ENOSYS, 'not supported'), create=True):
+            with mock.patch.object(runner, '_loop_process_output', wraps=runner._loop_process_output) as process:
+                self.assertEqual(runner._run(), (0, b''))
+        self.assertTrue(process.call_count > 0)
+        self.assertTrue(all(call[0][0] == b'' for call in process.call_args_list))
+        for cls in [RunNoShellFile, RunPty]:
+            self.assertEqual(cls(['true'], binary=True)._read_process(), b'')
+
+        self.assertErrorRegex(ValueError, "can not be binary", RunNoShell, ['true'], binary=True, encoding='utf-8')
+        self.assertErrorRegex(ValueError, "binary output", RunNoShellQA, ['true'], binary=True)
+
+        qa_dict = {'Simple question:': 'simple answer'}
+        ec, output = run_qas([sys.executable, SCRIPT_QA, 'simple'], qa=qa_dict, encoding='utf-8')
+        self.assertEqual(ec, 0)
+
+    def test_posix_spawn(self):
+        """Test starting the processes with posix_spawn"""
+        if not getattr(subprocess, '_USE_POSIX_SPAWN', False):
+            self.skipTest("subprocess does not use posix_spawn on this platform")
+
+        with mock.patch('os.posix_spawn', side_effect=os.posix_spawn) as posix_spawn:
+            self.assertEqual(run(['echo', 'hello'], posix_spawn=True), (0, 'hello\n'))
+            self.assertEqual(posix_spawn.call_count, 1)
+            self.assertEqual(posix_spawn.call_args[0][0], shutil.which('echo'))
+
+            # with shell
+            self.assertEqual(run_simple('echo hello | tr a-z A-Z', posix_spawn=True), (0, 'HELLO\n'))
+            self.assertEqual(posix_spawn.call_count, 2)
+
+            # PATH of the environment is used
+            env = {'PATH': os.path.dirname(sys.executable)}
+            ec, output = asyncloop([os.path.basename(sys.executable), '-c', 'print(42)'], env=env, posix_spawn=True)
+            self.assertEqual((ec, output), (0, '42\n'))
+            self.assertEqual(posix_spawn.call_count, 3)
+
+            self.assertEqual(run(['echo', 'hello']), (0, 'hello\n'))
+            self.assertEqual(posix_spawn.call_count, 3)
+
+        self.assertRaises(FileNotFoundError, run, ['no_such_command_at_all'], posix_spawn=True)
+
+    def test_run_pool(self):
+        """Test running commands in a pool of shells"""
+        with RunPool(workers=2) as pool:
+            self.assertEqual(pool.run(['echo', 'hello world', '$HOME']), (0, 'hello world $HOME\n'))
+            self.assertEqual(pool.run('echo out; echo err >&2; exit 3'), (3, 'out\nerr\n'))
+            self.assertEqual(pool.run(['printf', 'no newline']), (0, 'no newline'))
+
+            # commands do not change the shell, and can't read the input of the shell
+            self.assertEqual(pool.run('cd /; export FOO=bar; exit 0'), (0, ''))
+            self.assertEqual(pool.run('pwd; echo "foo=$FOO"'), (0, '%s\nfoo=\n' % os.getcwd()))
+            self.assertEqual(pool.run('cat'), (0, ''))
+
+            # syntax errors are errors of the command
+            ec, output = pool.run('echo (')
+            self.assertEqual(ec, 2)
+            self.assertTrue('syntax error' in output)
+
+            # startpath and env per command
+            self.assertEqual(pool.run('pwd', startpath=self.tempdir), (0, '%s\n' % self.tempdir))
+            self.assertErrorRegex(ValueError, 'not an existing directory', pool.run, 'pwd', startpath='/no/such/dir')
+            ec, output = pool.run('env', env={'FOO': "it's a test", 'PATH': '/usr/bin:/bin'})
+            self.assertEqual(ec, 0)
+            self.assertEqual(sorted(output.splitlines())[:2], ["FOO=it's a test", 'PATH=/usr/bin:/bin'])
+            self.assertFalse('HOME=' in output)
+            self.assertErrorRegex(ValueError, 'invalid environment variable', pool.run, 'env', env={'A B': 'x'})
+
+            # timeout kills the command and the shell, the next command gets a new shell
+            # the partial output is dropped, like with RunTimeout
+            start = time.time()
+            res = pool.run('echo start; sleep 30; echo end', timeout=1)
+            self.assertEqual(res, (RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT))
+            self.assertEqual(res, run_timeout('echo start; sleep 30; echo end', timeout=1))
+            self.assertTrue(time.time() - start < 10)
+            self.assertEqual(pool.run('echo again'), (0, 'again\n'))
+
+        self.assertErrorRegex(ValueError, 'pool is closed', pool.run, 'true')
+
+        # shells are replaced after max_commands commands
+        with RunPool(max_commands=3) as pool:
+            pids = [int(pool.run('echo $$')[1]) for _ in range(6)]
+        self.assertEqual(pids, [pids[0]] * 3 + [pids[3]] * 3)
+        self.assertNotEqual(pids[0], pids[3])
+
+    def test_accounting(self):
+        """Test measuring the resources used by the commands"""
+        script = "import time; x = bytearray(200 * 2**20); open(%r, 'wb').write(x[:2**20]); time.sleep(0.5)"
+        cmd = [sys.executable, '-c', script % os.path.join(self.tempdir, 'out')]
+
+        self.assertEqual(len(run(['true'])), 2)
+        self.assertEqual(run(['true']).resources, None)
+        res = run(cmd, accounting=True)
+        self.assertEqual(res, (0, ''))
+        resources = res.resources
+        self.assertTrue(0.5 <= resources.wall < 5)
+        self.assertTrue(resources.cpu > 0)
+        self.assertTrue(resources.utime > 0)
+        self.assertTrue(resources.maxrss > 200 * 2**20)
+        self.assertTrue(resources.io['wchar'] >= 2**20)
+        self.assertTrue(resources.as_dict()['wchar'] >= 2**20)
+
+        # sampled in the loop, killed on timeout
+        res = RunNoShellTimeout.run(['bash', '-c', 'head -c 1000000 /dev/zero > /dev/null; sleep 10'],
+                                    timeout=1, separate_stderr=True, accounting=True)
+        self.assertEqual(res, (RUNRUN_TIMEOUT_EXITCODE, RUNRUN_TIMEOUT_OUTPUT, ''))
+        self.assertEqual((res.exitcode, res.output, res.stderr), res)
+        resources = res.resources
+        self.assertTrue(0.5 <= resources.wall < 5)
+        self.assertTrue(resources.io['rchar'] >= 1000000)
+
+        runner = RunNoShell(['echo', 'hello'], log_resources=True)
+        with mock.patch.object(runner.log, 'info') as info:
+            self.assertEqual(runner._run(), (0, 'hello\n'))
+        self.assertEqual(info.call_count, 1)
+        logged = info.call_args[1]['extra']['resources']
+        self.assertEqual(logged, runner.resources.as_dict())
+        self.assertTrue(logged['wall'] > 0)
+
+        # only the public poll and wait of Popen are extended
+        popen = AccountingPopen.subclass(subprocess.Popen)
+        proc = popen(['sh', '-c', 'exit 3'])
+        self.assertEqual(proc.wait(), 3)
+        self.assertEqual(proc.poll(), 3)
+        self.assertTrue(proc.rusage is not None and proc.reaped is not None)
+        self.assertTrue('rchar' in proc.io)
+
+        proc = popen(['sleep', '10'])
+        self.assertEqual(proc.poll(), None)
+        self.assertRaises(subprocess.TimeoutExpired, proc.wait, timeout=0.1)
+        self.assertEqual(proc.rusage, None)
+        proc.kill()
+        self.assertEqual(proc.wait(timeout=5), -signal.SIGKILL)
+        self.assertTrue(proc.rusage is not None)
+
+        # poll does not block while another thread waits for the process
+        proc = popen(['sleep', '10'])
+        waiter = threading.Thread(target=proc.wait)
+        waiter.start()
+        time.sleep(0.2)
+        start = time.time()
+        self.assertEqual(proc.poll(), None)
+        self.assertTrue(time.time() - start < 1)
+        proc.kill()
+        waiter.join(5)
+        self.assertEqual(proc.poll(), -signal.SIGKILL)
+        self.assertTrue(proc.rusage is not None)
+
+        with popen(['true']) as proc:
+            pass
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(proc.rusage is not None)
+
+    def test_cgroup(self):
+        """Test running in a cgroup with limits, in a fake cgroup layout"""
+        parent = os.path.join(self.tempdir, 'delegated')
+        os.mkdir(parent)
+
+        limits = {'cpu_max': 1.5, 'memory_max': '1G', 'io_weight': 50, 'pids_max': 10}
+        runner = RunNoShell([sys.executable, '-c', 'import os; print(os.getpid())'], cgroup_parent=parent, **limits)
+        ec, output = runner._run()
+        self.assertEqual(ec, 0)
+
+        # the fake cgroup can't be removed
+        cgroups = os.listdir(parent)
+        self.assertEqual(len(cgroups), 2)
+        self.assertTrue('cgroup.subtree_control' in cgroups)
+        with open(os.path.join(parent, 'cgroup.subtree_control')) as fih:
+            self.assertEqual(sorted(fih.read().split()), ['+cpu', '+io', '+memory', '+pids'])
+
+        cgroup = runner._cgroup.path
+        expected = {
+            'cpu.max': '150000 100000',
+            'memory.max': '1G',
+            'io.weight': 'default 50',
+            'pids.max': '10',
+            'cgroup.procs': output,
+        }
+        for name, value in expected.items():
+            with open(os.path.join(cgroup, name)) as fih:
+                self.assertEqual(fih.read(), value)
+        self.assertEqual(runner.cgroup_stats, {'memory.peak': None, 'cpu.stat': {}})
+
+        # cgroup statistics are part of the resources
+        res = RunNoShellTimeout.run(['sleep', '10'], timeout=1, cgroup_parent=parent, pids_max=10, accounting=True)
+        self.assertEqual(res.exitcode, RUNRUN_TIMEOUT_EXITCODE)
+        self.assertEqual(res.resources.cgroup, {'memory.peak': None, 'cpu.stat': {}})
+        self.assertEqual(len(os.listdir(parent)), 3)
+
+    def test_cpus_nice(self):
+        """Test pinning processes to cpus and changing their priority"""
+        cpu = min(os.sched_getaffinity(0))
+        cmd = ['grep', '-E', '^Cpus_allowed_list', '/proc/self/status']
+        for cpus in [[cpu], str(cpu)]:
+            self.assertEqual(run(cmd, cpus=cpus), (0, f'Cpus_allowed_list:\t{cpu}\n'))
+        self.assertErrorRegex(ValueError, 'not allowed cpus', run, cmd, cpus=[100000])
+        self.assertErrorRegex(ValueError, 'no cpus', run, cmd, cpus=[])
+
+        nice = os.getpriority(os.PRIO_PROCESS, 0) + 5
+        cmd = [sys.executable, '-c', 'import os; print(os.getpriority(os.PRIO_PROCESS, 0))']
+        self.assertEqual(asyncloop(cmd, nice=nice), (0, f'{nice}\n'))
+        self.assertErrorRegex(ValueError, 'nice 100 should be', run, cmd, nice=100)
+
+        # failures in the new process are errors, the command does not run
+        refused = PermissionError(errno.EACCES, 'Permission denied')
+        for func in [run, asyncloop]:
+            with mock.patch('os.setpriority', side_effect=refused):
+                self.assertRaises(subprocess.SubprocessError, func, ['touch', 'ran'], nice=-5,
+                                  startpath=self.tempdir, disable_log=True)
+        with mock.patch('os.sched_setaffinity', side_effect=OSError(errno.EINVAL, 'Invalid argument')):
+            self.assertRaises(subprocess.SubprocessError, run, ['touch', 'ran'], cpus=[cpu],
+                              startpath=self.tempdir, disable_log=True)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'ran')))
+
+        # commands are spread over the groups of cpus
+        groups = [[cpu], [cpu]]
+        cmd = ['grep', '-E', '^Cpus_allowed_list', '/proc/self/status']
+        with mock.patch('vsc.utils.run.spread_cpus', return_value=groups) as spread:
+            res = list(run_many([cmd] * 4, max_workers=2, spread='numa'))
+        spread.assert_called_once_with(2, numa=True)
+        self.assertEqual([output for _, _, output in res], [f'Cpus_allowed_list:\t{cpu}\n'] * 4)
+        self.assertErrorRegex(ValueError, 'spread should be', lambda: list(run_many([cmd], spread='sockets')))
+
+    def test_readsize(self):
+        """Test configurable and adaptive read sizes, and the pipe size"""
+        size = 4 * 1024 * 1024
+        cmd = ['head', '-c', str(size), '/dev/zero']
+        self.assertEqual(asyncloop(cmd, readsize=65536, binary=True), (0, b'\0' * size))
+
+        r = RunNoShellAsyncLoop(cmd, binary=True, adaptive_readsize=True)
+        self.assertEqual(r._run(), (0, b'\0' * size))
+        self.assertTrue(r.readsize > RunNoShellAsyncLoop.READSIZE)
+        # default pipe size of 64kB
+        self.assertTrue(r.readsize <= r._readsize_max <= RunNoShellAsyncLoop.READSIZE_MAX)
+
+        r = RunNoShellAsyncLoop(cmd, binary=True, adaptive_readsize=True, pipe_size=1024 * 1024)
+        self.assertEqual(r._run(), (0, b'\0' * size))
+        self.assertEqual(r._readsize_max, 1024 * 1024)
+
+        # sparse output shrinks the readsize again
+        r = RunNoShellAsyncLoop(['sh', '-c', 'for i in 1 2 3 4 5; do echo $i; sleep 0.1; done'],
+                                readsize=8192, adaptive_readsize=True)
+        self.assertEqual(r._run(), (0, '1\n2\n3\n4\n5\n'))
+        self.assertEqual(r.readsize, RunNoShellAsyncLoop.READSIZE_MIN)
+
+        self.assertErrorRegex(ValueError, 'readsize 0 should be a positive integer', run, cmd, readsize=0)
+        self.assertErrorRegex(ValueError, 'pipe_size foo should be', run, cmd, pipe_size='foo')
+
+    def test_log_buffered(self):
+        """Test logging the output of a command, buffered in the logger"""
+        cmd = [sys.executable, '-c', 'import sys\nfor i in range(1000): print(i, flush=True)']
+        expected = ''.join('%d\n' % idx for idx in range(1000))
+        for log_buffered in [False, True]:
+            runner = RunNoShellLoopLog(cmd, log_buffered=log_buffered)
+            stream = StringIO()
+            handler = logging.StreamHandler(stream)
+            runner.log.addHandler(handler)
+            level = runner.log.level
+            runner.log.setLevel(logging.INFO)
+            # only to this handler
+            runner.log.propagate = False
+            try:
+                self.assertEqual(runner._run(), (0, expected))
+            finally:
+                runner.log.removeHandler(handler)
+                runner.log.setLevel(level)
+                runner.log.propagate = True
+            self.assertTrue(stream.getvalue().endswith(expected), stream.getvalue())
+
+    def test_stream(self):
+        """Test streaming the output"""
+        cmd = [sys.executable, '-c', 'import sys; sys.stdout.write("a\\nbb\\n" * 1000 + "no newline"); sys.exit(3)']
+        for cls in [RunNoShell, RunNoShellAsync, RunNoShellAsyncLoop]:
+            r = cls.stream(cmd)
+            self.assertEqual(r.exitcode, None)
+            lines = list(r)
+            self.assertEqual(lines, ['a\n', 'bb\n'] * 1000 + ['no newline'])
+            self.assertEqual(r.exitcode, 3)
+            # output is not collected
+            self.assertEqual(r._process_output, '')
+
+        # chunks, collect the output anyway
+        r = RunNoShell.stream(cmd, lines=False, keep_output=True)
+        chunks = list(r)
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) <= r.readsize for chunk in chunks))
+        self.assertEqual(''.join(chunks), r._process_output)
+        self.assertEqual(r._process_output, 'a\nbb\n' * 1000 + 'no newline')
+
+        # a line without newline is yielded in parts, it is not kept in memory until the end
+        cmd = [sys.executable, '-c', 'import sys; sys.stdout.write("x" * 100000 + "\\nend\\n")']
+        r = RunNoShell.stream(cmd, max_output=1000)
+        lines = list(r)
+        self.assertTrue(len(lines) > 50)
+        self.assertTrue(all(len(line) < 1000 + r.readsize for line in lines))
+        self.assertEqual(''.join(lines), 'x' * 100000 + '\nend\n')
+        self.assertEqual(lines[-1], 'end\n')
+
+        # stopping early kills the command
+        r = RunNoShell.stream([sys.executable, '-c', 'import time; print("first", flush=True); time.sleep(10)'])
+        start = time.time()
+        for line in r:
+            self.assertEqual(line, 'first\n')
+            break
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(r.exitcode, -9)
+
+        # the loop hooks are applied, so the timeout works
+        start = time.time()
+        r = RunNoShellTimeout.stream([sys.executable, SCRIPT_SIMPLE, 'longsleep'], timeout=1)
+        self.assertEqual(list(r), [])
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(r.exitcode, RUNRUN_TIMEOUT_EXITCODE)
+
+        # qa
+        qa_dict = {
+            "Enter a number ('0' to stop):": ['1', '2', '4', '0'],
+        }
+        r = RunQAShort.stream([sys.executable, SCRIPT_QA, 'ask_number', '4'], qa=qa_dict)
+        # the questions have no newline, so they are part of the line with the answer
+        self.assertTrue(list(r)[-1].endswith('Answer: 7\n'))
+        self.assertEqual(r.exitcode, 0)
+
+        # startpath is only used to start the command
+        cwd = os.getcwd()
+        r = RunNoShell.stream(['pwd'], startpath=self.tempdir)
+        self.assertEqual(list(r), [os.path.realpath(self.tempdir) + '\n'])
+        self.assertEqual(os.getcwd(), cwd)
+
     def test_qa_simple(self):
         """Simple testing"""
         ec, output = run_qas([sys.executable, SCRIPT_QA, 'noquestion'])
@@ -375,6 +1111,49 @@ class TestRun(TestCase):
         # restore
         RunQAShort.CYCLE_ANSWERS = orig_cycle_answers
 
+    def test_qa_many_questions(self):
+        """Test qa with many (unrelated) questions and no_qa patterns"""
+        qa_dict = {f"Unrelated question {idx}?": 'no' for idx in range(100)}
+        qa_dict["Enter a number ('0' to stop):"] = ['1', '2', '4', '0']
+        qa_reg_dict = {rf"Other (?P<nr>{idx}) question\?": '%(nr)s' for idx in range(100)}
+        no_qa = [rf"Not a question {idx}" for idx in range(100)]
+        ec, output = run_qas([sys.executable, SCRIPT_QA, 'ask_number', '4'], qa=qa_dict, qa_reg=qa_reg_dict, no_qa=no_qa)
+        self.assertEqual(ec, 0)
+        answer_re = re.compile(".*Answer: 7$")
+        self.assertTrue(answer_re.match(output), f"'{output}' matches pattern '{answer_re.pattern}'")
+
+        # questions are combined in a single regex, if possible
+        runqa = RunQAShort([], qa=qa_dict, no_qa=no_qa)
+        self.assertTrue(runqa._qa_any.search("Unrelated question 42?"))
+        self.assertTrue(runqa._qa_any.search("Enter a number ('0' to stop): "))
+        self.assertFalse(runqa._qa_any.search("Unrelated question 42? no\n"))
+        self.assertTrue(runqa._no_qa_any.search("Not a question 7\n"))
+
+        # duplicate named groups and backreferences can't be combined
+        self.assertEqual(RunQAShort([], qa_reg=qa_reg_dict)._qa_any, None)
+        self.assertEqual(RunQAShort([], no_qa=[r'(a)\1', 'b'])._no_qa_any, None)
+
+        # qa first, then qa_reg
+        runqa = RunQAShort([], qa={'b': 'x', 'a': 'y'}, qa_reg={'0': 'z'})
+        self.assertEqual([answers for _, answers in runqa._qa_all], [['y\n'], ['x\n'], ['z\n']])
+
+    def test_qa_debug(self):
+        """Test the output of a successful qa command is only reported when debug is logged"""
+        cmd = [sys.executable, SCRIPT_QA, 'ask_number', '1']
+        qa_dict = {"Enter a number ('0' to stop):": ['3', '0']}
+        for level, expected in [(logging.INFO, False), (logging.DEBUG, True)]:
+            runqa = RunNoShellQA(cmd, qa=qa_dict)
+            orig_level = runqa.log.level
+            runqa.log.setLevel(level)
+            try:
+                with mock.patch.object(runqa.log, 'debug') as debug:
+                    ec, _ = runqa._run()
+            finally:
+                runqa.log.setLevel(orig_level)
+            self.assertEqual(ec, 0)
+            messages = [call[0][0] for call in debug.call_args_list]
+            self.assertEqual('_post_exitcode: success cmd %s: output %s' in messages, expected)
+
     def test_qa_no_newline(self):
         """Test we do not add newline to the answer."""
         qa_dict = {